@@ -2,8 +2,10 @@ from django.contrib import admin
 from models import Image
 from models import Host
 from models import Container
+from models import Job
 # Register your models here.
 
 admin.site.register(Image)
 admin.site.register(Host)
 admin.site.register(Container)
+admin.site.register(Job)
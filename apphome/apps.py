@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+from django.apps import AppConfig
+
+
+class ApphomeConfig(AppConfig):
+    name = 'apphome'
+
+    def ready(self):
+        # 容器状态变化的事件, 见 telegraph_pole/lib/events.py
+        from telegraph_pole.lib import events
+        events.connect_signals()
@@ -0,0 +1,14 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Longgeek <longgeek@gmail.com>
+
+from django.core.management.base import NoArgsCommand
+
+from telegraph_pole.lib import jobs
+
+
+class Command(NoArgsCommand):
+    help = 'Consume scheduler replies for asynchronous container jobs.'
+
+    def handle_noargs(self, **options):
+        jobs.consume()
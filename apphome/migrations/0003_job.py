@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apphome', '0002_auto_20150307_0933'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('message_type', models.CharField(max_length=40)),
+                ('container_id', models.CharField(max_length=20, null=True, blank=True)),
+                ('status', models.CharField(default=b'pending', max_length=20, choices=[(b'pending', b'Pending'), (b'success', b'Success'), (b'error', b'Error'), (b'timeout', b'Timeout')])),
+                ('detail', models.TextField(null=True, blank=True)),
+                ('result', models.TextField(null=True, blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('deadline', models.DateTimeField()),
+                ('finished', models.DateTimeField(null=True, blank=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apphome', '0003_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='batch',
+            field=models.CharField(db_index=True, max_length=32, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='message',
+            field=models.TextField(null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AlterField(
+            model_name='job',
+            name='status',
+            field=models.CharField(default=b'pending', max_length=20, choices=[(b'queued', b'Queued'), (b'pending', b'Pending'), (b'success', b'Success'), (b'error', b'Error'), (b'timeout', b'Timeout')]),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apphome', '0004_job_batch'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='container',
+            name='cid',
+            field=models.CharField(db_index=True, max_length=80, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AlterField(
+            model_name='container',
+            name='user_id',
+            field=models.CharField(max_length=36),
+            preserve_default=True,
+        ),
+        migrations.AlterIndexTogether(
+            name='container',
+            index_together=set([('user_id', 'create_status'), ('host', 'create_status')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='host',
+            index_together=set([('ip', 'port')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='image',
+            index_together=set([('repository', 'tag')]),
+        ),
+    ]
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import re
+import calendar
+import datetime
+
+from django.db import models, migrations, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+
+# 每批转换的行数, 每批一条 UPDATE, 参数个数不超过 SQLite 的限制(999)
+BATCH_SIZE = 200
+
+# 以下转换复制自 telegraph_pole.lib.convert, 迁移不能依赖之后会修改的
+# 代码
+
+SIZE_UNITS = {
+    '': 1, 'b': 1,
+    'k': 1000, 'kb': 1000, 'kib': 1024,
+    'm': 1000 ** 2, 'mb': 1000 ** 2, 'mib': 1024 ** 2,
+    'g': 1000 ** 3, 'gb': 1000 ** 3, 'gib': 1024 ** 3,
+    't': 1000 ** 4, 'tb': 1000 ** 4, 'tib': 1024 ** 4,
+}
+
+SIZE_RE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([a-zA-Z]*)\s*(?:\(.*\))?\s*$')
+
+STATE_PATTERNS = (
+    (re.compile(r'^Up .*\(Paused\)'), 'paused'),
+    (re.compile(r'^Up\b'), 'running'),
+    (re.compile(r'^Restarting\b'), 'restarting'),
+    (re.compile(r'^Exited\b'), 'exited'),
+    (re.compile(r'^Created\b'), 'created'),
+    (re.compile(r'^Removal In Progress'), 'removing'),
+    (re.compile(r'^Dead\b'), 'dead'),
+)
+
+
+def parse_created(value):
+    if not value:
+        return None
+    if re.match(r'^\s*\d+(\.\d+)?\s*$', value):
+        return datetime.datetime.fromtimestamp(float(value), timezone.utc)
+    dt = parse_datetime(value.strip())
+    if dt is None:
+        raise ValueError('Invalid created: %r' % value)
+    if timezone.is_naive(dt):
+        dt = timezone.make_aware(dt, timezone.get_default_timezone())
+    return dt
+
+
+def format_created(value):
+    if value is None:
+        return None
+    return str(calendar.timegm(value.utctimetuple()))
+
+
+def parse_size(value):
+    if not value:
+        return None
+    match = SIZE_RE.match(value)
+    if not match or match.group(2).lower() not in SIZE_UNITS:
+        raise ValueError('Invalid size: %r' % value)
+    return int(round(float(match.group(1)) *
+                     SIZE_UNITS[match.group(2).lower()]))
+
+
+def format_size(value):
+    if value is None:
+        return None
+    return str(value)
+
+
+def parse_state(status):
+    if status:
+        for pattern, state in STATE_PATTERNS:
+            if pattern.match(status):
+                return state
+    return 'unknown'
+
+
+def batches(model, fields):
+    """按 id 分批读取 (id, field, ...)"""
+    last = 0
+    while True:
+        rows = list(model.objects.filter(id__gt=last).order_by('id')
+                    .values_list('id', *fields)[:BATCH_SIZE])
+        if not rows:
+            return
+        yield rows
+        last = rows[-1][0]
+
+
+def parse(func, value, default=None):
+    # 无法解析的旧数据不阻止迁移
+    try:
+        return func(value)
+    except ValueError:
+        return default
+
+
+def update(schema_editor, model, fields, rows):
+    """一条 UPDATE ... CASE id WHEN ... 更新一批行
+
+    Params:
+        fields: 更新的字段名
+        rows:   [(id, value, ...)], value 和 fields 的顺序一致
+    """
+    connection = schema_editor.connection
+    qn = connection.ops.quote_name
+    sets = []
+    params = []
+    for i, name in enumerate(fields, 1):
+        field = model._meta.get_field(name)
+        sets.append('%s = CASE %s %s END' % (
+            qn(field.column), qn('id'),
+            ' '.join('WHEN %d THEN %%s' % row[0] for row in rows)))
+        for row in rows:
+            value = row[i]
+            if isinstance(value, datetime.datetime):
+                value = connection.ops.value_to_db_datetime(value)
+            params.append(value)
+    sql = 'UPDATE %s SET %s WHERE %s IN (%s)' % (
+        qn(model._meta.db_table), ', '.join(sets), qn('id'),
+        ', '.join(str(row[0]) for row in rows))
+    with transaction.atomic():
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+
+
+def forwards(apps, schema_editor):
+    Container = apps.get_model('apphome', 'Container')
+    Image = apps.get_model('apphome', 'Image')
+
+    for rows in batches(Container, ('created', 'size', 'status')):
+        # state 在这里显式设置, 迁移中的模型不会调用 Container.save()
+        update(schema_editor, Container,
+               ('created_at', 'size_bytes', 'state'),
+               [(id, parse(parse_created, created),
+                 parse(parse_size, size), parse_state(status))
+                for id, created, size, status in rows])
+
+    for rows in batches(Image, ('virtual_size',)):
+        update(schema_editor, Image, ('virtual_size_bytes',),
+               [(id, parse(parse_size, virtual_size, 0) or 0)
+                for id, virtual_size in rows])
+
+
+def backwards(apps, schema_editor):
+    Container = apps.get_model('apphome', 'Container')
+    Image = apps.get_model('apphome', 'Image')
+
+    for rows in batches(Container, ('created_at', 'size_bytes')):
+        update(schema_editor, Container, ('created', 'size'),
+               [(id, format_created(created), format_size(size))
+                for id, created, size in rows])
+
+    for rows in batches(Image, ('virtual_size_bytes',)):
+        update(schema_editor, Image, ('virtual_size',),
+               [(id, format_size(virtual_size))
+                for id, virtual_size in rows])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apphome', '0005_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='container',
+            name='created_at',
+            field=models.DateTimeField(db_index=True, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='container',
+            name='size_bytes',
+            field=models.BigIntegerField(null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='container',
+            name='state',
+            field=models.CharField(default='unknown', max_length=20, db_index=True, choices=[('created', 'Created'), ('running', 'Running'), ('paused', 'Paused'), ('restarting', 'Restarting'), ('exited', 'Exited'), ('removing', 'Removing'), ('dead', 'Dead'), ('unknown', 'Unknown')]),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='virtual_size_bytes',
+            field=models.BigIntegerField(default=0),
+            preserve_default=True,
+        ),
+        # 回退时先加回可以为空的列, 转换之后才恢复 NOT NULL
+        migrations.AlterField(
+            model_name='image',
+            name='virtual_size',
+            field=models.CharField(max_length=20, null=True),
+            preserve_default=True,
+        ),
+        migrations.RunPython(forwards, backwards),
+        migrations.RemoveField(
+            model_name='container',
+            name='created',
+        ),
+        migrations.RemoveField(
+            model_name='container',
+            name='size',
+        ),
+        migrations.RemoveField(
+            model_name='image',
+            name='virtual_size',
+        ),
+        migrations.RenameField(
+            model_name='container',
+            old_name='created_at',
+            new_name='created',
+        ),
+        migrations.RenameField(
+            model_name='container',
+            old_name='size_bytes',
+            new_name='size',
+        ),
+        migrations.RenameField(
+            model_name='image',
+            old_name='virtual_size_bytes',
+            new_name='virtual_size',
+        ),
+    ]
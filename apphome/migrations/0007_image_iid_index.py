@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apphome', '0006_typed_columns'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='image',
+            name='iid',
+            field=models.CharField(max_length=80, db_index=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apphome', '0007_image_iid_index'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='job',
+            index_together=set([('status', 'deadline')]),
+        ),
+    ]
@@ -1,23 +1,27 @@
+# -*- coding: utf-8 -*-
 from django.db import models
 from django.utils.translation import ugettext as _
 
+from telegraph_pole.lib import convert
+
 
 class Image(models.Model):
     OS_TYPES = (
         ('ubuntu', 'Ubuntu'),
         ('centos', 'Centos'),
     )
-    iid = models.CharField(max_length=80)
+    iid = models.CharField(max_length=80, db_index=True)
     tag = models.CharField(max_length=40)
     created = models.CharField(max_length=40)
     repository = models.CharField(max_length=40)
-    virtual_size = models.CharField(max_length=20)
+    virtual_size = models.BigIntegerField(default=0)  # Bytes
     os_type = models.CharField(max_length=25, choices=OS_TYPES,
                                null=True, blank=True)
     os_version = models.CharField(max_length=20, null=True, blank=True)
 
     class Meta:
         app_label = "apphome"
+        index_together = [('repository', 'tag')]
 
 Flavor = {
     '1': {
@@ -60,20 +64,35 @@ class Host(models.Model):
 
     class Meta:
         app_label = "apphome"
+        index_together = [('ip', 'port')]
 
 
 class Container(models.Model):
-    cid = models.CharField(max_length=80, null=True, blank=True)
+    STATES = (
+        ('created', 'Created'),
+        ('running', 'Running'),
+        ('paused', 'Paused'),
+        ('restarting', 'Restarting'),
+        ('exited', 'Exited'),
+        ('removing', 'Removing'),
+        ('dead', 'Dead'),
+        ('unknown', 'Unknown'),
+    )
+    cid = models.CharField(max_length=80, null=True, blank=True,
+                           db_index=True)
     tag = models.CharField(max_length=120, null=True, blank=True)
-    size = models.CharField(max_length=40, null=True, blank=True)
+    size = models.BigIntegerField(null=True, blank=True)  # Bytes
     flavor_id = models.CharField(max_length=20)
     image = models.ForeignKey(Image)
     user_id = models.CharField(max_length=36)
     host = models.ForeignKey(Host, null=True, blank=True)
     name = models.CharField(max_length=80, null=True, blank=True)
     command = models.CharField(max_length=200, null=True, blank=True)
-    created = models.CharField(max_length=40, null=True, blank=True)
+    created = models.DateTimeField(null=True, blank=True, db_index=True)
+    # docker ps 的 Status, 例如 "Up 36 minutes", state 由它得出
     status = models.CharField(max_length=40, null=True, blank=True)
+    state = models.CharField(max_length=20, choices=STATES,
+                             default='unknown', db_index=True)
     ports = models.CharField(max_length=400, null=True, blank=True)
     hostname = models.CharField(max_length=80, null=True, blank=True)
     create_status = models.BooleanField(_("Create_Status"), default=False)
@@ -82,3 +101,42 @@ class Container(models.Model):
 
     class Meta:
         app_label = "apphome"
+        # 列表按用户或主机过滤, 并且只列出创建成功的容器
+        index_together = [('user_id', 'create_status'),
+                          ('host', 'create_status')]
+
+    def save(self, *args, **kwargs):
+        self.state = convert.parse_state(self.status)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'status' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | set(['state'])
+        super(Container, self).save(*args, **kwargs)
+
+
+class Job(models.Model):
+    """异步执行的容器操作, 见 lib/jobs"""
+    STATUSES = (
+        ('queued', 'Queued'),
+        ('pending', 'Pending'),
+        ('success', 'Success'),
+        ('error', 'Error'),
+        ('timeout', 'Timeout'),
+    )
+    message_type = models.CharField(max_length=40)
+    container_id = models.CharField(max_length=20, null=True, blank=True)
+    status = models.CharField(max_length=20, choices=STATUSES,
+                              default='pending')
+    detail = models.TextField(null=True, blank=True)
+    result = models.TextField(null=True, blank=True)  # JSON
+    created = models.DateTimeField(auto_now_add=True)
+    deadline = models.DateTimeField()
+    finished = models.DateTimeField(null=True, blank=True)
+    # 批量执行的 id 和排队中还没有发送的消息(JSON)
+    batch = models.CharField(max_length=32, null=True, blank=True,
+                             db_index=True)
+    message = models.TextField(null=True, blank=True)
+
+    class Meta:
+        app_label = "apphome"
+        # consume 定时查找超时和排队中的 Job, 见 lib/jobs.sweep
+        index_together = [('status', 'deadline')]
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Longgeek <longgeek@gmail.com>
+
+"""比较 scheduler 消息的编码和压缩方式
+
+用仓库里的 Python 源文件拼出 files_write_container 消息, 和 web IDE
+保存文件时发送的内容一致, 分别统计每种组合的消息大小和编解码耗时.
+
+Usage:
+    export TELEGRAPH_POLE_PROFILE=bench
+    export DJANGO_SETTINGS_MODULE=telegraph_pole.settings
+    python -m benchmarks.bench_codec --files 1,10,50 --rounds 50
+"""
+
+import os
+import time
+import argparse
+
+import django
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def source_files():
+    """仓库里所有的 .py 文件内容, 按大小从大到小"""
+    contents = []
+    for dirpath, dirnames, filenames in os.walk(ROOT):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        for filename in filenames:
+            if filename.endswith('.py'):
+                path = os.path.join(dirpath, filename)
+                with open(path) as f:
+                    contents.append(f.read().decode('utf-8'))
+    return sorted(contents, key=len, reverse=True)
+
+
+def files_write_message(contents, count):
+    files = {}
+    for i in range(count):
+        path = u'/opt/python/django_project/module_%d.py' % i
+        files[path] = contents[i % len(contents)]
+    return {'id': '10',
+            'files': files,
+            'username': 'longgeek',
+            'message_type': 'files_write_container'}
+
+
+def measure(codec, message, content_type, content_encoding, rounds):
+    body, props = codec.encode(message, content_type, content_encoding,
+                               threshold=0)
+    start = time.time()
+    for i in range(rounds):
+        codec.encode(message, content_type, content_encoding, threshold=0)
+    encode_time = (time.time() - start) / rounds
+
+    start = time.time()
+    for i in range(rounds):
+        codec.decode(body, props['content_type'],
+                     props.get('content_encoding'))
+    decode_time = (time.time() - start) / rounds
+    return len(body), encode_time, decode_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--files', default='1,10,50',
+                        help='number of files per message')
+    parser.add_argument('--rounds', type=int, default=50)
+    args = parser.parse_args()
+
+    django.setup()
+    from telegraph_pole.lib import codec
+
+    contents = source_files()
+    combinations = [(t, e) for t in sorted(codec.SERIALIZERS)
+                    for e in [None] + sorted(codec.COMPRESSORS)]
+
+    for count in [int(n) for n in args.files.split(',')]:
+        message = files_write_message(contents, count)
+        print('\nfiles_write_container, %d files' % count)
+        print('%-24s %-6s %12s %12s %12s' % (
+            'content_type', 'enc', 'bytes', 'encode ms', 'decode ms'))
+        for content_type, content_encoding in combinations:
+            size, encode_time, decode_time = measure(
+                codec, message, content_type, content_encoding, args.rounds)
+            print('%-24s %-6s %12d %12.3f %12.3f' % (
+                content_type,
+                content_encoding or '-',
+                size,
+                encode_time * 1000,
+                decode_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Longgeek <longgeek@gmail.com>
+
+"""比较索引迁移(apphome 0005_indexes)前后的查询计划和耗时
+
+写入大量容器, 主机和镜像之后, 先回退到 0004_job_batch(没有索引),
+再迁移到 0005_indexes, 两次分别输出视图中常用查询的 EXPLAIN 和
+平均耗时. 数据库使用当前配置, bench 配置下为 SQLite, 也可以指向
+MySQL 测试库.
+
+Usage:
+    export TELEGRAPH_POLE_PROFILE=bench
+    export DJANGO_SETTINGS_MODULE=telegraph_pole.settings
+    python -m benchmarks.bench_queries --containers 200000 --rounds 50
+"""
+
+import time
+import argparse
+
+import django
+
+
+BEFORE = '0004_job_batch'
+AFTER = '0005_indexes'
+
+
+def seed(containers, users, hosts, images):
+    from django.core.management import call_command
+    from apphome.models import Host
+    from apphome.models import Image
+    from apphome.models import Container
+    from telegraph_pole.lib import convert
+
+    call_command('migrate', interactive=False, verbosity=0)
+    Container.objects.all().delete()
+    Host.objects.all().delete()
+    Image.objects.all().delete()
+
+    Image.objects.bulk_create([
+        Image(iid='%012x' % i, tag='%d.04' % (i % 20),
+              created='1417874473', repository='repo%d' % (i // 20),
+              virtual_size=192500000, os_type='ubuntu',
+              os_version='14.04')
+        for i in range(images)], batch_size=500)
+    Host.objects.bulk_create([
+        Host(ip='10.0.%d.%d' % (i // 250, i % 250), port='2375',
+             total_cpu=32, total_mem=128, total_sys_disk=2000,
+             total_volume=2000, total_bandwidth=1000)
+        for i in range(hosts)], batch_size=500)
+    image_ids = list(Image.objects.values_list('id', flat=True))
+    host_ids = list(Host.objects.values_list('id', flat=True))
+    Container.objects.bulk_create([
+        Container(cid='%064x' % i,
+                  flavor_id='1',
+                  image_id=image_ids[i % len(image_ids)],
+                  user_id='user%d' % (i % users),
+                  host_id=host_ids[i % len(host_ids)],
+                  name='/container_%d' % i,
+                  command='bash',
+                  created=convert.parse_created('1417874473'),
+                  status='Up 36 minutes',
+                  state='running',
+                  size=0,
+                  # 每 10 个有一个创建失败
+                  create_status=i % 10 != 0,
+                  container_name='container_%d' % i)
+        for i in range(containers)], batch_size=500)
+
+
+def queries(containers, users, hosts):
+    """(名字, 返回 QuerySet 的函数), 对应视图中的查询
+
+    只读取 0004 中就有的列, 迁移回退之后模型中新加的列不存在.
+    """
+    from apphome.models import Host
+    from apphome.models import Image
+    from apphome.models import Container
+
+    listed = Container.objects.filter(create_status=True).values(
+        'id', 'cid', 'name', 'status', 'user_id', 'host_id')
+    host_id = Host.objects.order_by('id').values_list(
+        'id', flat=True)[hosts // 2]
+    return [
+        ('containers by user',
+         lambda: listed.filter(user_id='user%d' % (users // 2))
+         .order_by('id')[:100]),
+        ('containers by host',
+         lambda: listed.filter(host_id=host_id).order_by('id')[:100]),
+        ('container by cid',
+         lambda: listed.filter(cid='%064x' % (containers // 2 + 1))),
+        ('image by repository/tag',
+         lambda: Image.objects.filter(repository='repo3', tag='3.04')
+         .values('id', 'iid', 'tag', 'repository')),
+        ('host by ip/port',
+         lambda: Host.objects.filter(ip='10.0.0.%d' % (hosts // 2 % 250),
+                                     port='2375').values('id', 'ip', 'port')),
+    ]
+
+
+def explain(queryset):
+    from django.db import connection
+
+    sql, params = queryset.query.sql_with_params()
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' \
+        else 'EXPLAIN '
+    cursor = connection.cursor()
+    cursor.execute(prefix + sql, params)
+    return [' '.join(str(column) for column in row)
+            for row in cursor.fetchall()]
+
+
+def measure(func, rounds):
+    start = time.time()
+    for i in range(rounds):
+        list(func())
+    return (time.time() - start) / rounds
+
+
+def run(label, migration, cases, rounds):
+    from django.core.management import call_command
+
+    call_command('migrate', 'apphome', migration, interactive=False,
+                 verbosity=0)
+    print('\n== %s (%s)' % (label, migration))
+    timings = {}
+    for name, func in cases:
+        timings[name] = measure(func, rounds)
+        print('\n%s: %.3f ms' % (name, timings[name] * 1000))
+        for line in explain(func()):
+            print('    ' + line)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--containers', type=int, default=200000)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--hosts', type=int, default=200)
+    parser.add_argument('--images', type=int, default=400)
+    parser.add_argument('--rounds', type=int, default=50)
+    args = parser.parse_args()
+
+    django.setup()
+    seed(args.containers, args.users, args.hosts, args.images)
+    cases = queries(args.containers, args.users, args.hosts)
+
+    before = run('without indexes', BEFORE, cases, args.rounds)
+    after = run('with indexes', AFTER, cases, args.rounds)
+
+    print('\n%-26s %12s %12s %8s' % ('query', 'before ms', 'after ms',
+                                     'speedup'))
+    for name, func in cases:
+        print('%-26s %12.3f %12.3f %7.1fx' % (
+            name, before[name] * 1000, after[name] * 1000,
+            before[name] / max(after[name], 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
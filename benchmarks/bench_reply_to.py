@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Longgeek <longgeek@gmail.com>
+
+"""比较独占回调队列和 direct reply-to 两种 RPC 模式
+
+使用进程内的 broker 替身(lib/memory_broker), 不需要 RabbitMQ.
+每种模式分别在 "每次 RPC 新建连接" 和 "连接池" 两种情况下跑一遍,
+输出每次 RPC 和 broker 的同步往返次数, 创建的队列数以及耗时.
+
+Usage:
+    export TELEGRAPH_POLE_PROFILE=bench
+    export DJANGO_SETTINGS_MODULE=telegraph_pole.settings
+    python -m benchmarks.bench_reply_to --rpcs 1000 --rtt 0.5
+"""
+
+import time
+import argparse
+import threading
+import simplejson
+
+import django
+
+from pika import spec
+
+
+MODES = (
+    # (名字, 连接池大小, direct reply-to)
+    ('per-call exclusive', 0, False),
+    ('per-call direct', 0, True),
+    ('pooled exclusive', 4, False),
+    ('pooled direct', 4, True),
+)
+
+
+def start_responder(memory_broker, broker):
+    """scheduler 替身: 消费 docker_scheduler 队列, 原样返回空结果"""
+    conn = memory_broker.BlockingConnection(broker=broker)
+    channel = conn.channel()
+    channel.queue_declare(queue='docker_scheduler')
+    reply = simplejson.dumps([0, '', {}])
+
+    def on_request(ch, method, props, body):
+        ch.basic_publish(exchange='',
+                         routing_key=props.reply_to,
+                         properties=spec.BasicProperties(
+                             correlation_id=props.correlation_id),
+                         body=reply)
+
+    channel.basic_consume(on_request, queue='docker_scheduler', no_ack=True)
+
+    def run():
+        while conn.is_open:
+            conn.process_data_events(time_limit=0.1)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return conn, thread
+
+
+def run_mode(mq, codec, broker, rpcs, pool_size, direct):
+    mq.DIRECT_REPLY_TO = direct
+    pool = mq.Pool(size=pool_size)
+    message = codec.encode({'id': 1, 'message_type': 'top_container'})
+
+    broker.stats.clear()
+    start = time.time()
+    for i in range(rpcs):
+        pool.request(message, 10)
+    elapsed = time.time() - start
+    for call in pool.idle:
+        call.close()
+
+    stats = broker.stats
+    # 只统计客户端一侧: responder 的回复也会计入 publish
+    return {'elapsed': elapsed,
+            'round_trips': stats['round_trips'] / float(rpcs),
+            'queues': stats['queues_created'],
+            'messages': (stats['publish'] + stats['deliver']) / float(rpcs)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rpcs', type=int, default=1000)
+    parser.add_argument('--rtt', type=float, default=0.5,
+                        help='simulated broker round trip in ms')
+    args = parser.parse_args()
+
+    django.setup()
+    from telegraph_pole.lib import mq
+    from telegraph_pole.lib import codec
+    from telegraph_pole.lib import memory_broker
+
+    mq.BROKER = 'memory'
+    broker = memory_broker.Broker(rtt=args.rtt / 1000.0)
+    memory_broker._broker = broker
+    responder, thread = start_responder(memory_broker, broker)
+
+    print('%d RPCs, simulated rtt %.2f ms\n' % (args.rpcs, args.rtt))
+    print('%-20s %10s %10s %10s %10s %10s' % (
+        'mode', 'sync rt', 'msgs', 'queues', 'ms/rpc', 'rpc/s'))
+    for name, pool_size, direct in MODES:
+        r = run_mode(mq, codec, broker, args.rpcs, pool_size, direct)
+        print('%-20s %10.2f %10.2f %10d %10.3f %10.0f' % (
+            name,
+            r['round_trips'],
+            r['messages'],
+            r['queues'],
+            r['elapsed'] * 1000 / args.rpcs,
+            args.rpcs / r['elapsed']))
+    responder.close()
+    thread.join()
+
+
+if __name__ == '__main__':
+    main()
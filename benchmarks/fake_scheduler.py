@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Longgeek <longgeek@gmail.com>
+
+"""docker_scheduler 替身
+
+在进程内的 broker(lib/memory_broker) 上消费 docker_scheduler 队列,
+对 views_containers.py 用到的每一种 message_type 返回和真实 scheduler
+结构相同的结果. 处理时间和返回内容的大小可以配置.
+"""
+
+import io
+import time
+import random
+import fnmatch
+import tarfile
+import hashlib
+import threading
+
+from pika import spec
+
+from telegraph_pole.lib import codec
+from telegraph_pole.lib import patch
+from telegraph_pole.lib import memory_broker
+
+
+SOURCE_LINE = u'    return render(request, "index.html", {"items": items})\n'
+
+
+class FakeScheduler(object):
+    """docker_scheduler 替身
+
+    Params:
+        broker:    Broker; 默认为当前进程的 broker
+        latency:   float;  每个请求的处理时间(秒)
+        latencies: dict;   按 message_type 覆盖处理时间
+        jitter:    float;  处理时间随机波动的比例, 0.2 表示 ±20%
+        payload:   int;    文件内容等返回数据的大小(字节)
+        negotiate: bool;   是否按请求的 accept 头选择返回的编码
+        chunks:    int;    stream 请求在最终结果之前返回的输出段数
+    """
+
+    def __init__(self, broker=None, latency=0.005, latencies=None,
+                 jitter=0.2, payload=1024, negotiate=False, chunks=4):
+        self.broker = broker or memory_broker.get_broker()
+        self.latency = latency
+        self.latencies = latencies or {}
+        self.jitter = jitter
+        self.payload = payload
+        self.negotiate = negotiate
+        self.chunks = chunks
+        self.conn = None
+        self.channel = None
+        self.handled = 0
+        # 上传的文件: path -> 内容, 下载时优先返回
+        self.files = {}
+        self.uploads = {}
+
+    def start(self):
+        self.conn = memory_broker.BlockingConnection(broker=self.broker)
+        self.channel = self.conn.channel()
+        self.channel.queue_declare(queue='docker_scheduler')
+        self.channel.basic_consume(self.on_request,
+                                   queue='docker_scheduler',
+                                   no_ack=True)
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        if self.conn is not None:
+            self.conn.close()
+
+    def _run(self):
+        while self.conn.is_open:
+            self.conn.process_data_events(time_limit=None)
+
+    def on_request(self, ch, method, props, body):
+        message = codec.decode_request(props, body)
+        delay = self.latencies.get(message.get('message_type'), self.latency)
+        if self.jitter:
+            delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        timer = threading.Timer(delay, self.reply, (props, message))
+        timer.daemon = True
+        timer.start()
+
+    def publish_chunk(self, props, data, kind='chunk'):
+        """流式返回的中间消息, kind 为 chunk(原始字节)或者 meta"""
+        if kind == 'meta':
+            data, properties = codec.encode(data)
+        else:
+            properties = {'content_type': codec.OCTET_STREAM}
+        properties['headers'] = {'stream': kind}
+        self.channel.basic_publish(
+            exchange='',
+            routing_key=props.reply_to,
+            properties=spec.BasicProperties(
+                correlation_id=props.correlation_id, **properties),
+            body=data)
+
+    def stream_output(self, props, message):
+        output = self.content().encode('utf-8')
+        size = len(output) // self.chunks + 1
+        for i in range(self.chunks):
+            self.publish_chunk(props, output[i * size:(i + 1) * size])
+
+    def stream_files_download_container(self, props, message):
+        data = self.files.get(message['path'])
+        if data is None:
+            data = self.content().encode('utf-8')
+        offset = message.get('offset') or 0
+        if offset < 0:
+            offset = max(len(data) + offset, 0)
+        length = message.get('length')
+        end = len(data) if length is None else min(offset + length,
+                                                   len(data))
+        self.publish_chunk(props, {'size': len(data), 'offset': offset},
+                           'meta')
+        chunk_size = message.get('chunk_size') or 65536
+        for start in range(offset, end, chunk_size):
+            self.publish_chunk(props, data[start:min(start + chunk_size,
+                                                     end)])
+
+    def stream_archive_export_container(self, props, message):
+        prefix = message['path'].rstrip('/') + '/'
+        files = dict((path, data) for path, data in self.files.items()
+                     if path.startswith(prefix))
+        files.setdefault(prefix + 'README', self.content().encode('utf-8'))
+        buf = io.BytesIO()
+        archive = tarfile.open(fileobj=buf,
+                               mode='w:gz' if message.get('gzip') else 'w')
+        for path, data in sorted(files.items()):
+            info = tarfile.TarInfo(path[len(prefix):])
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+        archive.close()
+        data = buf.getvalue()
+        chunk_size = message.get('chunk_size') or 65536
+        for start in range(0, len(data), chunk_size):
+            self.publish_chunk(props, data[start:start + chunk_size])
+
+    def reply(self, props, message):
+        if message.get('stream'):
+            streamer = getattr(self, 'stream_' + message['message_type'],
+                               self.stream_output)
+            streamer(props, message)
+        self.handled += 1
+        handler = getattr(self, message.get('message_type', ''), None)
+        if handler is None:
+            result = [1, 'Error: Unknown message_type!', None]
+        else:
+            result = [0, '', handler(message)]
+
+        content_type = content_encoding = None
+        if self.negotiate and props.headers:
+            accept = props.headers.get('accept', '')
+            content_type = accept.split(',')[0].strip() or None
+            content_encoding = props.headers.get('accept-encoding', '')
+            content_encoding = content_encoding.split(',')[0].strip() or None
+        body, properties = codec.encode(result, content_type,
+                                        content_encoding)
+        properties.pop('headers', None)
+        self.channel.basic_publish(
+            exchange='',
+            routing_key=props.reply_to,
+            properties=spec.BasicProperties(
+                correlation_id=props.correlation_id, **properties),
+            body=body)
+
+    # 返回数据
+
+    def cid(self, message):
+        return hashlib.sha256(str(message.get('id'))).hexdigest()
+
+    def content(self):
+        return (SOURCE_LINE * (self.payload // len(SOURCE_LINE) + 1))[
+            :self.payload]
+
+    def base(self, message):
+        return {'id': message.get('id'),
+                'cid': self.cid(message),
+                'host': '192.168.8.8',
+                'username': message.get('username')}
+
+    def create_container(self, message):
+        result = dict(message)
+        result.pop('message_type', None)
+        result.update({'id': random.randint(1, 1 << 30),
+                       'cid': self.cid(message),
+                       'size': '0',
+                       'status': 'Up 1 seconds',
+                       'created': str(int(time.time()))})
+        return result
+
+    def _lifecycle(self, message):
+        return {'cid': self.cid(message)}
+
+    delete_container = _lifecycle
+    stop_container = _lifecycle
+    start_container = _lifecycle
+    restart_container = _lifecycle
+    pause_container = _lifecycle
+    unpause_container = _lifecycle
+
+    def exec_container(self, message):
+        return {'cid': self.cid(message), 'exit_code': 0}
+
+    def inspect_container(self, message):
+        return {'container_info': {
+            'Id': self.cid(message),
+            'Name': '/determined_lalande',
+            'State': {'Running': True, 'Paused': False, 'ExitCode': 0},
+            'Config': {'Hostname': self.cid(message)[:12],
+                       'Cmd': ['bash'],
+                       'Env': ['X=%s' % self.content()]},
+            'NetworkSettings': {'IPAddress': '172.17.0.2'},
+        }}
+
+    def top_container(self, message):
+        count = max(self.payload // 64, 1)
+        return {'id': message.get('id'),
+                'cid': self.cid(message),
+                'host': '192.168.8.8',
+                'port': '2375',
+                'message_type': 'top_container',
+                'titles': ['USER', 'PID', '%CPU', '%MEM', 'VSZ', 'RSS',
+                           'TTY', 'STAT', 'START', 'TIME', 'COMMAND'],
+                'processes': [['root', str(20000 + i), '0.0', '0.1',
+                               '18060', '1864', 'pts/4', 'S', '10:06',
+                               '0:00', 'bash'] for i in range(count)]}
+
+    def console_container(self, message):
+        result = self.base(message)
+        result['console'] = dict(
+            (command, {'url': 'http://%s.console.example.com' %
+                       self.cid(message)[:24],
+                       'private_port': 4301,
+                       'public_port': 49187})
+            for command in message.get('command') or [])
+        return result
+
+    def files_write_container(self, message):
+        result = self.base(message)
+        files = message.get('files') or {}
+        if message.get('mode') != 'patch':
+            for path, content in files.items():
+                self.files[path] = content.encode('utf-8')
+            result['files'] = files
+            return result
+
+        result['files'] = {}
+        for path, value in files.items():
+            current = self.files.get(path)
+            if current is None:
+                current = self.content().encode('utf-8')
+            if patch.content_hash(current) != value['base_hash']:
+                result['files'][path] = {'status': 'conflict',
+                                         'hash': patch.content_hash(current)}
+                continue
+            content = patch.apply(current.decode('utf-8'), value['patch'])
+            self.files[path] = content.encode('utf-8')
+            result['files'][path] = {'status': 'written',
+                                     'hash': patch.content_hash(content)}
+        return result
+
+    def files_download_container(self, message):
+        return self.base(message)
+
+    def receive(self, message):
+        """保存上传的一段, 最后一段返回完整的内容"""
+        upload = message['upload']
+        if message.get('abort'):
+            self.uploads.pop(upload, None)
+            return None
+        data = self.uploads.setdefault(upload, bytearray())
+        data[message['offset']:] = message['data']
+        if message.get('final'):
+            return str(self.uploads.pop(upload))
+
+    def files_upload_container(self, message):
+        data = self.receive(message)
+        if data is not None:
+            self.files[message['path']] = data
+        result = self.base(message)
+        result.update({'path': message['path'],
+                       'size': message['offset'] + len(message['data'])})
+        return result
+
+    def archive_export_container(self, message):
+        return self.base(message)
+
+    def archive_import_container(self, message):
+        data = self.receive(message)
+        result = self.base(message)
+        result.update({'path': message['path'], 'files': 0})
+        if data is None:
+            return result
+        prefix = message['path'].rstrip('/') + '/'
+        archive = tarfile.open(fileobj=io.BytesIO(data),
+                               mode='r:gz' if message.get('gzip') else 'r')
+        for info in archive:
+            if info.isfile():
+                self.files[prefix + info.name] = \
+                    archive.extractfile(info).read()
+                result['files'] += 1
+        return result
+
+    def files_read_container(self, message):
+        result = self.base(message)
+        known = message.get('hashes') or {}
+        result.update({'files': {}, 'hashes': {}, 'not_modified': []})
+        for path in message.get('files') or []:
+            content = self.files.get(path)
+            if content is None:
+                content = self.content().encode('utf-8')
+            digest = patch.content_hash(content)
+            result['hashes'][path] = digest
+            if known.get(path) == digest:
+                result['not_modified'].append(path)
+            else:
+                result['files'][path] = content.decode('utf-8')
+        return result
+
+    def files_list_container(self, message):
+        count = max(self.payload // 48, 1)
+        depth = message.get('depth')
+        ignore = message.get('ignore') or []
+        since = message.get('since')
+        limit = message.get('limit')
+        offset = int(message.get('cursor') or 0)
+        now = time.time()
+
+        # (相对路径, 修改时间), 两层目录, 每层 count 个文件
+        entries = []
+        for i in range(count):
+            entries.append(('file_%d.py' % i, now - i))
+            entries.append(('lib_%d/mod_%d.py' % (i % 4, i), now - i))
+        entries = [(name, mtime) for name, mtime in entries
+                   if not any(fnmatch.fnmatch(part, pattern)
+                              for pattern in ignore
+                              for part in name.split('/') + [name])]
+        if since is not None:
+            entries = [(name, mtime) for name, mtime in entries
+                       if mtime > since]
+        entries.sort()
+
+        result = {'dirs': {}}
+        if limit:
+            result['next'] = str(offset + limit) \
+                if offset + limit < len(entries) else None
+            entries = entries[offset:offset + limit]
+        for path in message.get('dirs') or []:
+            root = {'type': 'directory', 'name': path, 'contents': []}
+            dirs = {'': root}
+            files = 0
+            for name, mtime in entries:
+                parts = name.split('/')
+                parent = ''
+                for level, part in enumerate(parts[:-1]):
+                    key = parent + part + '/'
+                    if key not in dirs:
+                        dirs[key] = {'type': 'directory', 'name': part,
+                                     'contents': []}
+                        dirs[parent]['contents'].append(dirs[key])
+                    parent = key
+                if depth is not None and len(parts) > depth:
+                    dirs[parent]['truncated'] = True
+                    dirs[parent]['contents'] = []
+                    continue
+                dirs[parent]['contents'].append(
+                    {'type': 'file', 'name': parts[-1], 'mtime': mtime})
+                files += 1
+            result['dirs'][path] = [
+                root, {'type': 'report', 'directories': len(dirs) - 1,
+                       'files': files}]
+        return result
+
+    def files_delete_container(self, message):
+        return {'files': dict((path, 'deleted')
+                              for path in message.get('files') or [])}
+
+    def dirs_create_container(self, message):
+        return {'dirs': dict((path, 'created')
+                             for path in message.get('dirs') or [])}
+
+    def dirs_delete_container(self, message):
+        return {'dirs': dict((path, 'deleted')
+                             for path in message.get('dirs') or [])}
+
+    def host_exec_container(self, message):
+        result = self.base(message)
+        result['commands'] = dict((command, self.content())
+                                  for command in message.get('commands')
+                                  or [])
+        return result
+
+    def host_fdcheck_container(self, message):
+        result = self.base(message)
+        result['fds'] = dict((fd.get('name'), True)
+                             for fd in message.get('fds') or [])
+        return result
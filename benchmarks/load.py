@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Longgeek <longgeek@gmail.com>
+
+"""API 请求链路压测
+
+在一个进程里跑完整的请求链路: Django 的 URL, 中间件和视图, lib/mq,
+进程内的 broker 以及 scheduler 替身, 数据库使用 SQLite(bench 配置).
+不需要 RabbitMQ, docker_scheduler, Redis 和 MySQL.
+
+每个接口分别用 --concurrency 个并发客户端发送 --requests 个请求,
+输出 p50/p99 延迟和每秒请求数. 默认和线上一样使用 gevent.
+
+Usage:
+    python -m benchmarks.load --concurrency 50 --requests 1000
+    python -m benchmarks.load --endpoints top,inspect --latency 20
+"""
+
+import os
+import sys
+import time
+import argparse
+import itertools
+
+
+ENDPOINT_NAMES = ('list', 'detail', 'inspect', 'top', 'files_list',
+                  'files_read', 'files_write', 'exec', 'stop', 'start',
+                  'restart')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=500,
+                        help='requests per endpoint')
+    parser.add_argument('--endpoints', default=','.join(ENDPOINT_NAMES))
+    parser.add_argument('--containers', type=int, default=1000,
+                        help='containers seeded into the database')
+    parser.add_argument('--latency', type=float, default=5,
+                        help='scheduler processing time in ms')
+    parser.add_argument('--rtt', type=float, default=0.2,
+                        help='simulated broker round trip in ms')
+    parser.add_argument('--payload', type=int, default=4096,
+                        help='scheduler payload size in bytes')
+    parser.add_argument('--negotiate', action='store_true',
+                        help='let the scheduler reply in the accepted codec')
+    parser.add_argument('--no-gevent', action='store_true',
+                        help='use OS threads and the blocking transport')
+    return parser.parse_args()
+
+
+def seed(containers, users):
+    """初始化 SQLite 数据库, 写入镜像, 主机和容器"""
+    from django.core.management import call_command
+    from apphome.models import Host
+    from apphome.models import Image
+    from apphome.models import Container
+    from telegraph_pole.lib import convert
+
+    call_command('migrate', interactive=False, verbosity=0)
+    Container.objects.all().delete()
+
+    image = Image.objects.create(iid='0a8fb585b', tag='14.04',
+                                 created='1417874473',
+                                 repository='ubuntu',
+                                 virtual_size=192500000,
+                                 os_type='ubuntu', os_version='14.04')
+    host = Host.objects.create(ip='192.168.8.8', port='2375',
+                               total_cpu=32, total_mem=128,
+                               total_sys_disk=2000, total_volume=2000,
+                               total_bandwidth=1000)
+    Container.objects.bulk_create([
+        Container(cid='%064x' % i,
+                  flavor_id='1',
+                  image=image,
+                  user_id='user%d' % (i % users),
+                  host=host,
+                  name='/container_%d' % i,
+                  command='bash',
+                  created=convert.parse_created('1417874473'),
+                  status='Up 36 minutes',
+                  state='running',
+                  size=0,
+                  create_status=True,
+                  container_name='container_%d' % i)
+        for i in range(containers)], batch_size=500)
+    return list(Container.objects.values_list('id', 'user_id'))
+
+
+def endpoints(payload):
+    import simplejson
+
+    content = 'x' * payload
+
+    def post(client, path, data):
+        return client.generic('POST', path, simplejson.dumps(data),
+                              content_type='application/json')
+
+    def get(client, path, data):
+        return client.generic('GET', path, simplejson.dumps(data),
+                              content_type='application/json')
+
+    return {
+        'list': lambda c, id, user: c.get('/v1/containers/',
+                                          {'user_id': user}),
+        'detail': lambda c, id, user: c.get('/v1/containers/%d/' % id),
+        'inspect': lambda c, id, user: c.get(
+            '/v1/containers/%d/inspect' % id),
+        'top': lambda c, id, user: c.get('/v1/containers/%d/top' % id),
+        'files_list': lambda c, id, user: get(
+            c, '/v1/containers/%d/files/list' % id, {'dirs': ['/opt']}),
+        'files_read': lambda c, id, user: post(
+            c, '/v1/containers/%d/files/read' % id,
+            {'files': ['/opt/urls.py', '/opt/views.py'], 'username': user}),
+        'files_write': lambda c, id, user: post(
+            c, '/v1/containers/%d/files/write' % id,
+            {'files': {'/opt/urls.py': content}, 'username': user}),
+        'exec': lambda c, id, user: post(
+            c, '/v1/containers/%d/exec' % id,
+            {'command': ['date'], 'wait': True}),
+        'stop': lambda c, id, user: post(
+            c, '/v1/containers/%d/stop' % id, {}),
+        'start': lambda c, id, user: post(
+            c, '/v1/containers/%d/start' % id, {'username': user}),
+        'restart': lambda c, id, user: post(
+            c, '/v1/containers/%d/restart' % id, {}),
+    }
+
+
+def percentile(values, p):
+    return values[int(round(p * (len(values) - 1)))]
+
+
+def run(call, rows, total, concurrency):
+    """并发发送请求, 返回 (延迟列表, 错误数, 总耗时)"""
+    import threading
+    from django.test import Client
+
+    counter = itertools.count()
+    latencies = []
+    errors = []
+
+    def worker():
+        client = Client()
+        while True:
+            i = next(counter)
+            if i >= total:
+                return
+            id, user = rows[i % len(rows)]
+            start = time.time()
+            response = call(client, id, user)
+            latencies.append(time.time() - start)
+            if response.status_code >= 400:
+                errors.append(response.status_code)
+
+    start = time.time()
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(latencies), errors, time.time() - start
+
+
+def main():
+    args = parse_args()
+    if not args.no_gevent:
+        from gevent import monkey
+        monkey.patch_all()
+
+    os.environ.setdefault('TELEGRAPH_POLE_PROFILE', 'bench')
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'telegraph_pole.settings')
+
+    import django
+    django.setup()
+
+    from telegraph_pole.lib import mq
+    from telegraph_pole.lib import memory_broker
+    from benchmarks.fake_scheduler import FakeScheduler
+
+    if mq.BROKER != 'memory':
+        sys.exit('benchmarks.load needs RABBITMQ_BROKER = "memory"')
+
+    memory_broker._broker = memory_broker.Broker(rtt=args.rtt / 1000.0)
+    scheduler = FakeScheduler(latency=args.latency / 1000.0,
+                              payload=args.payload,
+                              negotiate=args.negotiate).start()
+    rows = seed(args.containers, max(args.containers // 20, 1))
+    calls = endpoints(args.payload)
+
+    print('%s transport, concurrency %d, %d requests/endpoint, '
+          'scheduler latency %.1f ms, payload %d B\n' % (
+              type(mq.get_transport()).__name__, args.concurrency,
+              args.requests, args.latency, args.payload))
+    print('%-12s %8s %8s %10s %10s %10s' % (
+        'endpoint', 'requests', 'errors', 'p50 ms', 'p99 ms', 'req/s'))
+    for name in args.endpoints.split(','):
+        latencies, errors, elapsed = run(calls[name], rows, args.requests,
+                                         args.concurrency)
+        print('%-12s %8d %8d %10.2f %10.2f %10.0f' % (
+            name,
+            len(latencies),
+            len(errors),
+            percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.99) * 1000,
+            len(latencies) / elapsed))
+    scheduler.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -6,10 +6,12 @@ from django.conf.urls import patterns
 from django.conf.urls import include
 from django.conf.urls import url
 
+from telegraph_pole.controller.v1 import urls_jobs
 from telegraph_pole.controller.v1 import urls_hosts
 from telegraph_pole.controller.v1 import urls_images
 from telegraph_pole.controller.v1 import urls_flavors
 from telegraph_pole.controller.v1 import urls_containers
+from telegraph_pole.controller.v1.views import views_metrics
 
 urlpatterns = patterns(
     '',
@@ -17,4 +19,6 @@ urlpatterns = patterns(
     url(r'^images/', include(urls_images)),
     url(r'^flavors/', include(urls_flavors)),
     url(r'^containers/', include(urls_containers)),
+    url(r'^jobs/', include(urls_jobs)),
+    url(r'^metrics$', views_metrics.MetricsView.as_view()),
 )
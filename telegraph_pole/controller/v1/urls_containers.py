@@ -5,6 +5,7 @@
 from django.conf.urls import patterns
 from django.conf.urls import url
 
+from views import views_events
 from views import views_containers as views
 
 urlpatterns = patterns(
@@ -15,6 +16,18 @@ urlpatterns = patterns(
     url(r'^create$',
         views.ContainerCreateView.as_view()),
 
+    url(r'^events$',
+        views_events.ContainerEventsView.as_view()),
+
+    url(r'^exec$',
+        views.ContainerExecBatchView.as_view()),
+
+    url(r'^exec/(?P<batch>[0-9a-f]{32})$',
+        views.ContainerExecBatchDetailView.as_view()),
+
+    url(r'^bulk/(?P<action>stop|start|restart|pause|unpause|delete)$',
+        views.ContainerBulkView.as_view()),
+
     url(r'^(?P<id>[0-9]+)/$',
         views.ContainerDetailView.as_view()),
 
@@ -60,6 +73,12 @@ urlpatterns = patterns(
     url(r'^(?P<id>[0-9]+)/files/read$',
         views.ContainerFilesReadView.as_view()),
 
+    url(r'^(?P<id>[0-9]+)/files/content$',
+        views.ContainerFilesContentView.as_view()),
+
+    url(r'^(?P<id>[0-9]+)/archive$',
+        views.ContainerArchiveView.as_view()),
+
     url(r'^(?P<id>[0-9]+)/files/delete$',
         views.ContainerFilesDeleteView.as_view()),
 
@@ -0,0 +1,14 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Longgeek <longgeek@gmail.com>
+
+from django.conf.urls import patterns
+from django.conf.urls import url
+
+from views import views_jobs as views
+
+urlpatterns = patterns(
+    '',
+    url(r'^(?P<id>[0-9]+)/?$',
+        views.JobDetailView.as_view()),
+)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Longgeek <longgeek@gmail.com>
+
+"""列表接口的 url 参数过滤
+
+每个列表视图用 FilterSpec 声明可以过滤的字段和允许的查询方式, 只
+包含有索引的列, 其他参数一律返回 400, 客户端不能触发全表扫描或者
+跨表的 join(例如 ?host__image__repository=ubuntu).
+
+    ?user_id=2                      exact
+    ?state__in=running,paused       in, 逗号分隔, 最多 IN_MAX 个
+    ?created__gte=1417874473        gte / lte
+    ?ordering=-created              排序, 只能用 FilterSpec 中声明的字段
+
+所有条件编译为一次 filter(**kwargs), 和 create_status 等固定条件
+一起生成一条 SQL.
+
+组合索引中后面的列(例如 Image 的 (repository, tag) 中的 tag)用
+requires 声明, 只能和前面的列一起使用.
+"""
+
+from pagination import PAGE_PARAMS
+
+
+LOOKUPS = ('exact', 'in', 'gte', 'lte')
+
+# in 最多的值个数
+IN_MAX = 100
+
+# 不作为过滤条件的 url 参数
+RESERVED = PAGE_PARAMS + ('fields', 'ordering')
+
+
+class FilterError(ValueError):
+    """url 参数不允许或者值不正确"""
+
+
+def integer(value):
+    return int(value)
+
+
+def choice(choices):
+    """只能是 choices(模型字段的 choices)中的值"""
+    values = set(key for key, label in choices)
+
+    def parse(value):
+        if value not in values:
+            raise ValueError(value)
+        return value
+    return parse
+
+
+class Field(object):
+    """一个可以过滤的字段
+
+    Params:
+        lookups:  允许的查询方式, LOOKUPS 中的几个
+        parse:    url 参数转换为数据库中的值, 无法转换抛出 ValueError
+        source:   模型中的字段名, 默认和参数名相同
+        requires: 只能和这个参数一起使用, 用于组合索引中后面的列
+    """
+
+    def __init__(self, lookups=('exact', 'in'), parse=None, source=None,
+                 requires=None):
+        self.lookups = lookups
+        self.parse = parse
+        self.source = source
+        self.requires = requires
+
+    def convert(self, name, value):
+        if self.parse is None:
+            return value
+        try:
+            return self.parse(value)
+        except (ValueError, TypeError):
+            raise FilterError('Error: Invalid %s: %s' % (name, value))
+
+
+class FilterSpec(object):
+    """一个列表接口可以使用的过滤条件和排序
+
+    Params:
+        fields:   dict; 参数名 -> Field
+        ordering: tuple; 可以排序的参数名
+    """
+
+    def __init__(self, fields, ordering=('id',)):
+        self.fields = fields
+        self.ordering = ordering
+
+    def compile(self, params):
+        """把 url 参数编译为 filter 的 kwargs 和 order_by 的参数
+
+        Params:
+            params: request.GET
+
+        Return:
+            (kwargs, ordering), 没有排序参数时 ordering 为空
+
+        有不允许的参数或者值不正确抛出 FilterError.
+        """
+        kwargs = {}
+        names = set()
+        for key, value in params.items():
+            if key in RESERVED:
+                continue
+            name, _, lookup = key.partition('__')
+            lookup = lookup or 'exact'
+            field = self.fields.get(name)
+            if field is None or lookup not in field.lookups:
+                raise FilterError('Error: Can not filter by %s!' % key)
+            if lookup == 'in':
+                values = [v for v in value.split(',') if v]
+                if not values or len(values) > IN_MAX:
+                    raise FilterError('Error: %s takes 1 to %d values!' %
+                                      (key, IN_MAX))
+                value = [field.convert(name, v) for v in values]
+            else:
+                value = field.convert(name, value)
+            source = field.source or name
+            kwargs[source if lookup == 'exact' else
+                   '%s__%s' % (source, lookup)] = value
+            names.add(name)
+
+        for name in names:
+            requires = self.fields[name].requires
+            if requires and requires not in names:
+                raise FilterError('Error: %s can only be used with %s!' %
+                                  (name, requires))
+
+        return kwargs, self.compile_ordering(params)
+
+    def compile_ordering(self, params):
+        value = params.get('ordering')
+        if not value:
+            return []
+        ordering = []
+        for item in value.split(','):
+            name = item[1:] if item.startswith('-') else item
+            if name not in self.ordering:
+                raise FilterError('Error: Can not order by %s!' % name)
+            field = self.fields.get(name)
+            source = field.source if field and field.source else name
+            ordering.append(item[:-len(name)] + source)
+        # 分页按 id 进行, 不能同时使用其他排序
+        if 'limit' in params and ordering != ['id']:
+            raise FilterError('Error: ordering can not be used with limit, '
+                              'pages are ordered by id!')
+        # 值相同时按 id, 保证顺序固定
+        if ordering[-1].lstrip('-') != 'id':
+            ordering.append('id')
+        return ordering
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Longgeek <longgeek@gmail.com>
+
+"""列表接口的 keyset 分页
+
+按 id 排序, cursor 记录上一页边界的 id, 下一页用 id > cursor 查询,
+走主键索引, 翻到多深都只读取 limit + 1 行, 不像 OFFSET 那样越往后
+越慢. 没有 limit 参数时不分页, 和之前一样返回所有结果.
+
+下一页和上一页的地址放在 Link 头中(RFC 5988), 返回的内容仍然是
+原来的列表, 旧的客户端不受影响:
+
+    Link: <http://host/v1/containers/?limit=100&cursor=PjEyMzQ>; rel="next",
+          <http://host/v1/containers/?limit=100&cursor=PDEyMzU>; rel="prev"
+"""
+
+import base64
+import urllib
+
+from telegraph_pole import settings
+
+
+# 一页最多的条目数, 更大的 limit 按这个值返回
+PAGE_MAX = getattr(settings, 'LIST_PAGE_MAX', 1000)
+
+# 分页用的 url 参数, 不作为过滤条件
+PAGE_PARAMS = ('limit', 'cursor')
+
+
+class PageError(ValueError):
+    """limit 或者 cursor 不正确"""
+
+
+def encode_cursor(direction, id):
+    """direction 为 '>'(下一页) 或者 '<'(上一页)"""
+    return base64.urlsafe_b64encode('%s%d' % (direction, id)).rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        value = base64.urlsafe_b64decode(
+            str(cursor) + '=' * (-len(cursor) % 4))
+        direction, id = value[0], int(value[1:])
+    except (TypeError, ValueError, IndexError):
+        raise PageError('Error: Invalid cursor!')
+    if direction not in '<>':
+        raise PageError('Error: Invalid cursor!')
+    return direction, id
+
+
+def _link(request, limit, cursor, rel):
+    query = request.GET.copy()
+    query['limit'] = limit
+    query['cursor'] = cursor
+    return '<%s?%s>; rel="%s"' % (
+        request.build_absolute_uri(request.path),
+        urllib.urlencode(sorted(query.items())), rel)
+
+
+def paginate(request, queryset):
+    """按 id 分页
+
+    Params:
+        request:  当前请求, 读取 limit 和 cursor
+        queryset: 过滤之后的 QuerySet
+
+    Return:
+        (rows, headers), 没有 limit 时 rows 为原来的 queryset,
+        headers 为空
+
+    limit 或者 cursor 不正确抛出 PageError.
+    """
+    if 'limit' not in request.GET:
+        return queryset, {}
+    try:
+        limit = int(request.GET['limit'])
+    except ValueError:
+        raise PageError('Error: Invalid limit!')
+    if limit <= 0:
+        raise PageError('Error: limit must be greater than 0!')
+    limit = min(limit, PAGE_MAX)
+
+    cursor = request.GET.get('cursor')
+    direction, boundary = decode_cursor(cursor) if cursor else ('>', None)
+    if direction == '>':
+        page = queryset.order_by('id')
+        if boundary is not None:
+            page = page.filter(id__gt=boundary)
+    else:
+        page = queryset.order_by('-id').filter(id__lt=boundary)
+
+    # 多读一行判断这个方向上还有没有下一页
+    rows = list(page[:limit + 1])
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == '<':
+        rows.reverse()
+    if not rows:
+        return rows, {}
+
+    first, last = rows[0].id, rows[-1].id
+    if direction == '>':
+        has_next = more
+        has_prev = boundary is not None and \
+            queryset.filter(id__lt=first).exists()
+    else:
+        has_prev = more
+        has_next = queryset.filter(id__gt=last).exists()
+
+    links = []
+    if has_next:
+        links.append(_link(request, limit, encode_cursor('>', last), 'next'))
+    if has_prev:
+        links.append(_link(request, limit, encode_cursor('<', first), 'prev'))
+    return rows, {'Link': ', '.join(links)} if links else {}
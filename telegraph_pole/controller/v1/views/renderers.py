@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Longgeek <longgeek@gmail.com>
+
+import simplejson
+
+from rest_framework.renderers import BaseRenderer
+from rest_framework.settings import api_settings
+
+
+class EventStreamRenderer(BaseRenderer):
+    """让 Accept: text/event-stream 通过内容协商, 事件流本身由视图返回"""
+    media_type = 'text/event-stream'
+    format = 'sse'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return simplejson.dumps(data)
+
+
+# 支持 SSE 的视图使用的 renderer_classes
+STREAM_RENDERERS = tuple(api_settings.DEFAULT_RENDERER_CLASSES) + (
+    EventStreamRenderer,)
+
+
+def sse(event, data, id=None):
+    """一个 SSE 事件, data 中的换行拆成多个 data 行
+
+    id 为客户端断线重连时 Last-Event-ID 的值.
+    """
+    lines = [] if id is None else ['id: %s' % id]
+    lines.append('event: %s' % event)
+    lines.extend('data: %s' % line for line in data.split('\n'))
+    return '\n'.join(lines) + '\n\n'
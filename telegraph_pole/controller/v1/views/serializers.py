@@ -1,10 +1,74 @@
+# -*- coding: utf-8 -*-
+import simplejson
+
 from apphome.models import Host
 from apphome.models import Image
 from apphome.models import Container
+from apphome.models import Job
 from rest_framework import serializers
+from django.core.exceptions import ValidationError
+from telegraph_pole.lib import convert
+
+
+class CreatedField(serializers.WritableField):
+    """datetime 列, 输入输出仍然是时间戳字符串, 例如 "1417874473" """
+
+    def to_native(self, value):
+        return convert.format_created(value)
+
+    def from_native(self, value):
+        try:
+            return convert.parse_created(value)
+        except (ValueError, TypeError):
+            raise ValidationError('Enter a timestamp or a datetime.')
+
+
+class SizeField(serializers.WritableField):
+    """字节数列, 输出为字符串, 输入可以带单位, 例如 "2.5 kB" """
+
+    def to_native(self, value):
+        return convert.format_size(value)
+
+    def from_native(self, value):
+        try:
+            return convert.parse_size(value)
+        except (ValueError, TypeError):
+            raise ValidationError('Enter a size in bytes.')
+
+
+class DynamicFieldsModelSerializer(serializers.ModelSerializer):
+    """fields 参数指定只输出哪些字段, 默认输出 Meta.fields 中的全部"""
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super(DynamicFieldsModelSerializer, self).__init__(*args, **kwargs)
+        if fields:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
 
+def parse_fields(request, serializer_class):
+    """解析 ?fields=id,cid,status
+
+    Return:
+        字段列表, 没有 fields 参数时返回 None
+
+    有不存在的字段抛出 ValueError.
+    """
+    value = request.GET.get('fields')
+    if not value:
+        return None
+    fields = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = set(fields) - set(serializer_class.Meta.fields)
+    if unknown:
+        raise ValueError('Error: Unknown fields: %s' %
+                         ', '.join(sorted(unknown)))
+    return fields
+
+
+class ImageSerializer(DynamicFieldsModelSerializer):
+    virtual_size = SizeField()
 
-class ImageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Image
         fields = ('id',
@@ -17,7 +81,7 @@ class ImageSerializer(serializers.ModelSerializer):
                   'virtual_size',)
 
 
-class HostSerializer(serializers.ModelSerializer):
+class HostSerializer(DynamicFieldsModelSerializer):
     class Meta:
         model = Host
         fields = ('id',
@@ -32,7 +96,10 @@ class HostSerializer(serializers.ModelSerializer):
                   'total_bandwidth',)
 
 
-class ContainerSerializer(serializers.ModelSerializer):
+class ContainerSerializer(DynamicFieldsModelSerializer):
+    size = SizeField(required=False)
+    created = CreatedField(required=False)
+
     class Meta:
         model = Container
         fields = ('id',
@@ -43,6 +110,7 @@ class ContainerSerializer(serializers.ModelSerializer):
                   'image',
                   'ports',
                   'status',
+                  'state',
                   'user_id',
                   'command',
                   'created',
@@ -50,3 +118,25 @@ class ContainerSerializer(serializers.ModelSerializer):
                   'flavor_id',
                   'container_name',
                   'json_extra')
+        read_only_fields = ('state',)
+
+
+class JobSerializer(serializers.ModelSerializer):
+    result = serializers.SerializerMethodField('get_result')
+
+    class Meta:
+        model = Job
+        fields = ('id',
+                  'status',
+                  'detail',
+                  'result',
+                  'created',
+                  'deadline',
+                  'finished',
+                  'message_type',
+                  'container_id',)
+
+    def get_result(self, obj):
+        if obj.result is None:
+            return None
+        return simplejson.loads(obj.result)
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Longgeek <longgeek@gmail.com>
+
+import StringIO
+import simplejson
+
+from django.http import QueryDict
+from django.test import TestCase
+from django.test import SimpleTestCase
+from django.test.client import RequestFactory
+
+import pagination
+import views_images
+import views_containers
+from filters import IN_MAX
+from filters import FilterError
+from apphome.models import Image
+from apphome.models import Container
+from telegraph_pole.lib.mq import RPCTimeout
+
+
+class Renderer(object):
+    def __init__(self, format):
+        self.format = format
+
+
+class Request(object):
+    def __init__(self, format=None, body=''):
+        self.accepted_renderer = Renderer(format)
+        self.stream = StringIO.StringIO(body)
+
+
+class StreamedTest(SimpleTestCase):
+    """streamed 逐段输出 exec 的结果"""
+
+    def setUp(self):
+        self.send_stream = views_containers.send_stream
+
+    def tearDown(self):
+        views_containers.send_stream = self.send_stream
+
+    def replies(self, *chunks):
+        def send_stream(message):
+            for chunk in chunks:
+                yield 'output', chunk
+            yield 'result', (0, '', {'exit_code': 0})
+        views_containers.send_stream = send_stream
+
+    def stream(self, format):
+        response = views_containers.streamed(Request(format),
+                                             {'message_type': 'exec'})
+        return ''.join(response.streaming_content)
+
+    def test_character_split_across_chunks(self):
+        text = u'编译完成, 测试通过'.encode('utf-8')
+        # "编" 的三个字节分在两段中
+        self.replies(text[:2], text[2:])
+        lines = self.stream('json').splitlines()
+        output = u''.join(simplejson.loads(line)['output']
+                          for line in lines[:-1])
+        self.assertEqual(output, u'编译完成, 测试通过')
+        self.assertEqual(simplejson.loads(lines[-1])['exit_code'], 0)
+
+    def test_character_split_across_chunks_sse(self):
+        text = u'测试通过'.encode('utf-8')
+        self.replies(text[:4], text[4:])
+        content = self.stream('sse').decode('utf-8')
+        self.assertNotIn(u'�', content)
+        self.assertIn(u'测', content)
+        self.assertIn(u'试通过', content)
+
+    def test_truncated_character_flushed_before_end(self):
+        self.replies(u'完'.encode('utf-8')[:2])
+        lines = self.stream('json').splitlines()
+        self.assertEqual(simplejson.loads(lines[0])['output'], u'�')
+        self.assertEqual(simplejson.loads(lines[1])['status'], 0)
+
+
+class UploadTest(SimpleTestCase):
+    """upload 失败时发送 abort"""
+
+    def setUp(self):
+        self.send_data = views_containers.send_data
+        self.chunk_size = views_containers.FILES_CHUNK_SIZE
+        views_containers.FILES_CHUNK_SIZE = 4
+        self.sent = []
+
+    def tearDown(self):
+        views_containers.send_data = self.send_data
+        views_containers.FILES_CHUNK_SIZE = self.chunk_size
+
+    def replies(self, *results):
+        results = list(results)
+
+        def send_data(message, data):
+            self.sent.append(message)
+            if message.get('abort'):
+                return 0, '', None
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        views_containers.send_data = send_data
+
+    def upload(self):
+        return views_containers.upload(
+            Request(body='x' * 10),
+            {'message_type': 'files_upload_container', 'id': '1'})
+
+    def test_success(self):
+        self.replies((0, '', {}), (0, '', {}), (0, '', {'size': 10}))
+        self.assertEqual(self.upload().status_code, 200)
+        self.assertFalse(any(m.get('abort') for m in self.sent))
+
+    def test_abort_on_error_status(self):
+        self.replies((0, '', {}), (1, 'No space left on device', None))
+        self.assertEqual(self.upload().status_code, 400)
+        self.assertTrue(self.sent[-1].get('abort'))
+
+    def test_abort_on_rpc_error(self):
+        self.replies((0, '', {}), RPCTimeout())
+        self.assertRaises(RPCTimeout, self.upload)
+        self.assertTrue(self.sent[-1].get('abort'))
+        self.assertEqual(self.sent[-1]['upload'], self.sent[0]['upload'])
+
+
+class FilesWriteTest(SimpleTestCase):
+    """files/write 的 mode 参数"""
+
+    def setUp(self):
+        self.send_message = views_containers.send_message
+        self.sent = []
+
+    def tearDown(self):
+        views_containers.send_message = self.send_message
+
+    def reply(self, result):
+        def send_message(message):
+            self.sent.append(message)
+            return 0, '', result
+        views_containers.send_message = send_message
+
+    def post(self, **data):
+        request = Request()
+        request.DATA = dict({'username': 'longgeek',
+                             'files': {'/tmp/a.py': 'print 1'}}, **data)
+        return views_containers.ContainerFilesWriteView().post(request, '3')
+
+    def test_full_mode(self):
+        self.reply({'files': {}})
+        self.assertEqual(self.post().status_code, 200)
+        self.assertEqual(self.post(mode='full').status_code, 200)
+        self.assertNotIn('mode', self.sent[-1])
+
+    def test_unknown_mode(self):
+        self.reply({'files': {}})
+        self.assertEqual(self.post(mode='append').status_code, 400)
+        self.assertEqual(self.sent, [])
+
+    def test_patch_unexpected_result(self):
+        self.reply({'files': {'/tmp/a.py': 'written'}})
+        files = {'/tmp/a.py': {'base_hash': 'abc', 'patch': [[0, 0, 'x']]}}
+        response = self.post(mode='patch', files=files)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.sent[-1]['mode'], 'patch')
+
+
+class FilesListTest(SimpleTestCase):
+    """files/list 的可选参数"""
+
+    def setUp(self):
+        self.send_message = views_containers.send_message
+        self.sent = []
+
+        def send_message(message):
+            self.sent.append(message)
+            return 0, '', {'dirs': []}
+        views_containers.send_message = send_message
+
+    def tearDown(self):
+        views_containers.send_message = self.send_message
+
+    def get(self, **options):
+        request = Request()
+        request.DATA = dict({'dirs': ['/opt']}, **options)
+        return views_containers.ContainerFilesListView().get(request, '3')
+
+    def test_integer_options(self):
+        self.assertEqual(self.get(depth=2, limit=10).status_code, 200)
+        self.assertEqual(self.get(depth=True).status_code, 400)
+        self.assertEqual(self.get(limit=True).status_code, 400)
+        self.assertEqual(self.get(depth=1.5).status_code, 400)
+        self.assertEqual(len(self.sent), 1)
+
+
+class FilterTest(SimpleTestCase):
+    """列表接口的 url 参数过滤"""
+
+    def compile(self, query, spec=views_containers.ContainerView.filters):
+        return spec.compile(QueryDict(query))
+
+    def test_valid(self):
+        kwargs, ordering = self.compile(
+            'user_id=2&state__in=running,paused&id__gte=10'
+            '&created__lte=1417874473&ordering=-created&fields=id')
+        self.assertEqual(kwargs['user_id'], '2')
+        self.assertEqual(kwargs['state__in'], ['running', 'paused'])
+        self.assertEqual(kwargs['id__gte'], 10)
+        self.assertEqual(kwargs['created__lte'].year, 2014)
+        self.assertEqual(ordering, ['-created', 'id'])
+
+    def test_unknown_field(self):
+        self.assertRaises(FilterError, self.compile, 'name=web')
+        self.assertRaises(FilterError, self.compile,
+                          'host__image__repository=ubuntu')
+
+    def test_unknown_lookup(self):
+        self.assertRaises(FilterError, self.compile, 'user_id__gte=2')
+        self.assertRaises(FilterError, self.compile, 'cid__contains=ab')
+
+    def test_bad_value(self):
+        self.assertRaises(FilterError, self.compile, 'id=abc')
+        self.assertRaises(FilterError, self.compile, 'state=sleeping')
+        self.assertRaises(FilterError, self.compile, 'created__gte=soon')
+        self.assertRaises(FilterError, self.compile,
+                          'id__in=' + ','.join(['1'] * (IN_MAX + 1)))
+
+    def test_requires(self):
+        spec = views_images.ImageView.filters
+        self.assertRaises(FilterError, self.compile, 'tag=14.04', spec)
+        kwargs, ordering = self.compile('repository=ubuntu&tag=14.04', spec)
+        self.assertEqual(kwargs, {'repository': 'ubuntu', 'tag': '14.04'})
+
+    def test_view_returns_400(self):
+        view = views_containers.ContainerView.as_view()
+        for query in ('name=web', 'user_id__gte=2', 'id=abc'):
+            request = RequestFactory().get('/v1/containers/?' + query)
+            self.assertEqual(view(request).status_code, 400)
+
+
+class PaginationTest(TestCase):
+    """列表接口的 keyset 分页"""
+
+    def setUp(self):
+        image = Image.objects.create(iid='i', tag='14.04', created='0',
+                                     repository='ubuntu')
+        self.ids = [Container.objects.create(
+            image=image, flavor_id='1', user_id=str(i % 2 + 1),
+            create_status=True).id for i in range(6)]
+        self.page_max = pagination.PAGE_MAX
+
+    def tearDown(self):
+        pagination.PAGE_MAX = self.page_max
+
+    def get(self, query):
+        request = RequestFactory().get('/v1/containers/?' + query)
+        response = views_containers.ContainerView.as_view()(request)
+        links = {}
+        for link in filter(None, response.get('Link', '').split(', ')):
+            url, rel = link.split('; ')
+            links[rel[5:-1]] = url[1:-1].split('?', 1)[1]
+        ids = [c['id'] for c in response.data] \
+            if response.status_code == 200 else None
+        return response.status_code, ids, links
+
+    def test_pages(self):
+        code, ids, links = self.get('limit=4')
+        self.assertEqual(ids, self.ids[:4])
+        self.assertNotIn('prev', links)
+        code, ids, links = self.get(links['next'])
+        self.assertEqual(ids, self.ids[4:])
+        self.assertNotIn('next', links)
+        code, ids, links = self.get(links['prev'])
+        self.assertEqual(ids, self.ids[:4])
+
+    def test_filters_kept_in_links(self):
+        code, ids, links = self.get('user_id=1&limit=2')
+        self.assertEqual(ids, self.ids[0:4:2])
+        self.assertIn('user_id=1', links['next'])
+        code, ids, links = self.get(links['next'])
+        self.assertEqual(ids, self.ids[4:6:2])
+        self.assertIn('user_id=1', links['prev'])
+
+    def test_limit_capped(self):
+        pagination.PAGE_MAX = 3
+        code, ids, links = self.get('limit=1000')
+        self.assertEqual(ids, self.ids[:3])
+        self.assertIn('limit=3', links['next'])
+
+    def test_bad_parameters(self):
+        # eDE 为 "x1", 方向不正确
+        for query in ('limit=0', 'limit=abc', 'limit=2&cursor=%25%25%25',
+                      'limit=2&cursor=eDE', 'limit=2&cursor=PmFi'):
+            self.assertEqual(self.get(query)[0], 400)
@@ -2,17 +2,42 @@
 # -*- coding: utf-8 -*-
 # Author: Longgeek <longgeek@gmail.com>
 
+import re
+import uuid
+import codecs
 import redis
 import hashlib
+import logging
+import posixpath
+import mimetypes
 import simplejson
 
 from django.http import Http404
+from django.http import StreamingHttpResponse
 from apphome.models import Container
+from filters import Field
+from filters import choice
+from filters import integer
+from filters import FilterSpec
+from filters import FilterError
+from pagination import paginate
+from pagination import PageError
+from renderers import sse
+from renderers import STREAM_RENDERERS
+from serializers import parse_fields
 from serializers import ContainerSerializer
 
 from rest_framework import status
 from rest_framework.views import APIView
 from rest_framework.response import Response
+from telegraph_pole import settings
+from telegraph_pole.lib import jobs
+from telegraph_pole.lib import convert
+from telegraph_pole.lib import patch
+from telegraph_pole.lib.mq import RPCError
+from telegraph_pole.lib.mq import send_data
+from telegraph_pole.lib.mq import send_many
+from telegraph_pole.lib.mq import send_stream
 from telegraph_pole.lib.mq import send_message
 
 from telegraph_pole.settings import REDIS_DB
@@ -20,6 +45,246 @@ from telegraph_pole.settings import REDIS_HOST
 from telegraph_pole.settings import REDIS_PORT
 
 
+LOG = logging.getLogger(__name__)
+
+# 批量操作: action -> (message_type, 成功信息), 和单个容器的视图一致
+BULK_ACTIONS = {
+    'stop': ('stop_container', 'Container %s stop success.'),
+    'start': ('start_container', 'Container %s startup success.'),
+    'restart': ('restart_container', 'Container %s restart success.'),
+    'pause': ('pause_container', 'Container %s suspend success.'),
+    'unpause': ('unpause_container', 'Container %s unpause success.'),
+    'delete': ('delete_container', 'Container %s has been deleted.'),
+}
+
+# 一次批量操作最多的容器数
+BULK_MAX = getattr(settings, 'CONTAINER_BULK_MAX', 500)
+
+# 批量操作同时等待 scheduler 返回的请求数
+BULK_CONCURRENCY = getattr(settings, 'CONTAINER_BULK_CONCURRENCY', 20)
+
+# 文件传输时每个消息的字节数
+FILES_CHUNK_SIZE = getattr(settings, 'FILES_CHUNK_SIZE', 256 * 1024)
+
+# 下载时每次向 scheduler 请求的字节数, 读完一个窗口再请求下一个,
+# 客户端读得慢 scheduler 也不会多发. 不能超过
+# RPC_STREAM_BUFFER * FILES_CHUNK_SIZE
+FILES_WINDOW = getattr(settings, 'FILES_WINDOW', 4 * 1024 * 1024)
+
+# files/list 一页最多的条目数
+FILES_LIST_MAX = getattr(settings, 'FILES_LIST_MAX', 1000)
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def is_async(request):
+    """是否使用异步模式: ?async=1"""
+    return request.QUERY_PARAMS.get('async') in ('1', 'true', 'True')
+
+
+def is_stream(request):
+    """是否逐段返回命令的输出: ?stream=1"""
+    return request.QUERY_PARAMS.get('stream') in ('1', 'true', 'True')
+
+
+def streamed(request, message):
+    """逐段返回 scheduler 的输出
+
+    Accept: text/event-stream 时为 SSE, 输出为 output 事件, 最后是
+    exit 事件; 否则为分块传输的 NDJSON, 每行 {"output": STRING},
+    最后一行为 {"status": 0, "exit_code": 0, "detail": "", "result": {}}.
+    WSGI 不支持 HTTP trailer, 退出码放在最后一条记录中.
+
+    收到第一段输出之前失败的按普通请求返回错误.
+    """
+    replies = send_stream(message)
+    kind, data = next(replies)
+    if kind == 'result' and data[0] != 0:
+        return Response({'detail': data[1]},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    if request.accepted_renderer.format == 'sse':
+        def output(text):
+            return sse('output', text)
+
+        def end(record):
+            return sse('error' if record['status'] else 'exit',
+                       simplejson.dumps(record))
+        content_type = 'text/event-stream'
+    else:
+        def output(text):
+            return simplejson.dumps({'output': text}) + '\n'
+
+        def end(record):
+            return simplejson.dumps(record) + '\n'
+        content_type = 'application/x-ndjson'
+
+    # 一个字符可能被分在两段中, 整个输出共用一个解码器
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+    def generate(kind, data):
+        try:
+            while True:
+                if kind == 'output':
+                    text = decoder.decode(data)
+                    if text:
+                        yield output(text)
+                else:
+                    text = decoder.decode('', final=True)
+                    if text:
+                        yield output(text)
+                    s, m, r = data
+                    yield end({'status': s,
+                               'detail': m,
+                               'exit_code': r.get('exit_code')
+                               if isinstance(r, dict) else None,
+                               'result': r})
+                    return
+                kind, data = next(replies)
+        except RPCError, e:
+            text = decoder.decode('', final=True)
+            if text:
+                yield output(text)
+            yield end({'status': e.status_code, 'detail': e.detail})
+        finally:
+            replies.close()
+
+    response = StreamingHttpResponse(generate(kind, data),
+                                     content_type=content_type)
+    response['Cache-Control'] = 'no-cache'
+    # nginx 不缓冲, 输出立即发给客户端
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def parse_range(header):
+    """解析 Range 头, 只支持单个范围: bytes=a-b, bytes=a-, bytes=-n
+
+    Return:
+        (offset, length), 后缀范围 offset 为负数, length 为 None 表示
+        到文件末尾; 没有 Range 或者不支持的格式返回 None, 按整个文件返回
+    """
+    match = RANGE_RE.match((header or '').strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last or not int(last):
+            return None
+        return -int(last), None
+    if not last:
+        return int(first), None
+    if int(last) < int(first):
+        return None
+    return int(first), int(last) - int(first) + 1
+
+
+def parse_etag(header):
+    """If-None-Match 中的第一个 hash, 去掉引号和 W/"""
+    if not header:
+        return None
+    etag = header.split(',')[0].strip()
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    return etag.strip('"') or None
+
+
+def is_integer(value):
+    """JSON 中的整数, true/false 在 Python 中也是 int, 不算"""
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+
+def download(replies, message, offset, end):
+    """逐个窗口从 scheduler 读取 [offset, end) 的文件内容
+
+    replies 为第一个窗口的 send_stream, 元数据已经取走. 一个窗口
+    读完才请求下一个, worker 中最多缓存一个窗口. 开始返回之后
+    无法再修改状态码, 出错时只记录日志并结束, 客户端按
+    Content-Length 可以发现内容不完整.
+    """
+    pos = start = offset
+    try:
+        while True:
+            for kind, data in replies:
+                if kind == 'output':
+                    data = data[:end - pos]
+                    pos += len(data)
+                    yield data
+                elif kind == 'result' and data[0] != 0:
+                    LOG.warning('Download of %s failed: %s' % (
+                        message['path'], data[1]))
+                    return
+            # 文件在下载过程中变短了, 这个窗口没有读到内容
+            if pos >= end or pos == start:
+                return
+            start = pos
+            replies = send_stream(dict(
+                message, offset=pos, length=min(end - pos, FILES_WINDOW)))
+    except RPCError, e:
+        LOG.warning('Download of %s failed: %s' % (message['path'], e))
+    finally:
+        replies.close()
+
+
+def upload(request, message):
+    """把请求的内容按 FILES_CHUNK_SIZE 分段发给 scheduler
+
+    每段是一个带原始字节的消息(send_data), 收到返回之后才读取下一段,
+    worker 中最多有两段. 同一次上传的消息带着同一个 upload id 和
+    各自的 offset, 最后一段 final 为 True, scheduler 收到之后才替换
+    目标. 客户端中途断开, scheduler 返回错误或者 RPC 失败时都发送
+    abort, 让 scheduler 删除临时文件.
+    """
+    message = dict(message, upload=uuid.uuid4().hex)
+    stream = request.stream
+    offset = 0
+    sent = False
+
+    def abort():
+        if not sent:
+            return
+        try:
+            send_data(dict(message, offset=offset, abort=True), '')
+        except RPCError, e:
+            LOG.warning('Can not abort upload %s: %s' %
+                        (message['upload'], e.detail))
+
+    try:
+        data = stream.read(FILES_CHUNK_SIZE) if stream else ''
+        while True:
+            # 多读一段才知道当前这段是不是最后一段
+            following = stream.read(FILES_CHUNK_SIZE) if data else ''
+            sent = True
+            s, m, r = send_data(
+                dict(message, offset=offset, final=not following), data)
+            if s != 0:
+                abort()
+                detail = {'detail': m}
+                return Response(detail,
+                                status=status.HTTP_400_BAD_REQUEST)
+            if not following:
+                return Response(r, status=status.HTTP_200_OK)
+            offset += len(data)
+            data = following
+    except IOError, e:
+        abort()
+        detail = {'detail': 'Error: Upload interrupted: %s' % e}
+        return Response(detail,
+                        status=status.HTTP_400_BAD_REQUEST)
+    except RPCError:
+        abort()
+        raise
+
+
+def accepted(message):
+    """发送消息并创建 Job, 返回 202 和 job id, 结果通过 /jobs/(id) 查询"""
+    job = jobs.submit(message)
+    url = '/v1/jobs/%d' % job.id
+    return Response({'id': job.id, 'status': job.status, 'url': url},
+                    status=status.HTTP_202_ACCEPTED,
+                    headers={'Location': url})
+
+
 class ContainerView(APIView):
     """列出所有的容器
 
@@ -29,12 +294,25 @@ class ContainerView(APIView):
 
     Example request:
         - GET /containers/ HTTP/1.1
-        - GET /containers/?cid=390e90e34656806&host=192.168.8.1&... HTTP/1.1
+        - GET /containers/?user_id=2&state__in=running,paused
+              &ordering=-created HTTP/1.1
 
     Query Parameters:
 
-        cid name host size ports image status
-        user_id command created hostname flavor_id json_extra
+        只能按有索引的字段过滤, 见 filters, 其他参数返回 400:
+
+        id:       exact in gte lte
+        cid:      exact in
+        user_id:  exact in
+        host:     exact in, 主机 id
+        image:    exact in, 镜像 id
+        state:    exact in, created running paused restarting exited
+                  removing dead unknown 中的一个
+        created:  exact gte lte, 时间戳
+        ordering: id created, 例如 ordering=-created, 不能和 limit 一起使用
+
+        limit cursor: 按 id 分页, 见 pagination, 下一页和上一页在 Link 头中
+        fields: 只返回哪些字段, 例如 fields=id,cid,status, 只从数据库读取这些列
 
     Status Codes:
         200 - Success, no error
@@ -55,6 +333,7 @@ class ContainerView(APIView):
                     "image": 1,
                     "ports": "",
                     "status": "Up 36 minutes",
+                    "state": "running",
                     "user_id": "2",
                     "command": "bash",
                     "created": "1417874473",
@@ -67,25 +346,50 @@ class ContainerView(APIView):
             {"detail": STRING}
     """
 
+    filters = FilterSpec({
+        'id': Field(('exact', 'in', 'gte', 'lte'), parse=integer),
+        'cid': Field(),
+        'user_id': Field(),
+        'host': Field(parse=integer, source='host_id'),
+        'image': Field(parse=integer, source='image_id'),
+        'state': Field(parse=choice(Container.STATES)),
+        'created': Field(('exact', 'gte', 'lte'),
+                         parse=convert.parse_created),
+    }, ordering=('id', 'created'))
+
     def get(self, request, format=None):
+        try:
+            kwargs, ordering = self.filters.compile(request.GET)
+        except FilterError, e:
+            return Response({'detail': str(e)},
+                            status=status.HTTP_400_BAD_REQUEST)
 
-        # 如果有 url 参数
-        if request.GET:
-            # 从数据库中过滤相应的对象
-            containers = Container.objects.filter(create_status=True)
-            kwargs = request.GET.dict()
-            containers = containers.filter(**kwargs)
+        # 如果有 url 参数, 从数据库中过滤相应的对象
+        containers = Container.objects.filter(create_status=True, **kwargs)
+        if ordering:
+            containers = containers.order_by(*ordering)
 
-            # 如果没有过滤出，或者参数传递错误，返回 404
-            if not containers:
-                raise Http404
+        # 只读取需要输出的列
+        try:
+            fields = parse_fields(request, ContainerSerializer)
+        except ValueError, e:
+            return Response({'detail': str(e)},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if fields:
+            containers = containers.only(*fields)
 
-        # 没有 url 参数，就返回所有的 container
-        else:
-            containers = Container.objects.filter(create_status=True)
+        try:
+            containers, headers = paginate(request, containers)
+        except PageError, e:
+            return Response({'detail': str(e)},
+                            status=status.HTTP_400_BAD_REQUEST)
 
-        serializer = ContainerSerializer(containers, many=True)
-        return Response(serializer.data)
+        # 如果没有过滤出，或者参数传递错误，返回 404
+        if kwargs and not containers:
+            raise Http404
+
+        serializer = ContainerSerializer(containers, many=True, fields=fields)
+        return Response(serializer.data, headers=headers)
 
 
 class ContainerCreateView(APIView):
@@ -102,8 +406,12 @@ class ContainerCreateView(APIView):
         cid name host size ports image status
         user_id command created hostname flavor_id json_extra
 
+    Query Parameters:
+        async - 1 表示异步执行, 立即返回 job id
+
     Status Codes:
         201 - Success, no error, created
+        202 - Accepted, async job created, see /jobs/(id)
         400 - Failure, bad request
         500 - Failure, server error
 
@@ -119,6 +427,7 @@ class ContainerCreateView(APIView):
                 "image": 1,
                 "ports": "",
                 "status": "Up 41 minutes",
+                "state": "running",
                 "user_id": "2",
                 "command": "bash",
                 "created": "1417874473",
@@ -136,6 +445,8 @@ class ContainerCreateView(APIView):
         if serializer.is_valid():
             serializer.data['message_type'] = 'create_container'
             serializer.data['username'] = request.DATA['username']
+            if is_async(request):
+                return accepted(serializer.data)
             s, m, r = send_message(serializer.data)
             if s == 0:
                 return Response(r, status=status.HTTP_201_CREATED)
@@ -197,8 +508,12 @@ class ContainerDeleteView(APIView):
     Example request:
         DELETE /containers/3/delete HTTP/1.1
 
+    Query Parameters:
+        async - 1 表示异步执行, 立即返回 job id
+
     Status Codes:
         200 - Success, no error
+        202 - Accepted, async job created, see /jobs/(id)
         400 - Failure, bad request
         500 - Failure, server error
 
@@ -211,6 +526,8 @@ class ContainerDeleteView(APIView):
 
     def delete(self, request, id, format=None):
         msg = {'id': id, 'message_type': 'delete_container'}
+        if is_async(request):
+            return accepted(msg)
         s, m, r = send_message(msg)
         if s == 0:
             detail = {'detail': 'Container %s has been deleted.' % r['cid']}
@@ -247,6 +564,7 @@ class ContainerDetailView(APIView):
                 "image": 1,
                 "ports": "",
                 "status": "Up 6 minutes",
+                "state": "running",
                 "user_id": "2",
                 "command": "bash",
                 "created": "1417874473",
@@ -354,9 +672,11 @@ class ContainerStopView(APIView):
 
     Query Parameters:
         t – number of seconds to wait before killing the container
+        async - 1 表示异步执行, 立即返回 job id
 
     Status Codes:
         200 - Success, no error
+        202 - Accepted, async job created, see /jobs/(id)
         400 - Failure, bad request
         500 - Failure, server error
 
@@ -372,6 +692,8 @@ class ContainerStopView(APIView):
             return Response('Error: Do not need any parameters!',
                             status=status.HTTP_400_BAD_REQUEST)
         msg = {'id': id, 'message_type': 'stop_container'}
+        if is_async(request):
+            return accepted(msg)
         s, m, r = send_message(msg)
         if s == 0:
             detail = {'detail': 'Container %s stop success.' % r['cid']}
@@ -391,8 +713,12 @@ class ContainerStartView(APIView):
     Example request:
         POST /containers/3/start HTTP/1.1
 
+    Query Parameters:
+        async - 1 表示异步执行, 立即返回 job id
+
     Status Codes:
         200 - Success, no error
+        202 - Accepted, async job created, see /jobs/(id)
         400 - Failure, bad request
         500 - Failure, server error
 
@@ -421,6 +747,8 @@ class ContainerStartView(APIView):
         msg = {'id': id,
                'username': param['username'],
                'message_type': 'start_container'}
+        if is_async(request):
+            return accepted(msg)
         s, m, r = send_message(msg)
         if s == 0:
             detail = {'detail': 'Container %s startup success.' % r['cid']}
@@ -440,8 +768,12 @@ class ContainerReStartView(APIView):
     Example request:
         POST /containers/3/restart HTTP/1.1
 
+    Query Parameters:
+        async - 1 表示异步执行, 立即返回 job id
+
     Status Codes:
         200 - Success, no error
+        202 - Accepted, async job created, see /jobs/(id)
         400 - Failure, bad request
         500 - Failure, server error
 
@@ -457,6 +789,8 @@ class ContainerReStartView(APIView):
             return Response('Error: Do not need any parameters!',
                             status=status.HTTP_400_BAD_REQUEST)
         msg = {'id': id, 'message_type': 'restart_container'}
+        if is_async(request):
+            return accepted(msg)
         s, m, r = send_message(msg)
         if s == 0:
             detail = {'detail': 'Container %s restart success.' % r['cid']}
@@ -487,6 +821,9 @@ class ContainerExecView(APIView):
     Jons Parameters:
         command: list
 
+    Query Parameters:
+        stream - 1 表示逐段返回命令的输出, 见 streamed
+
     Status Codes:
         200 - Success, no error
         400 - Failure, bad request
@@ -499,6 +836,8 @@ class ContainerExecView(APIView):
             {"detail": STRING}
     """
 
+    renderer_classes = STREAM_RENDERERS
+
     def post(self, request, id, format=None):
         param = request.DATA
 
@@ -510,6 +849,8 @@ class ContainerExecView(APIView):
                        'command': param['command'],
                        'wait': param['wait'],
                        'message_type': 'exec_container'}
+                if is_stream(request):
+                    return streamed(request, msg)
 
                 s, m, r = send_message(msg)
                 if s == 0:
@@ -534,6 +875,146 @@ executed successfully' % r['cid']}
                             status=status.HTTP_400_BAD_REQUEST)
 
 
+class ContainerExecBatchView(APIView):
+    """在多个容器中执行同一个命令
+
+    每个容器一个 Job(见 lib/jobs.submit_batch), 最多
+    JOB_BATCH_CONCURRENCY 个同时执行, 执行完一个再发送下一个.
+    立即返回 202, 执行过程中可以通过返回的 url 查询已经完成的结果.
+    需要运行 manage.py consume_jobs.
+
+    Info:
+        POST /containers/exec HTTP/1.1
+        Content-Type: application/json
+
+    Example request:
+        POST /containers/exec HTTP/1.1
+
+        {
+         "ids": [3, 4, 5],
+         "command": ["make test"],
+         "wait": true
+        }
+
+    Jons Parameters:
+        ids: list;      最多 CONTAINER_BULK_MAX 个
+        command: list
+        wait: bool
+
+    Status Codes:
+        202 - Accepted, see /containers/exec/(batch)
+        400 - Failure, bad request
+
+    Results: JSON
+        Success:
+            {
+                "batch": "9f3c0c1e7f2d4a0e9d6c1b2a3f4e5d6c",
+                "url": "/v1/containers/exec/9f3c0c1e7f2d4a0e9d6c1b2a3f4e5d6c",
+                "total": 2,
+                "not_found": [5]
+            }
+        Failure:
+            {"detail": STRING}
+    """
+
+    def post(self, request, format=None):
+        param = request.DATA
+        ids = param.get('ids') if isinstance(param, dict) else None
+        if not isinstance(ids, list) or not ids:
+            return Response({'detail': 'ids must be a non-empty list'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if len(ids) > BULK_MAX:
+            return Response({'detail': 'At most %d ids' % BULK_MAX},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            ids = [int(id) for id in ids]
+        except (TypeError, ValueError):
+            return Response({'detail': 'ids must be integers'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if not param.get('command'):
+            detail = {'detail': 'Error: The wrong parameter!'}
+            return Response(detail,
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        found = set(Container.objects.filter(id__in=ids).values_list(
+            'id', flat=True))
+        messages = [{'id': str(id),
+                     'command': param['command'],
+                     'wait': param.get('wait', False),
+                     'message_type': 'exec_container'}
+                    for id in ids if id in found]
+        not_found = [id for id in ids if id not in found]
+        if not messages:
+            return Response({'detail': 'Not found', 'not_found': not_found},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        batch = jobs.submit_batch(messages)
+        url = '/v1/containers/exec/%s' % batch
+        return Response({'batch': batch,
+                         'url': url,
+                         'total': len(messages),
+                         'not_found': not_found},
+                        status=status.HTTP_202_ACCEPTED,
+                        headers={'Location': url})
+
+
+class ContainerExecBatchDetailView(APIView):
+    """查询批量执行的进度和每个容器的结果
+
+    Info:
+        GET /containers/exec/(batch) HTTP/1.1
+
+    Status Codes:
+        200 - Success, no error
+        404 - Failure, batch not found
+
+    Results: JSON
+        Success:
+            {
+                "batch": "9f3c0c1e7f2d4a0e9d6c1b2a3f4e5d6c",
+                "total": 2,
+                "queued": 0,
+                "running": 1,
+                "finished": 1,
+                "results": [
+                    {"id": "3", "job": 12, "status": "success",
+                     "exit_code": 0, "detail": "",
+                     "result": {"cid": "bda51967884c...", "exit_code": 0}},
+                    {"id": "4", "job": 13, "status": "pending",
+                     "exit_code": null, "detail": null, "result": null}
+                ]
+            }
+        Failure:
+            {"detail": STRING}
+    """
+
+    def get(self, request, batch, format=None):
+        rows = jobs.batch_jobs(batch)
+        if not rows:
+            raise Http404
+        counts = {'queued': 0, 'pending': 0}
+        results = []
+        for job in rows:
+            counts[job.status] = counts.get(job.status, 0) + 1
+            result = None if job.result is None else \
+                simplejson.loads(job.result)
+            results.append({'id': job.container_id,
+                            'job': job.id,
+                            'status': job.status,
+                            'exit_code': result.get('exit_code')
+                            if isinstance(result, dict) else None,
+                            'detail': job.detail,
+                            'result': result})
+        return Response({'batch': batch,
+                         'total': len(rows),
+                         'queued': counts['queued'],
+                         'running': counts['pending'],
+                         'finished': len(rows) - counts['queued'] -
+                         counts['pending'],
+                         'results': results},
+                        status=status.HTTP_200_OK)
+
+
 class ContainerPauseView(APIView):
     """暂停一个容器
 
@@ -606,6 +1087,102 @@ class ContainerUnPauseView(APIView):
             return Response(detail, status=status.HTTP_400_BAD_REQUEST)
 
 
+class ContainerBulkView(APIView):
+    """批量停止, 启动, 重启, 暂停, 恢复或删除容器
+
+    一次查询校验所有的 id, 再按 BULK_CONCURRENCY 分批并发发送给
+    scheduler, 返回每个容器的结果. 单个容器失败不影响其它容器.
+
+    Info:
+        POST /containers/bulk/(action) HTTP/1.1
+        Content-Type: application/json
+
+        action: stop start restart pause unpause delete
+
+    Example request:
+        POST /containers/bulk/stop HTTP/1.1
+
+        {
+            "ids": [3, 4, 5],
+            "username": "longgeek"  # 只有 start 需要
+        }
+
+    Status Codes:
+        200 - Success, see the status of each container
+        400 - Failure, bad request
+
+    Results: JSON
+        Success:
+            {
+                "results": [
+                    {"id": 3, "status": 200,
+                     "detail": "Container bda51967884c... stop success."},
+                    {"id": 4, "status": 404, "detail": "Not found"},
+                    {"id": 5, "status": 504, "detail": "..."}
+                ]
+            }
+        Failure:
+            {"detail": STRING}
+    """
+
+    def post(self, request, action, format=None):
+        message_type, success = BULK_ACTIONS[action]
+        param = request.DATA
+        ids = param.get('ids') if isinstance(param, dict) else None
+        if not isinstance(ids, list) or not ids:
+            return Response({'detail': 'ids must be a non-empty list'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if len(ids) > BULK_MAX:
+            return Response({'detail': 'At most %d ids' % BULK_MAX},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            ids = [int(id) for id in ids]
+        except (TypeError, ValueError):
+            return Response({'detail': 'ids must be integers'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if action == 'start' and 'username' not in param:
+            return Response({'detail': 'username is required'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        containers = dict(
+            (id, (cid, create_status)) for id, cid, create_status in
+            Container.objects.filter(id__in=ids).values_list(
+                'id', 'cid', 'create_status'))
+
+        results = []
+        messages = []
+        for id in ids:
+            result = {'id': id, 'status': status.HTTP_404_NOT_FOUND,
+                      'detail': 'Not found'}
+            results.append(result)
+            if id not in containers:
+                continue
+            # 和 ContainerStartView 一致, 没有创建成功的容器不能启动
+            cid, create_status = containers[id]
+            if action == 'start' and (not cid or not create_status):
+                continue
+            msg = {'id': str(id), 'message_type': message_type}
+            if action == 'start':
+                msg['username'] = param['username']
+            messages.append((result, msg))
+
+        for i in range(0, len(messages), BULK_CONCURRENCY):
+            batch = messages[i:i + BULK_CONCURRENCY]
+            replies = send_many([m for _, m in batch])
+            for (result, msg), (s, m, r) in zip(batch, replies):
+                if s == 0:
+                    result['status'] = status.HTTP_200_OK
+                    result['detail'] = success % r['cid']
+                else:
+                    # 超时和无法连接时 s 为 504/503, 其它为 scheduler 的错误
+                    result['status'] = s if s in (
+                        status.HTTP_503_SERVICE_UNAVAILABLE,
+                        status.HTTP_504_GATEWAY_TIMEOUT) else \
+                        status.HTTP_400_BAD_REQUEST
+                    result['detail'] = m
+        return Response({'results': results}, status=status.HTTP_200_OK)
+
+
 class ContainerTopView(APIView):
     """列出容器中的所有进程
 
@@ -759,13 +1336,33 @@ class ContainerFilesWriteView(APIView):
             }
         }
 
+    Example patch request:
+        POST /containers/3/files/write HTTP/1.1
+
+        {
+         "username":"longgeek",
+         "mode": "patch",
+         "files":{
+            "/opt/python/django_project/urls.py": {
+                "base_hash": "2fd4e1c67a2d28fced849ee1bb76e7391b93eb12",
+                "patch": [[120, 131, "new text"], [300, 300, "inserted"]]
+            }
+         }
+        }
+
     Jons Parameters:
         files: dict
         username: str
+        mode: str;  full(默认) 或者 patch
+
+    patch 模式只发送修改的部分和编辑器打开文件时内容的 hash(base_hash),
+    补丁的格式见 lib/patch. 容器中文件的 hash 和 base_hash 不一致时
+    该文件不会写入, 返回 409, 客户端重新发送完整内容.
 
     Status Codes:
         200 - Success, no error
         400 - Failure, bad request
+        409 - Failure, the file changed, resend the full content
         500 - Failure, server error
 
     Results: JSON
@@ -781,12 +1378,40 @@ class ContainerFilesWriteView(APIView):
                    "/opt/python/django_project/views.py": "file content",
                 }
             }
+        Patch success:
+            {
+                ...
+                "files":{
+                   "/opt/python/django_project/urls.py": {
+                        "status": "written",
+                        "hash": "de9f2c7fd25e1b3afad3e85a0bd17d9b100db4b3"
+                   }
+                }
+            }
+        Conflict:
+            {
+                "detail": STRING,
+                "files":{
+                   "/opt/python/django_project/urls.py": {
+                        "status": "conflict",
+                        "hash": "容器中文件当前的 hash"
+                   }
+                }
+            }
         Failure:
             {"detail": STRING}
     """
 
     def post(self, request, id, format=None):
-        param = request.DATA
+        param = dict(request.DATA.items())
+
+        mode = param.pop('mode', None)
+        if mode == 'patch':
+            return self.write_patch(id, param)
+        if mode not in (None, 'full'):
+            detail = {'detail': 'Error: Unknown mode %s!' % mode}
+            return Response(detail,
+                            status=status.HTTP_400_BAD_REQUEST)
 
         # 判断 post 的参数是否有 'files' 'username'
         # 并且 value 不能为空
@@ -818,6 +1443,47 @@ class ContainerFilesWriteView(APIView):
             return Response(detail,
                             status=status.HTTP_400_BAD_REQUEST)
 
+    def write_patch(self, id, param):
+        """patch 模式, scheduler 确认 base_hash 之后应用补丁"""
+        files = param.get('files')
+        if not param.get('username') or not files or \
+                not isinstance(files, dict):
+            detail = {'detail': 'Error: The wrong parameter!'}
+            return Response(detail,
+                            status=status.HTTP_400_BAD_REQUEST)
+        for value in files.values():
+            if not isinstance(value, dict) or \
+                    not value.get('base_hash') or \
+                    not patch.validate(value.get('patch')):
+                detail = {'detail': 'Error: The wrong parameter!'}
+                return Response(detail,
+                                status=status.HTTP_400_BAD_REQUEST)
+
+        msg = {'id': id,
+               'files': dict((path, {'base_hash': value['base_hash'],
+                                     'patch': value['patch']})
+                             for path, value in files.items()),
+               'username': param['username'],
+               'mode': 'patch',
+               'message_type': 'files_write_container'}
+        s, m, r = send_message(msg)
+        if s != 0:
+            detail = {'detail': m}
+            return Response(detail,
+                            status=status.HTTP_400_BAD_REQUEST)
+        # 其它文件已经写入, 只有冲突的文件需要重新发送完整内容
+        results = r.get('files') if isinstance(r, dict) else None
+        if isinstance(results, dict) and any(
+                isinstance(result, dict) and
+                result.get('status') == 'conflict'
+                for result in results.values()):
+            detail = {'detail': 'Error: The file has changed, '
+                                'resend the full content!',
+                      'files': results}
+            return Response(detail,
+                            status=status.HTTP_409_CONFLICT)
+        return Response(r, status=status.HTTP_200_OK)
+
 
 class ContainerFilesListView(APIView):
     """列出文件中的文件
@@ -835,9 +1501,26 @@ class ContainerFilesListView(APIView):
              ],
         }
 
+    Example paged request:
+        GET /containers/3/files/list HTTP/1.1
+
+        {
+         "dirs": ["/opt/project"],
+         "depth": 1,
+         "limit": 200,
+         "ignore": ["node_modules", "*.pyc", ".git"],
+         "since": 1426838486.15
+        }
+
     Jons Parameters:
-        files: list
-        username: str
+        dirs: list
+        depth: int;     只列出几层, 1 表示只列出 dirs 下的直接子项,
+                        没有展开的目录带 "truncated": true
+        limit: int;     最多返回的条目数, 最大 FILES_LIST_MAX,
+                        只能列出一个目录
+        cursor: str;    上一页返回的 X-Next-Cursor
+        ignore: list;   忽略的文件名或路径(glob), 匹配的目录不会展开
+        since: float;   只返回修改时间(mtime)晚于它的条目, 用于增量刷新
 
     Status Codes:
         200 - Success, no error
@@ -858,21 +1541,44 @@ class ContainerFilesListView(APIView):
                       {"type":"report","directories":2,"files":1}
                     ],
             }
+
+            还有下一页时响应头 X-Next-Cursor 为下一页的 cursor.
         Failure:
             {"detail": STRING}
     """
 
+    # 可选参数 -> 检查参数值的函数
+    OPTIONS = {
+        'depth': lambda v: is_integer(v) and v > 0,
+        'limit': lambda v: is_integer(v) and 0 < v <= FILES_LIST_MAX,
+        'cursor': lambda v: isinstance(v, basestring) and v,
+        'ignore': lambda v: isinstance(v, list) and all(
+            isinstance(i, basestring) and i for i in v),
+        'since': lambda v: isinstance(v, (int, float)) and
+        not isinstance(v, bool),
+    }
+
     def get(self, request, id, format=None):
         param = request.DATA
-
-        # 判断 get 的参数是否有 'dirs', 并且 value 不能为空
-        if len(param) == 1 and 'dirs' in param.keys() and param['dirs']:
+        options = dict((k, v) for k, v in param.items() if k != 'dirs')
+
+        # 判断 get 的参数是否有 'dirs', 并且 value 不能为空,
+        # 分页时只能列出一个目录
+        if 'dirs' in param.keys() and param['dirs'] and \
+                all(k in self.OPTIONS and self.OPTIONS[k](v)
+                    for k, v in options.items()) and \
+                ('limit' not in options and 'cursor' not in options or
+                 len(param['dirs']) == 1):
             msg = {'id': id,
                    'dirs': param['dirs'],
                    'message_type': 'files_list_container'}
+            msg.update(options)
             s, m, r = send_message(msg)
             if s == 0:
-                return Response(r['dirs'], status=status.HTTP_200_OK)
+                response = Response(r['dirs'], status=status.HTTP_200_OK)
+                if r.get('next'):
+                    response['X-Next-Cursor'] = r['next']
+                return response
             else:
                 detail = {'detail': m}
                 return Response(detail,
@@ -903,9 +1609,16 @@ class ContainerFilesReadView(APIView):
     Jons Parameters:
         files: list
         username: str
+        hashes: dict;   可选, 客户端已有内容的 hash, {path: hash}
+
+    每个文件都返回内容的 hash(lib/patch.content_hash, 也是 patch 模式
+    写入时的 base_hash). hash 和 hashes 中一致的文件不返回内容,
+    列在 not_modified 中. 只读取一个文件时也可以用 If-None-Match
+    头传入 hash(返回的 ETag), 没有修改返回 304.
 
     Status Codes:
         200 - Success, no error
+        304 - Not modified, single file with If-None-Match
         400 - Failure, bad request
         500 - Failure, server error
 
@@ -919,8 +1632,12 @@ class ContainerFilesReadView(APIView):
                 "username": 'longgeek',
                 "files": {
                     "/opt/python/django_project/urls.py": "file content",
-                    "/opt/python/django_project/views.py": "file content",
                 },
+                "hashes": {
+                    "/opt/python/django_project/urls.py": "de9f2c7f...",
+                    "/opt/python/django_project/views.py": "2fd4e1c6...",
+                },
+                "not_modified": ["/opt/python/django_project/views.py"]
             }
         Failure:
             {"detail": STRING}
@@ -928,19 +1645,35 @@ class ContainerFilesReadView(APIView):
 
     def post(self, request, id, format=None):
         param = request.DATA
+        hashes = param.get('hashes') or {}
+        etag = parse_etag(request.META.get('HTTP_IF_NONE_MATCH'))
 
         # 判断 post 的参数是否有 'files' 'username'
         # 并且 value 不能为空
-        if len(param) == 2 and 'files' in param.keys() and \
-                               'username' in param.keys():
+        if len(param) - ('hashes' in param) == 2 and \
+                'files' in param.keys() and 'username' in param.keys() \
+                and isinstance(hashes, dict):
             if param['files'] and param['username']:
                 msg = {'id': id,
                        'files': param['files'],
                        'username': param['username'],
                        'message_type': 'files_read_container'}
+                single = len(param['files']) == 1
+                if etag and single:
+                    hashes = {param['files'][0]: etag}
+                if hashes:
+                    msg['hashes'] = hashes
                 s, m, r = send_message(msg)
                 if s == 0:
-                    return Response(r, status=status.HTTP_200_OK)
+                    if not single:
+                        return Response(r, status=status.HTTP_200_OK)
+                    etag = (r.get('hashes') or {}).get(param['files'][0])
+                    headers = {'ETag': '"%s"' % etag} if etag else {}
+                    if r.get('not_modified'):
+                        return Response(status=status.HTTP_304_NOT_MODIFIED,
+                                        headers=headers)
+                    return Response(r, status=status.HTTP_200_OK,
+                                    headers=headers)
                 else:
                     detail = {'detail': m}
                     return Response(detail,
@@ -955,6 +1688,232 @@ class ContainerFilesReadView(APIView):
                             status=status.HTTP_400_BAD_REQUEST)
 
 
+class ContainerFilesContentView(APIView):
+    """流式读取和写入容器中的一个文件, 内容为原始字节
+
+    Info:
+        GET /containers/(id)/files/content?path=PATH&username=USER HTTP/1.1
+        PUT /containers/(id)/files/content?path=PATH&username=USER HTTP/1.1
+
+    Example request:
+        GET /containers/3/files/content?path=/opt/app.tar&username=longgeek
+        Range: bytes=1048576-
+
+        PUT /containers/3/files/content?path=/opt/app.tar&username=longgeek
+        Content-Type: application/octet-stream
+
+        <file content>
+
+    Query Parameters:
+        path: str;      文件的绝对路径
+        username: str
+
+    文件按 FILES_CHUNK_SIZE 分段在 scheduler 和 worker 之间传输, 请求和
+    返回的内容都不会整个读入内存. GET 支持单个范围的 Range 请求.
+    PUT 的内容先写入临时文件, 最后一段写入之后才替换原文件.
+
+    Status Codes:
+        200 - Success, no error
+        206 - Success, partial content
+        400 - Failure, bad request
+        416 - Failure, range not satisfiable
+        500 - Failure, server error
+
+    Results:
+        GET Success:
+            文件内容, Content-Range 为返回的范围
+        PUT Success:
+            {
+                "id": "10",
+                "cid": "779bfb2bebb079ae80f7686c642cb83df9ae
+                        b51b3cd139fc050860f362def2ed",
+                "host": "192.168.8.8",
+                "username": 'longgeek',
+                "path": "/opt/app.tar",
+                "size": 10485760
+            }
+        Failure:
+            {"detail": STRING}
+    """
+
+    def message(self, request, id, message_type):
+        path = request.QUERY_PARAMS.get('path')
+        username = request.QUERY_PARAMS.get('username')
+        if not path or not username or path[0] != '/':
+            return None
+        return {'id': id,
+                'path': path,
+                'username': username,
+                'message_type': message_type}
+
+    def get(self, request, id, format=None):
+        msg = self.message(request, id, 'files_download_container')
+        if msg is None:
+            detail = {'detail': 'Error: The wrong parameter!'}
+            return Response(detail,
+                            status=status.HTTP_400_BAD_REQUEST)
+        msg['chunk_size'] = FILES_CHUNK_SIZE
+
+        byte_range = parse_range(request.META.get('HTTP_RANGE'))
+        offset, length = byte_range or (0, None)
+        replies = send_stream(dict(
+            msg, offset=offset, length=min(length or FILES_WINDOW,
+                                           FILES_WINDOW)))
+
+        # 第一个消息是文件的元数据: 大小和实际的起始位置
+        kind, data = next(replies)
+        if kind != 'meta':
+            replies.close()
+            detail = {'detail': data[1] if kind == 'result' and data[0]
+                      else 'Error: Invalid reply from scheduler!'}
+            return Response(detail,
+                            status=status.HTTP_400_BAD_REQUEST)
+        size, offset = data['size'], data['offset']
+        if byte_range and offset >= size:
+            replies.close()
+            detail = {'detail': 'Error: The range is not satisfiable!'}
+            return Response(
+                detail,
+                status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                headers={'Content-Range': 'bytes */%d' % size})
+        end = size if length is None else min(offset + length, size)
+
+        content_type = mimetypes.guess_type(msg['path'])[0]
+        response = StreamingHttpResponse(
+            download(replies, msg, offset, end),
+            content_type=content_type or 'application/octet-stream')
+        response['Content-Length'] = str(end - offset)
+        response['Accept-Ranges'] = 'bytes'
+        response['Content-Disposition'] = 'attachment; filename="%s"' % (
+            posixpath.basename(msg['path']).replace('"', ''))
+        if byte_range:
+            response.status_code = status.HTTP_206_PARTIAL_CONTENT
+            response['Content-Range'] = 'bytes %d-%d/%d' % (
+                offset, end - 1, size)
+        return response
+
+    def put(self, request, id, format=None):
+        msg = self.message(request, id, 'files_upload_container')
+        if msg is None:
+            detail = {'detail': 'Error: The wrong parameter!'}
+            return Response(detail,
+                            status=status.HTTP_400_BAD_REQUEST)
+        return upload(request, msg)
+
+
+class ContainerArchiveView(APIView):
+    """以 tar 包导出和导入容器中的目录
+
+    Info:
+        GET /containers/(id)/archive?path=PATH&username=USER HTTP/1.1
+        PUT /containers/(id)/archive?path=PATH&username=USER HTTP/1.1
+
+    Example request:
+        GET /containers/3/archive?path=/opt/project&username=longgeek&gzip=1
+
+        PUT /containers/3/archive?path=/opt&username=longgeek&gzip=1
+        Content-Type: application/gzip
+
+        <tar.gz content>
+
+    Query Parameters:
+        path: str;      导出的目录, 或者导入时解包到的目录
+        username: str
+        gzip: 1 表示 tar 包经过 gzip 压缩
+
+    一次请求代替逐个 dirs/create, files/write 和 files/read. 导出时
+    scheduler 边打包边返回, 导入时请求的内容分段发给 scheduler,
+    全部收到之后再解包, 都不会把整个 tar 包读入内存.
+    导出时客户端读取太慢, 缓存的数据超过 RPC_STREAM_BUFFER 段会中断.
+
+    Status Codes:
+        200 - Success, no error
+        400 - Failure, bad request
+        500 - Failure, server error
+
+    Results:
+        GET Success:
+            tar 包(application/x-tar 或者 application/gzip)
+        PUT Success:
+            {
+                "id": "10",
+                "cid": "779bfb2bebb079ae80f7686c642cb83df9ae
+                        b51b3cd139fc050860f362def2ed",
+                "host": "192.168.8.8",
+                "username": 'longgeek',
+                "path": "/opt",
+                "files": 120
+            }
+        Failure:
+            {"detail": STRING}
+    """
+
+    def message(self, request, id, message_type):
+        path = request.QUERY_PARAMS.get('path')
+        username = request.QUERY_PARAMS.get('username')
+        if not path or not username or path[0] != '/':
+            return None
+        return {'id': id,
+                'path': path,
+                'username': username,
+                'gzip': request.QUERY_PARAMS.get('gzip') in
+                ('1', 'true', 'True'),
+                'message_type': message_type}
+
+    def get(self, request, id, format=None):
+        msg = self.message(request, id, 'archive_export_container')
+        if msg is None:
+            detail = {'detail': 'Error: The wrong parameter!'}
+            return Response(detail,
+                            status=status.HTTP_400_BAD_REQUEST)
+        msg['chunk_size'] = FILES_CHUNK_SIZE
+
+        replies = send_stream(msg)
+        kind, data = next(replies)
+        if kind == 'result':
+            replies.close()
+            detail = {'detail': data[1] if data[0]
+                      else 'Error: Invalid reply from scheduler!'}
+            return Response(detail,
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        def generate(kind, data):
+            try:
+                while True:
+                    if kind == 'output':
+                        yield data
+                    elif kind == 'result':
+                        if data[0] != 0:
+                            LOG.warning('Export of %s failed: %s' % (
+                                msg['path'], data[1]))
+                        return
+                    kind, data = next(replies)
+            except RPCError, e:
+                LOG.warning('Export of %s failed: %s' % (msg['path'], e))
+            finally:
+                replies.close()
+
+        name = posixpath.basename(msg['path'].rstrip('/')) or 'root'
+        if msg['gzip']:
+            content_type, name = 'application/gzip', name + '.tar.gz'
+        else:
+            content_type, name = 'application/x-tar', name + '.tar'
+        response = StreamingHttpResponse(generate(kind, data),
+                                         content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename="%s"' % (
+            name.replace('"', ''))
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    def put(self, request, id, format=None):
+        msg = self.message(request, id, 'archive_import_container')
+        if msg is None:
+            detail = {'detail': 'Error: The wrong parameter!'}
+            return Response(detail,
+                            status=status.HTTP_400_BAD_REQUEST)
+        return upload(request, msg)
+
+
 class ContainerFilesDeleteView(APIView):
     """删除容器中的文件
 
@@ -1144,6 +2103,9 @@ class ContainerDirsCreateView(APIView):
             else:
                 detail = {'detail': 'Error: The wrong parameter!'}
                 return Response(detail, status=status.HTTP_400_BAD_REQUEST)
+        except RPCError:
+            # 超时或者 scheduler 不可用, 交给 rest_framework 返回 504/503
+            raise
         except:
             detail = {'detail': 'Error: The wrong parameter!'}
             return Response(detail, status=status.HTTP_400_BAD_REQUEST)
@@ -1201,6 +2163,9 @@ class ContainerDirsDeleteView(APIView):
             else:
                 detail = {'detail': 'Error: The wrong parameter!'}
                 return Response(detail, status=status.HTTP_400_BAD_REQUEST)
+        except RPCError:
+            # 超时或者 scheduler 不可用, 交给 rest_framework 返回 504/503
+            raise
         except:
             detail = {'detail': 'Error: The wrong parameter!'}
             return Response(detail, status=status.HTTP_400_BAD_REQUEST)
@@ -1228,6 +2193,9 @@ class ContainerHostExecView(APIView):
         commands: list
         username: str
 
+    Query Parameters:
+        stream - 1 表示逐段返回命令的输出, 见 streamed
+
     Status Codes:
         200 - Success, no error
         400 - Failure, bad request
@@ -1248,6 +2216,8 @@ class ContainerHostExecView(APIView):
             {"detail": STRING}
     """
 
+    renderer_classes = STREAM_RENDERERS
+
     def post(self, request, id, format=None):
         param = request.DATA
 
@@ -1260,6 +2230,8 @@ class ContainerHostExecView(APIView):
                        'commands': param['commands'],
                        'username': param['username'],
                        'message_type': 'host_exec_container'}
+                if is_stream(request):
+                    return streamed(request, msg)
                 s, m, r = send_message(msg)
                 if s == 0:
                     return Response(r, status=status.HTTP_200_OK)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Longgeek <longgeek@gmail.com>
+
+import time
+import simplejson
+
+from django.http import StreamingHttpResponse
+
+from rest_framework import status
+from rest_framework.views import APIView
+from rest_framework.response import Response
+from renderers import sse
+from renderers import STREAM_RENDERERS
+from telegraph_pole import settings
+from telegraph_pole.lib import events
+
+
+# 长轮询最长等待的秒数
+POLL_TIMEOUT = getattr(settings, 'EVENTS_POLL_TIMEOUT', 25)
+
+# SSE 没有事件时发送注释行的间隔(秒), 避免代理断开空闲连接
+KEEPALIVE = 15
+
+
+def container_event(event):
+    return sse('container', simplejson.dumps(event), id=repr(event['ts']))
+
+
+class ContainerEventsView(APIView):
+    """容器状态变化的事件, 支持 SSE 和长轮询
+
+    请求头 Accept 包含 text/event-stream 时返回 SSE 事件流,
+    否则为长轮询: 有事件立即返回, 没有则最多等待 timeout 秒.
+    等待在 gevent worker 中只挂起当前 greenlet.
+
+    Info:
+        GET /containers/events HTTP/1.1
+
+    Example request:
+        GET /containers/events?user_id=2 HTTP/1.1
+        Accept: text/event-stream
+
+        GET /containers/events?ids=3,4&since=1426838486.152 HTTP/1.1
+
+    Query Parameters:
+        user_id - 只返回该用户的容器的事件
+        ids     - 只返回这些容器的事件, 逗号分隔
+        since   - 只返回这个时间之后的事件, 使用上次返回的 cursor;
+                  SSE 断线重连时使用 Last-Event-ID
+        timeout - 长轮询最长等待的秒数, 默认 25
+
+    Status Codes:
+        200 - Success, no error
+        400 - Failure, bad request
+
+    Results: JSON
+        Success:
+            {
+                "cursor": 1426838491.870,
+                "events": [
+                    {
+                        "ts": 1426838491.870,
+                        "id": "3",
+                        "user_id": "2",
+                        "event": "stop_container",
+                        "ok": true,
+                        "detail": ""
+                    }
+                ]
+            }
+        Failure:
+            {"detail": STRING}
+    """
+
+    renderer_classes = STREAM_RENDERERS
+
+    def get(self, request, format=None):
+        params = request.QUERY_PARAMS
+        ids = params.get('ids')
+        try:
+            since = float(params.get('since') or
+                          request.META.get('HTTP_LAST_EVENT_ID') or
+                          time.time())
+            timeout = min(float(params.get('timeout', POLL_TIMEOUT)),
+                          POLL_TIMEOUT)
+        except ValueError:
+            return Response({'detail': 'since and timeout must be numbers'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        watcher = events.Watcher(
+            user_id=params.get('user_id'),
+            ids=set(ids.split(',')) if ids else None)
+
+        hub = events.get_hub()
+        hub.watch(watcher)
+        backlog = hub.since(watcher, since)
+        if request.accepted_renderer.format == 'sse':
+            response = StreamingHttpResponse(
+                self.stream(hub, watcher, backlog, since),
+                content_type='text/event-stream')
+            response['Cache-Control'] = 'no-cache'
+            # nginx 不缓冲, 事件立即发给客户端
+            response['X-Accel-Buffering'] = 'no'
+            return response
+
+        try:
+            if not backlog:
+                event = watcher.get(timeout)
+                if event is not None:
+                    backlog = [event]
+        finally:
+            hub.unwatch(watcher)
+        cursor = max([since] + [item['ts'] for item in backlog])
+        return Response({'cursor': cursor, 'events': backlog})
+
+    def stream(self, hub, watcher, backlog, since):
+        try:
+            yield 'retry: 3000\n\n'
+            for event in backlog:
+                since = event['ts']
+                yield container_event(event)
+            while True:
+                event = watcher.get(KEEPALIVE)
+                if event is None:
+                    yield ': keepalive\n\n'
+                elif event['ts'] > since:
+                    yield container_event(event)
+        finally:
+            hub.unwatch(watcher)
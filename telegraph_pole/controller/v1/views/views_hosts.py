@@ -6,6 +6,13 @@ from django import http
 
 from apphome.models import Host
 
+from filters import Field
+from filters import integer
+from filters import FilterSpec
+from filters import FilterError
+from pagination import paginate
+from pagination import PageError
+from serializers import parse_fields
 from serializers import HostSerializer
 
 from rest_framework import status
@@ -25,33 +32,63 @@ class HostView(APIView):
         - GET /hosts/?ip=192.168.8.1&port=2375& ...... HTTP/1.1
 
     Query Parameters:
-        ip port image status total_cpu total_mem
-        total_sys_disk total_volume total_bandwidth
+        只能按有索引的字段过滤, 见 filters, 其他参数返回 400:
+
+        id:       exact in gte lte
+        ip:       exact in
+        port:     exact in, 只能和 ip 一起使用
+        ordering: id
+
+        limit cursor: 按 id 分页, 见 pagination, 下一页和上一页在 Link 头中
+        fields: 只返回哪些字段, 例如 fields=id,ip,port, 只从数据库读取这些列
 
     Status Codes:
         200 - no error
-        404 - no such container
+        400 - bad filter, limit or cursor
+        404 - no such host
         500 - server error
     """
 
+    filters = FilterSpec({
+        'id': Field(('exact', 'in', 'gte', 'lte'), parse=integer),
+        'ip': Field(),
+        # (ip, port) 组合索引
+        'port': Field(requires='ip'),
+    })
+
     def get(self, request, format=None):
-        # 如果有 url 参数
-        if request.GET:
-            # 从数据库中过滤相应的对象
-            hosts = Host.objects.all()
-            kwargs = request.GET.dict()
-            hosts = hosts.filter(**kwargs)
-
-            # 如果没有过滤出，或者参数传递错误，返回 404
-            if not hosts:
-                raise http.Http404
-
-        # 没有 url 参数，就返回所有的 host
-        else:
-            hosts = Host.objects.all()
-
-        serializer = HostSerializer(hosts, many=True)
-        return response.Response(serializer.data)
+        try:
+            kwargs, ordering = self.filters.compile(request.GET)
+        except FilterError, e:
+            return response.Response({'detail': str(e)},
+                                     status=status.HTTP_400_BAD_REQUEST)
+
+        # 如果有 url 参数, 从数据库中过滤相应的对象
+        hosts = Host.objects.filter(**kwargs)
+        if ordering:
+            hosts = hosts.order_by(*ordering)
+
+        # 只读取需要输出的列
+        try:
+            fields = parse_fields(request, HostSerializer)
+        except ValueError, e:
+            return response.Response({'detail': str(e)},
+                                     status=status.HTTP_400_BAD_REQUEST)
+        if fields:
+            hosts = hosts.only(*fields)
+
+        try:
+            hosts, headers = paginate(request, hosts)
+        except PageError, e:
+            return response.Response({'detail': str(e)},
+                                     status=status.HTTP_400_BAD_REQUEST)
+
+        # 如果没有过滤出，或者参数传递错误，返回 404
+        if kwargs and not hosts:
+            raise http.Http404
+
+        serializer = HostSerializer(hosts, many=True, fields=fields)
+        return response.Response(serializer.data, headers=headers)
 
 
 class HostCreateView(APIView):
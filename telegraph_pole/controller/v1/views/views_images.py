@@ -5,6 +5,13 @@
 from django import http
 from apphome.models import Image
 
+from filters import Field
+from filters import integer
+from filters import FilterSpec
+from filters import FilterError
+from pagination import paginate
+from pagination import PageError
+from serializers import parse_fields
 from serializers import ImageSerializer
 
 from rest_framework import status
@@ -24,34 +31,65 @@ class ImageView(APIView):
         - GET /images/?iid=0a8fb585b&repository=ubuntu&tag=12.04 ... HTTP/1.1
 
     Query Parameters:
-        iid tag created repository virtual_size
-        os_type os_version
+        只能按有索引的字段过滤, 见 filters, 其他参数返回 400:
+
+        id:         exact in gte lte
+        iid:        exact in
+        repository: exact in
+        tag:        exact in, 只能和 repository 一起使用
+        ordering:   id
+
+        limit cursor: 按 id 分页, 见 pagination, 下一页和上一页在 Link 头中
+        fields: 只返回哪些字段, 例如 fields=id,repository,tag, 只从数据库读取这些列
 
     Status Codes:
         200 - no error
+        400 - bad filter, limit or cursor
         404 - no such image
         500 - server error
     """
 
+    filters = FilterSpec({
+        'id': Field(('exact', 'in', 'gte', 'lte'), parse=integer),
+        'iid': Field(),
+        'repository': Field(),
+        # (repository, tag) 组合索引
+        'tag': Field(requires='repository'),
+    })
+
     def get(self, request, format=None):
+        try:
+            kwargs, ordering = self.filters.compile(request.GET)
+        except FilterError, e:
+            return response.Response({'detail': str(e)},
+                                     status=status.HTTP_400_BAD_REQUEST)
 
-        # 如果有 url 参数
-        if request.GET:
-            # 从数据库中过滤相应的对象
-            images = Image.objects.all()
-            kwargs = request.GET.dict()
-            images = images.filter(**kwargs)
+        # 如果有 url 参数, 从数据库中过滤相应的对象
+        images = Image.objects.filter(**kwargs)
+        if ordering:
+            images = images.order_by(*ordering)
 
-            # 如果没有过滤出，或者参数传递错误，返回 404
-            if not images:
-                raise http.Http404
+        # 只读取需要输出的列
+        try:
+            fields = parse_fields(request, ImageSerializer)
+        except ValueError, e:
+            return response.Response({'detail': str(e)},
+                                     status=status.HTTP_400_BAD_REQUEST)
+        if fields:
+            images = images.only(*fields)
 
-        # 没有 url 参数，就返回所有的 Image
-        else:
-            images = Image.objects.all()
+        try:
+            images, headers = paginate(request, images)
+        except PageError, e:
+            return response.Response({'detail': str(e)},
+                                     status=status.HTTP_400_BAD_REQUEST)
 
-        serializer = ImageSerializer(images, many=True)
-        return response.Response(serializer.data)
+        # 如果没有过滤出，或者参数传递错误，返回 404
+        if kwargs and not images:
+            raise http.Http404
+
+        serializer = ImageSerializer(images, many=True, fields=fields)
+        return response.Response(serializer.data, headers=headers)
 
 
 class ImageCreateView(APIView):
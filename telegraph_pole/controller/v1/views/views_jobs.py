@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Longgeek <longgeek@gmail.com>
+
+from django.http import Http404
+from apphome.models import Job
+from serializers import JobSerializer
+
+from rest_framework.views import APIView
+from rest_framework.response import Response
+from telegraph_pole.lib import jobs
+
+
+class JobDetailView(APIView):
+    """查询异步操作的状态和结果
+
+    Info:
+        GET /jobs/(id) HTTP/1.1
+        Content-Type: application/json
+
+    Example request:
+        GET /jobs/12 HTTP/1.1
+
+    Status Codes:
+        200 - Success, no error
+        404 - Failure, job not found
+
+    Results: JSON
+        Success:
+            {
+                "id": 12,
+                "status": "success",  # pending/success/error/timeout
+                "detail": "",
+                "result": {"cid": "bda51967884c..."},
+                "created": "2015-03-20T08:01:26.152Z",
+                "deadline": "2015-03-20T08:02:56.152Z",
+                "finished": "2015-03-20T08:01:31.870Z",
+                "message_type": "restart_container",
+                "container_id": "3"
+            }
+        Failure:
+            {"detail": STRING}
+    """
+
+    def get_object(self, id):
+        try:
+            return Job.objects.get(id=id)
+        except Job.DoesNotExist:
+            raise Http404
+
+    def get(self, request, id, format=None):
+        job = jobs.expire(self.get_object(id))
+        return Response(JobSerializer(job).data)
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Longgeek <longgeek@gmail.com>
+
+from django.http import HttpResponse
+
+from rest_framework.views import APIView
+
+from telegraph_pole.lib import metrics
+
+
+class MetricsView(APIView):
+    """scheduler RPC 的统计, Prometheus 文本格式
+
+    只供内部抓取, nginx 中禁止外部访问.
+
+    Info:
+        GET /metrics HTTP/1.1
+
+    Example request:
+        GET /metrics HTTP/1.1
+
+    Status Codes:
+        200 - Success, no error
+
+    Results: text/plain
+        telegraph_pole_rpc_duration_seconds  - 发出到收到返回的延迟
+        telegraph_pole_rpc_request_bytes     - 请求的字节数
+        telegraph_pole_rpc_response_bytes    - 返回的字节数
+        telegraph_pole_rpc_total             - 按结果统计的请求数
+        telegraph_pole_rpc_in_flight         - 正在等待返回的请求数
+    """
+
+    def get(self, request, format=None):
+        return HttpResponse(metrics.render(),
+                            content_type='text/plain; version=0.0.4')
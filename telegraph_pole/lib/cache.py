@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Longgeek <longgeek@gmail.com>
+
+"""只读 scheduler RPC 的返回缓存
+
+前端会不停地轮询 inspect, top 和 files/list, 这些请求的返回在
+几秒内可以直接复用. 缓存按 容器 id + message_type + 其它参数 作 key,
+每种 message_type 有自己的过期时间, 只缓存 status 为 0 的返回.
+
+每个容器在 Redis 中有一个代数(generation), 缓存的值带着写入时的代数,
+代数不一致就视为没有命中. 对同一个容器的修改操作(stop, start,
+files/write 等)完成之后把代数加一, 所有 worker 中该容器的缓存立即失效,
+不需要逐个删除 key.
+
+get 返回的 lookup 同时用于 lib/mq 合并相同的只读请求, key 中包含
+代数, 修改之后发出的请求不会和修改之前的请求合并.
+
+worker 进程内还有一个小的 LRU, 先用一次 GET 读取代数, 代数一致时
+直接使用进程内的值, 不用再从 Redis 读取整个返回. Redis 不可用时
+不使用缓存, 直接请求 scheduler.
+"""
+
+import time
+import hashlib
+import simplejson
+import collections
+
+import redis
+
+from telegraph_pole import settings
+from telegraph_pole.lib.redis_client import get_redis
+from telegraph_pole.lib.redis_client import mark_down
+
+
+ENABLED = getattr(settings, 'RPC_CACHE_ENABLED', True)
+
+# 只读 message_type 的缓存时间(秒), 0 表示不缓存
+TTLS = {
+    'top_container': 2,
+    'inspect_container': 2,
+    'files_list_container': 5,
+}
+TTLS.update(getattr(settings, 'RPC_CACHE_TTLS', {}))
+
+# 只读的 message_type, 可以缓存和合并
+READ_ONLY = frozenset([
+    'top_container',
+    'inspect_container',
+    'files_list_container',
+    'files_read_container',
+])
+
+# 会修改容器状态的 message_type, 完成之后使该容器的缓存失效
+INVALIDATES = frozenset([
+    'stop_container',
+    'start_container',
+    'restart_container',
+    'pause_container',
+    'unpause_container',
+    'delete_container',
+    'exec_container',
+    'files_write_container',
+    'files_upload_container',
+    'archive_import_container',
+    'files_delete_container',
+    'dirs_create_container',
+    'dirs_delete_container',
+])
+
+# 进程内 LRU 的最大条目数
+LOCAL_SIZE = getattr(settings, 'RPC_CACHE_LOCAL_SIZE', 1024)
+
+KEY_PREFIX = 'telegraph_pole:rpc:'
+
+# 代数 key 的过期时间(秒), 远大于缓存时间即可
+GENERATION_TTL = 86400
+
+# 缓存 key -> (过期时间, 代数, 返回的 JSON), 按最近使用排序
+_local = collections.OrderedDict()
+
+
+def _key(message):
+    """(容器 id, 缓存 key), 不是只读的消息返回 (None, None)"""
+    message_type = message.get('message_type')
+    if message_type not in READ_ONLY or 'id' not in message:
+        return None, None
+    args = dict((k, v) for k, v in message.items()
+                if k not in ('id', 'message_type'))
+    digest = hashlib.sha1(simplejson.dumps(args, sort_keys=True)).hexdigest()
+    id = str(message['id'])
+    return id, '%s%s:%s:%s' % (KEY_PREFIX, id, message_type, digest)
+
+
+def _generation_key(id):
+    return '%sgen:%s' % (KEY_PREFIX, id)
+
+
+def get(message):
+    """查询缓存
+
+    Params:
+        message: dict; 消息内容
+
+    Return:
+        (lookup, result)
+
+        lookup 为 None 表示不是只读的消息, 否则为 (key, 代数, 缓存时间),
+        Redis 不可用时代数为 None. 没有命中时 result 为 None,
+        收到返回之后把 lookup 传给 set.
+    """
+    id, key = _key(message)
+    if key is None:
+        return None, None
+    conn = get_redis()
+    if conn is None:
+        return (key, None, 0), None
+    ttl = TTLS.get(message['message_type'], 0) if ENABLED else 0
+    try:
+        generation = int(conn.get(_generation_key(id)) or 0)
+        lookup = (key, generation, ttl)
+        if not ttl:
+            return lookup, None
+
+        entry = _local.pop(key, None)
+        if entry is not None and entry[0] > time.time() \
+                and entry[1] == generation:
+            _local[key] = entry
+            return lookup, tuple(simplejson.loads(entry[2]))
+
+        value = conn.get(key)
+    except redis.RedisError, e:
+        mark_down(e)
+        return (key, None, 0), None
+    if value is None:
+        return lookup, None
+    cached_generation, expires, data = value.split(':', 2)
+    if int(cached_generation) != generation:
+        return lookup, None
+    _store(key, generation, float(expires), data)
+    return lookup, tuple(simplejson.loads(data))
+
+
+def set(lookup, result):
+    """写入缓存, 只缓存 status 为 0 的返回
+
+    写入的值带着请求之前读到的代数, 请求期间容器被修改过的话
+    代数已经变了, 这个值不会被使用.
+    """
+    if lookup is None or not lookup[2] or result[0] != 0:
+        return
+    key, generation, ttl = lookup
+    data = simplejson.dumps(result)
+    expires = time.time() + ttl
+    conn = get_redis()
+    if conn is None:
+        return
+    try:
+        conn.setex(key, ttl, '%d:%.3f:%s' % (generation, expires, data))
+    except redis.RedisError, e:
+        mark_down(e)
+        return
+    _store(key, generation, expires, data)
+
+
+def _store(key, generation, expires, data):
+    _local.pop(key, None)
+    _local[key] = (expires, generation, data)
+    while len(_local) > LOCAL_SIZE:
+        _local.popitem(last=False)
+
+
+def invalidate(message):
+    """修改操作之后使该容器的缓存失效"""
+    if message.get('message_type') not in INVALIDATES or 'id' not in message:
+        return
+    conn = get_redis()
+    if conn is None:
+        return
+    key = _generation_key(str(message['id']))
+    try:
+        pipe = conn.pipeline()
+        pipe.incr(key)
+        pipe.expire(key, GENERATION_TTL)
+        pipe.execute()
+    except redis.RedisError, e:
+        mark_down(e)
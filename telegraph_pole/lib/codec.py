@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Longgeek <longgeek@gmail.com>
+
+"""scheduler 消息的编码
+
+消息体的格式由 AMQP 的 content_type 决定, 压缩方式由 content_encoding
+决定. 发送请求时在 headers 中带上 accept 和 accept-encoding, 告诉
+scheduler 可以用哪些格式返回; 返回消息按它自己的 content_type 和
+content_encoding 解码, 没有设置的按 JSON 处理, 兼容旧的 scheduler.
+"""
+
+import zlib
+import simplejson
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+from telegraph_pole import settings
+
+
+JSON = 'application/json'
+MSGPACK = 'application/x-msgpack'
+OCTET_STREAM = 'application/octet-stream'
+
+# 请求使用的格式, 使用 msgpack 之前要确认 scheduler 已经支持
+CONTENT_TYPE = getattr(settings, 'RABBITMQ_CONTENT_TYPE', JSON)
+
+# 请求使用的压缩方式: None, zlib, lz4
+CONTENT_ENCODING = getattr(settings, 'RABBITMQ_CONTENT_ENCODING', None)
+
+# 消息体超过这个字节数才压缩
+COMPRESS_THRESHOLD = getattr(settings, 'RABBITMQ_COMPRESS_THRESHOLD', 16384)
+
+
+class CodecError(Exception):
+    """不支持的格式或者压缩方式"""
+
+
+def _msgpack_dumps(obj):
+    return msgpack.packb(obj, use_bin_type=True)
+
+
+def _msgpack_loads(body):
+    return msgpack.unpackb(body, raw=False)
+
+
+# content_type -> (dumps, loads)
+SERIALIZERS = {
+    JSON: (simplejson.dumps, simplejson.loads),
+}
+if msgpack is not None:
+    SERIALIZERS[MSGPACK] = (_msgpack_dumps, _msgpack_loads)
+
+# content_encoding -> (compress, decompress)
+COMPRESSORS = {
+    'zlib': (zlib.compress, zlib.decompress),
+}
+if lz4 is not None:
+    COMPRESSORS['lz4'] = (lz4.frame.compress, lz4.frame.decompress)
+
+
+def accept_headers():
+    """告诉 scheduler 返回消息可以使用的格式和压缩方式, 优先的在前"""
+    types = [t for t in (MSGPACK, JSON) if t in SERIALIZERS]
+    encodings = [e for e in ('lz4', 'zlib') if e in COMPRESSORS]
+    return {'accept': ', '.join(types),
+            'accept-encoding': ', '.join(encodings)}
+
+
+def encode(obj, content_type=None, content_encoding=None,
+           threshold=None):
+    """编码消息
+
+    Params:
+        obj:              消息内容
+        content_type:     str; 格式, 默认 RABBITMQ_CONTENT_TYPE
+        content_encoding: str; 压缩方式, 默认 RABBITMQ_CONTENT_ENCODING
+        threshold:        int; 超过多少字节才压缩
+
+    Return:
+        (body, properties)  # properties 为 BasicProperties 的参数
+    """
+    content_type = content_type or CONTENT_TYPE
+    content_encoding = content_encoding or CONTENT_ENCODING
+    if threshold is None:
+        threshold = COMPRESS_THRESHOLD
+    if content_type not in SERIALIZERS:
+        raise CodecError('Unsupported content type: %s' % content_type)
+
+    body = SERIALIZERS[content_type][0](obj)
+    properties = {'content_type': content_type,
+                  'headers': accept_headers()}
+
+    if content_encoding and len(body) > threshold:
+        if content_encoding not in COMPRESSORS:
+            raise CodecError('Unsupported content encoding: %s' %
+                             content_encoding)
+        body = COMPRESSORS[content_encoding][0](body)
+        properties['content_encoding'] = content_encoding
+    return (body, properties)
+
+
+def encode_data(message, data, content_encoding=None, threshold=None):
+    """编码带原始字节的消息(例如上传的文件内容)
+
+    body 为原始字节, 消息内容按 JSON 放在 headers 的 message 中,
+    文件内容不需要 base64 也不需要序列化进 JSON.
+
+    Return:
+        (body, properties)
+    """
+    content_encoding = content_encoding or CONTENT_ENCODING
+    if threshold is None:
+        threshold = COMPRESS_THRESHOLD
+    headers = accept_headers()
+    headers['message'] = simplejson.dumps(message)
+    properties = {'content_type': OCTET_STREAM, 'headers': headers}
+
+    if content_encoding and len(data) > threshold:
+        if content_encoding not in COMPRESSORS:
+            raise CodecError('Unsupported content encoding: %s' %
+                             content_encoding)
+        data = COMPRESSORS[content_encoding][0](data)
+        properties['content_encoding'] = content_encoding
+    return (data, properties)
+
+
+def decompress(body, content_encoding=None):
+    """只解压, 用于原始字节的消息(例如流式返回的输出)"""
+    if content_encoding:
+        if content_encoding not in COMPRESSORS:
+            raise CodecError('Unsupported content encoding: %s' %
+                             content_encoding)
+        body = COMPRESSORS[content_encoding][1](body)
+    return body
+
+
+def decode(body, content_type=None, content_encoding=None):
+    """解码消息, 没有 content_type 的按 JSON 处理"""
+    body = decompress(body, content_encoding)
+    content_type = content_type or JSON
+    if content_type not in SERIALIZERS:
+        raise CodecError('Unsupported content type: %s' % content_type)
+    return SERIALIZERS[content_type][1](body)
+
+
+def decode_reply(props, body):
+    """按返回消息的属性解码"""
+    return decode(body, props.content_type, props.content_encoding)
+
+
+def decode_request(props, body):
+    """按请求消息的属性解码(scheduler 一侧), 原始字节放在 data 中"""
+    if props.content_type == OCTET_STREAM:
+        message = simplejson.loads((props.headers or {})['message'])
+        message['data'] = decompress(body, props.content_encoding)
+        return message
+    return decode_reply(props, body)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Longgeek <longgeek@gmail.com>
+
+"""Docker 返回的时间, 大小和状态字符串与数据库类型之间的转换
+
+数据库中 Container.created 为 datetime, Container.size 和
+Image.virtual_size 为字节数, Container.state 为枚举的状态; 接口仍然
+输出原来的字符串:
+
+    created:       "1417874473"         <-> datetime(2014, 12, 6, 14, 1, 13)
+    size:          "2.5 kB" / "2500"    ->  2500, 输出 "2500"
+    status:        "Up 36 minutes"      ->  state "running"
+
+无法解析的值抛出 ValueError.
+"""
+
+import re
+import calendar
+import datetime
+
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+
+# docker 的 HumanSize 用 1000 进制, BytesSize 用 1024 进制
+SIZE_UNITS = {
+    '': 1, 'b': 1,
+    'k': 1000, 'kb': 1000, 'kib': 1024,
+    'm': 1000 ** 2, 'mb': 1000 ** 2, 'mib': 1024 ** 2,
+    'g': 1000 ** 3, 'gb': 1000 ** 3, 'gib': 1024 ** 3,
+    't': 1000 ** 4, 'tb': 1000 ** 4, 'tib': 1024 ** 4,
+}
+
+# "2.5 kB", "188MB", 以及 docker ps -s 的 "0 B (virtual 188 MB)"
+SIZE_RE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([a-zA-Z]*)\s*(?:\(.*\))?\s*$')
+
+# 按顺序匹配 docker ps 的 Status
+STATE_PATTERNS = (
+    (re.compile(r'^Up .*\(Paused\)'), 'paused'),
+    (re.compile(r'^Up\b'), 'running'),
+    (re.compile(r'^Restarting\b'), 'restarting'),
+    (re.compile(r'^Exited\b'), 'exited'),
+    (re.compile(r'^Created\b'), 'created'),
+    (re.compile(r'^Removal In Progress'), 'removing'),
+    (re.compile(r'^Dead\b'), 'dead'),
+)
+
+
+def parse_created(value):
+    """时间戳("1417874473", 1417874473), "2014-12-06 22:01:13" 或者
+    ISO 8601 转换为 aware datetime, 空值返回 None
+
+    没有时区的时间按 settings.TIME_ZONE 处理.
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, datetime.datetime):
+        dt = value
+    elif isinstance(value, bool) or \
+            not isinstance(value, (int, long, float, basestring)):
+        raise ValueError('Invalid created: %r' % value)
+    elif not isinstance(value, basestring) or \
+            re.match(r'^\s*\d+(\.\d+)?\s*$', value):
+        return datetime.datetime.fromtimestamp(float(value), timezone.utc)
+    else:
+        dt = parse_datetime(value.strip())
+        if dt is None:
+            raise ValueError('Invalid created: %r' % value)
+    if timezone.is_naive(dt):
+        dt = timezone.make_aware(dt, timezone.get_default_timezone())
+    return dt
+
+
+def format_created(value):
+    """datetime 转换为时间戳字符串, 和之前接口中的格式一致"""
+    if value is None:
+        return None
+    return str(calendar.timegm(value.utctimetuple()))
+
+
+def parse_size(value):
+    """字节数或者带单位的大小转换为字节数(int), 空值返回 None"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool) or \
+            not isinstance(value, (int, long, float, basestring)):
+        raise ValueError('Invalid size: %r' % value)
+    if not isinstance(value, basestring):
+        number, unit = value, ''
+    else:
+        match = SIZE_RE.match(value)
+        if not match or match.group(2).lower() not in SIZE_UNITS:
+            raise ValueError('Invalid size: %r' % value)
+        number, unit = float(match.group(1)), match.group(2)
+    if number < 0:
+        raise ValueError('Invalid size: %r' % value)
+    return int(round(number * SIZE_UNITS[unit.lower()]))
+
+
+def format_size(value):
+    if value is None:
+        return None
+    return str(value)
+
+
+def parse_state(status):
+    """docker ps 的 Status 对应的状态, 无法识别时返回 unknown"""
+    if status:
+        for pattern, state in STATE_PATTERNS:
+            if pattern.match(status):
+                return state
+    return 'unknown'
@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Longgeek <longgeek@gmail.com>
+
+"""容器状态变化的事件
+
+事件来自两处, 都发送到 AMQP fanout exchange(EXCHANGE):
+    - scheduler 对修改容器的消息(stop, start, ...)的返回, 见 mq.rpc_completed
+    - Container 的保存和删除(post_save/post_delete)
+
+每个 worker 进程有一个 Hub, 用一个后台线程(gevent 下是 greenlet)
+消费绑定到 exchange 的独占队列, 把事件分发给本进程中的 Watcher,
+并在内存中保留最近 BUFFER_SIZE 个事件, 用于长轮询和 SSE 断线重连
+时补发. 等待中的 Watcher 只是一个挂起的 greenlet 和一个队列,
+不占用数据库和 scheduler.
+
+事件格式:
+    {
+        "ts": 1426838486.152,    # 发生时间, 同时作为游标
+        "id": "3",               # 容器 id
+        "user_id": "2",
+        "event": "stop_container",  # message_type 或者 saved/deleted
+        "ok": true,
+        "status": "Exited (0) 2 seconds ago",  # 只有 saved 有
+        "state": "exited",       # 只有 saved 有, 见 Container.STATES
+        "detail": ""
+    }
+"""
+
+import os
+import time
+import Queue
+import logging
+import threading
+import collections
+
+from django.db.models.signals import post_save
+from django.db.models.signals import post_delete
+
+from apphome.models import Container
+from telegraph_pole import settings
+from telegraph_pole.lib import mq
+from telegraph_pole.lib import cache
+from telegraph_pole.lib import codec
+
+
+LOG = logging.getLogger(__name__)
+
+ENABLED = getattr(settings, 'EVENTS_ENABLED', True)
+
+# 事件的 fanout exchange
+EXCHANGE = getattr(settings, 'EVENTS_EXCHANGE', 'telegraph_pole.events')
+
+# 每个 worker 保留的最近事件数
+BUFFER_SIZE = getattr(settings, 'EVENTS_BUFFER_SIZE', 1000)
+
+# Watcher 队列的最大长度, 消费太慢的 Watcher 丢弃多出的事件
+WATCHER_QUEUE_SIZE = 100
+
+# Hub 连接断开之后重连的间隔(秒)
+RECONNECT_INTERVAL = 3
+
+# 发送失败之后这段时间(秒)内的事件直接丢弃, RabbitMQ 不可用时
+# Container.save() 等不会每次都等待连接超时
+PUBLISH_RETRY_INTERVAL = getattr(settings, 'EVENTS_PUBLISH_RETRY_INTERVAL',
+                                 10)
+
+# 缓存的容器 id -> user_id 的个数
+OWNERS_SIZE = 10000
+
+# 每个进程只需要声明一次 exchange
+_declared = [None]
+
+# 在这个时间之前不再尝试发送
+_retry_at = [0]
+
+# 容器 id -> user_id, 容器的用户不会改变, 修改容器的 RPC 完成时
+# 不需要每次都查询数据库. 由 Container 的保存和收到的事件填充
+_owners = collections.OrderedDict()
+_owners_lock = threading.Lock()
+
+
+def declare_exchange(channel):
+    channel.exchange_declare(exchange=EXCHANGE, exchange_type='fanout')
+
+
+def _ensure_exchange():
+    # 用 mq 的 Multiplexer/Pool 中已有的连接声明
+    if _declared[0] == os.getpid():
+        return
+    mq.declare_exchange(EXCHANGE, 'fanout')
+    _declared[0] = os.getpid()
+
+
+def publish(event):
+    """发送事件, 失败只记录日志, 不影响触发事件的请求"""
+    if not ENABLED or time.time() < _retry_at[0]:
+        return
+    event.setdefault('ts', time.time())
+    try:
+        _ensure_exchange()
+        mq.broadcast(EXCHANGE, event)
+    except (mq.RPCError,) + mq.CONNECTION_ERRORS, e:
+        LOG.warning('Can not publish container event: %s, dropping events '
+                    'for %ss' % (e, PUBLISH_RETRY_INTERVAL))
+        _retry_at[0] = time.time() + PUBLISH_RETRY_INTERVAL
+
+
+def remember_owner(id, user_id):
+    if user_id is None:
+        return
+    with _owners_lock:
+        _owners.pop(id, None)
+        _owners[id] = user_id
+        if len(_owners) > OWNERS_SIZE:
+            _owners.popitem(last=False)
+
+
+def get_owner(id):
+    """容器的 user_id, 没有缓存时才查询数据库"""
+    user_id = _owners.get(id)
+    if user_id is None:
+        user_id = Container.objects.filter(id=id).values_list(
+            'user_id', flat=True).first()
+        remember_owner(id, user_id)
+    return user_id
+
+
+def on_rpc_completed(sender, message, result, **kwargs):
+    """修改容器的消息收到返回之后发送事件"""
+    if message.get('message_type') not in cache.INVALIDATES or \
+            'id' not in message:
+        return
+    # 分段上传只在最后一段完成之后发送一次
+    if message.get('final') is False:
+        return
+    id = str(message['id'])
+    s, m, r = result
+    publish({'id': id,
+             'user_id': get_owner(id),
+             'event': message['message_type'],
+             'ok': s == 0,
+             'detail': m if s != 0 else ''})
+
+
+def on_container_saved(sender, instance, **kwargs):
+    remember_owner(str(instance.id), instance.user_id)
+    publish({'id': str(instance.id),
+             'user_id': instance.user_id,
+             'event': 'saved',
+             'ok': True,
+             'status': instance.status,
+             'state': instance.state,
+             'create_status': instance.create_status})
+
+
+def on_container_deleted(sender, instance, **kwargs):
+    publish({'id': str(instance.id),
+             'user_id': instance.user_id,
+             'event': 'deleted',
+             'ok': True})
+
+
+def connect_signals():
+    """注册事件来源, 由 apphome 的 AppConfig.ready 调用"""
+    mq.rpc_completed.connect(on_rpc_completed,
+                             dispatch_uid='events.rpc_completed')
+    post_save.connect(on_container_saved, sender=Container,
+                      dispatch_uid='events.container_saved')
+    post_delete.connect(on_container_deleted, sender=Container,
+                        dispatch_uid='events.container_deleted')
+
+
+class Watcher(object):
+    """一个等待事件的客户端
+
+    Params:
+        user_id: str;  只接收该用户的容器的事件
+        ids:     set;  只接收这些容器的事件
+    """
+
+    def __init__(self, user_id=None, ids=None):
+        self.user_id = user_id
+        self.ids = ids
+        self.queue = Queue.Queue(WATCHER_QUEUE_SIZE)
+
+    def match(self, event):
+        if self.user_id is not None and event.get('user_id') != self.user_id:
+            return False
+        if self.ids and event.get('id') not in self.ids:
+            return False
+        return True
+
+    def put(self, event):
+        if self.match(event):
+            try:
+                self.queue.put_nowait(event)
+            except Queue.Full:
+                pass
+
+    def get(self, timeout):
+        """等待下一个事件, 超时返回 None"""
+        try:
+            return self.queue.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+
+class Hub(object):
+    """worker 进程内的事件分发"""
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.watchers = set()
+        self.buffer = collections.deque(maxlen=BUFFER_SIZE)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def _run(self):
+        try:
+            while True:
+                conn = None
+                try:
+                    conn = mq.open_connection()
+                    channel = conn.channel()
+                    declare_exchange(channel)
+                    queue = channel.queue_declare(
+                        exclusive=True).method.queue
+                    channel.queue_bind(queue=queue, exchange=EXCHANGE)
+                    channel.basic_consume(self.on_event, queue=queue,
+                                          no_ack=True)
+                    while True:
+                        conn.process_data_events(time_limit=None)
+                except mq.CONNECTION_ERRORS, e:
+                    LOG.warning('Event subscriber lost RabbitMQ connection: '
+                                '%s, reconnecting' % e)
+                except Exception:
+                    # 其它错误也不能让订阅线程退出, 否则所有 Watcher
+                    # 都不会再收到事件
+                    LOG.exception('Event subscriber failed, restarting')
+                # 只是 channel 出错时连接还打开着, 重连之前关闭
+                self._close(conn)
+                time.sleep(RECONNECT_INTERVAL)
+        finally:
+            # 线程意外退出时, 下一次 watch 重新启动
+            with self.lock:
+                self.thread = None
+
+    def _close(self, conn):
+        if conn is None:
+            return
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def on_event(self, ch, method, props, body):
+        try:
+            event = codec.decode(body, props.content_type,
+                                 props.content_encoding)
+        except (codec.CodecError, ValueError), e:
+            LOG.warning('Invalid container event: %s' % e)
+            return
+        if 'id' in event:
+            remember_owner(event['id'], event.get('user_id'))
+        self.buffer.append(event)
+        for watcher in list(self.watchers):
+            watcher.put(event)
+
+    def since(self, watcher, ts):
+        """保留的事件中 ts 之后并且匹配 watcher 的事件"""
+        return [event for event in list(self.buffer)
+                if event.get('ts', 0) > ts and watcher.match(event)]
+
+    def watch(self, watcher):
+        self.start()
+        self.watchers.add(watcher)
+
+    def unwatch(self, watcher):
+        self.watchers.discard(watcher)
+
+
+_hub = None
+
+
+def get_hub():
+    """当前 worker 进程的 Hub, fork 之后重新创建"""
+    global _hub
+    if _hub is None or _hub.pid != os.getpid():
+        _hub = Hub()
+    return _hub
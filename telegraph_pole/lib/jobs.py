@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Longgeek <longgeek@gmail.com>
+
+"""异步执行的容器操作
+
+创建, 启动, 停止, 重启和删除容器需要 scheduler 操作 Docker, 每次可能
+要等很多秒. 异步模式下视图只写入一条 Job 记录并发送消息, 立即返回
+202 和 job id, 不再占用 gunicorn worker 等待返回.
+
+scheduler 把返回消息发到持久化的 JOB_QUEUE 队列, correlation_id 为
+"job:<id>". consume 在独立的进程中消费该队列(manage.py consume_jobs),
+更新 Job 记录之后才 ack, 进程重启不会丢失返回消息.
+
+批量执行(submit_batch)把一组消息写成 queued 状态的 Job, 同一个
+batch 最多 BATCH_CONCURRENCY 个同时等待返回. 每收到一个返回就从
+队列中补发下一个, 不需要有进程一直等着整个 batch 执行完.
+"""
+
+import os
+import time
+import uuid
+import logging
+import datetime
+import simplejson
+
+from django.db import close_old_connections
+from django.utils import timezone
+
+from apphome.models import Job
+from telegraph_pole import settings
+from telegraph_pole.lib import mq
+from telegraph_pole.lib import cache
+from telegraph_pole.lib import codec
+
+
+LOG = logging.getLogger(__name__)
+
+# 接收异步操作返回消息的队列
+JOB_QUEUE = getattr(settings, 'RPC_JOB_QUEUE', 'telegraph_pole_jobs')
+
+CORRELATION_PREFIX = 'job:'
+
+# 一个 batch 中同时等待返回的 Job 数
+BATCH_CONCURRENCY = getattr(settings, 'JOB_BATCH_CONCURRENCY', 20)
+
+# consume 连接断开之后重连的间隔(秒)
+RECONNECT_INTERVAL = 3
+
+# consume 检查超时的 Job 和补发 batch 的间隔(秒)
+SWEEP_INTERVAL = getattr(settings, 'JOB_SWEEP_INTERVAL', 5)
+
+# 每个进程只需要声明一次队列
+_declared = [None]
+
+
+def declare_queue(channel):
+    """声明持久化的返回队列, scheduler 返回时队列必须已经存在"""
+    channel.queue_declare(queue=JOB_QUEUE, durable=True)
+
+
+def _ensure_queue():
+    if _declared[0] == os.getpid():
+        return
+    try:
+        conn = mq.open_connection()
+        try:
+            declare_queue(conn.channel())
+        finally:
+            conn.close()
+    except mq.CONNECTION_ERRORS, e:
+        LOG.error('Can not connect to RabbitMQ: %s' % e)
+        raise mq.RPCUnavailable()
+    _declared[0] = os.getpid()
+
+
+def submit(message, timeout=None):
+    """发送消息并创建 Job, 不等待返回
+
+    Params:
+        message: dict; 消息内容, 包含 message_type
+        timeout: int;  等待返回的秒数, 默认根据 message_type 获取
+
+    Return:
+        Job
+
+    无法连接抛出 RPCUnavailable(503), 此时 Job 状态为 error.
+    """
+    if timeout is None:
+        timeout = mq.get_timeout(message)
+    container_id = message.get('id')
+    job = Job.objects.create(
+        message_type=message['message_type'],
+        container_id=str(container_id) if container_id else None,
+        deadline=timezone.now() + datetime.timedelta(seconds=timeout))
+    try:
+        _ensure_queue()
+        mq.send_async(message, JOB_QUEUE,
+                      '%s%d' % (CORRELATION_PREFIX, job.id), timeout)
+    except mq.RPCError, e:
+        finish(job.id, 'error', e.detail)
+        raise
+    return job
+
+
+def submit_batch(messages):
+    """创建一组排队的 Job 并开始发送, 不等待返回
+
+    Params:
+        messages: list; 消息列表, 每个消息包含 message_type 和 id
+
+    Return:
+        batch id, 用 batch_jobs 查询
+    """
+    batch = uuid.uuid4().hex
+    now = timezone.now()
+    Job.objects.bulk_create([
+        Job(message_type=message['message_type'],
+            container_id=str(message['id']),
+            status='queued',
+            batch=batch,
+            message=simplejson.dumps(message),
+            # 发送时重新计算
+            deadline=now + datetime.timedelta(
+                seconds=mq.get_timeout(message)))
+        for message in messages])
+    dispatch(batch)
+    return batch
+
+
+def dispatch(batch):
+    """发送 batch 中排队的 Job, 补足 BATCH_CONCURRENCY 个
+
+    用条件 update 认领 queued 的 Job, 多个进程同时调用时同一个 Job
+    只会发送一次. 无法连接时 Job 放回 queued 并停止发送, 下一次
+    dispatch 时重新发送; scheduler 无法处理的消息标记为 error.
+    """
+    free = BATCH_CONCURRENCY - Job.objects.filter(
+        batch=batch, status='pending').count()
+    if free <= 0:
+        return
+    queued = Job.objects.filter(batch=batch, status='queued').order_by(
+        'id').values_list('id', 'message')[:free]
+    for job_id, data in queued:
+        message = simplejson.loads(data)
+        timeout = mq.get_timeout(message)
+        if not Job.objects.filter(id=job_id, status='queued').update(
+                status='pending',
+                deadline=timezone.now() + datetime.timedelta(
+                    seconds=timeout)):
+            continue
+        try:
+            _ensure_queue()
+            mq.send_async(message, JOB_QUEUE,
+                          '%s%d' % (CORRELATION_PREFIX, job_id), timeout)
+        except mq.RPCUnavailable:
+            Job.objects.filter(id=job_id, status='pending').update(
+                status='queued')
+            return
+        except mq.RPCError, e:
+            finish(job_id, 'error', e.detail)
+
+
+def batch_jobs(batch):
+    """batch 中的所有 Job
+
+    超时的标记为 timeout, 并补发排队的 Job, 包括之前因为无法连接
+    放回 queued 的.
+    """
+    Job.objects.filter(
+        batch=batch, status='pending', deadline__lt=timezone.now()).update(
+        status='timeout',
+        detail='Timed out waiting for the scheduler',
+        finished=timezone.now())
+    dispatch(batch)
+    return list(Job.objects.filter(batch=batch).order_by('id'))
+
+
+def finish(job_id, status, detail, result=None):
+    """更新还在等待的 Job, 返回是否更新"""
+    return Job.objects.filter(id=job_id, status='pending').update(
+        status=status,
+        detail=detail,
+        result=None if result is None else simplejson.dumps(result),
+        finished=timezone.now()) > 0
+
+
+def expire(job):
+    """超过 deadline 还没有返回的 Job 标记为 timeout, 返回最新的 Job"""
+    if job.status == 'pending' and job.deadline < timezone.now():
+        finish(job.id, 'timeout', 'Timed out waiting for the scheduler')
+        job = Job.objects.get(id=job.id)
+    return job
+
+
+def on_reply(ch, method, props, body):
+    """处理 scheduler 的返回消息, 更新 Job 之后再 ack
+
+    处理失败的消息只记录日志, 同样 ack, 否则重启之后再次投递,
+    每次都让 consume 退出.
+    """
+    # consume 进程一直运行, 数据库连接可能已经被服务器断开
+    close_old_connections()
+    try:
+        handle_reply(props, body)
+    except Exception:
+        LOG.exception('Can not handle job reply %r' % props.correlation_id)
+    ch.basic_ack(delivery_tag=method.delivery_tag)
+
+
+def handle_reply(props, body):
+    corr_id = props.correlation_id or ''
+    if not corr_id.startswith(CORRELATION_PREFIX):
+        return
+    try:
+        job_id = int(corr_id[len(CORRELATION_PREFIX):])
+    except ValueError:
+        LOG.warning('Invalid job correlation id: %r' % corr_id)
+        return
+    try:
+        s, m, r = codec.decode_reply(props, body)
+    except (codec.CodecError, ValueError), e:
+        s, m, r = 1, 'Invalid reply from scheduler: %s' % e, None
+    if not finish(job_id, 'success' if s == 0 else 'error', m, r):
+        return
+    job = Job.objects.filter(id=job_id).first()
+    if job is None:
+        return
+    if job.batch:
+        dispatch(job.batch)
+    message = {'message_type': job.message_type}
+    if job.container_id:
+        message['id'] = job.container_id
+        cache.invalidate(message)
+    mq.rpc_completed.send(sender=None, message=message, result=(s, m, r))
+
+
+def sweep():
+    """超时的 Job 标记为 timeout, 并补发有排队 Job 的 batch
+
+    由 consume 定时调用, scheduler 丢失返回并且没有客户端查询时,
+    batch 也会继续执行.
+    """
+    close_old_connections()
+    try:
+        Job.objects.filter(
+            status='pending', deadline__lt=timezone.now()).update(
+            status='timeout',
+            detail='Timed out waiting for the scheduler',
+            finished=timezone.now())
+        for batch in Job.objects.filter(
+                status='queued', batch__isnull=False).values_list(
+                'batch', flat=True).distinct():
+            dispatch(batch)
+    except Exception:
+        LOG.exception('Can not sweep jobs')
+
+
+def consume():
+    """消费 JOB_QUEUE, 连接断开之后自动重连, 不会返回"""
+    while True:
+        try:
+            conn = mq.open_connection()
+            channel = conn.channel()
+            declare_queue(channel)
+            channel.basic_qos(prefetch_count=16)
+            channel.basic_consume(on_reply, queue=JOB_QUEUE)
+            LOG.info('Consuming job replies from %s' % JOB_QUEUE)
+            swept = 0
+            while True:
+                conn.process_data_events(time_limit=SWEEP_INTERVAL)
+                if time.time() - swept >= SWEEP_INTERVAL:
+                    sweep()
+                    swept = time.time()
+        except mq.CONNECTION_ERRORS, e:
+            LOG.warning('RabbitMQ connection lost: %s, reconnecting' % e)
+            time.sleep(RECONNECT_INTERVAL)
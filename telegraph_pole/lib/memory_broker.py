@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Longgeek <longgeek@gmail.com>
+
+"""进程内的 RabbitMQ 替身
+
+只实现 lib.mq, lib.events 和 scheduler 替身用到的那部分 pika
+BlockingConnection 接口, exchange 只支持默认 exchange 和 fanout,
+用于压测以及在没有 RabbitMQ 的环境中跑通请求链路.
+
+每个同步的 AMQP 方法(建立连接, 打开 channel, 声明队列, 开始消费)
+耗费一个 rtt, 消息从发出到投递耗费半个 rtt, 并分别计数, 可以用来
+比较不同模式下每次 RPC 实际要和 broker 交互多少次.
+"""
+
+import time
+import heapq
+import socket
+import threading
+import collections
+
+from pika import spec
+from pika import frame
+from pika import exceptions
+
+
+# RabbitMQ 的 direct reply-to 伪队列
+DIRECT_REPLY_TO = 'amq.rabbitmq.reply-to'
+
+
+class _Queue(object):
+    """队列, 有消费者时轮流投递, 没有时先保存"""
+
+    def __init__(self, name, owner=None):
+        self.name = name
+        self.owner = owner
+        self.messages = collections.deque()
+        self.consumers = []
+        self.next_consumer = 0
+
+
+class Broker(object):
+    """进程内的 broker
+
+    Params:
+        rtt: float; 一次网络往返的秒数
+    """
+
+    def __init__(self, rtt=0.0):
+        self.rtt = rtt
+        self.lock = threading.RLock()
+        self.queues = {}
+        self.channels = {}
+        # fanout exchange -> 绑定的队列名
+        self.exchanges = {}
+        self.stats = collections.Counter()
+        self.serial = 0
+
+        # 延迟投递, (投递时间, 序号, 函数)
+        self.timers = []
+        self.timers_cond = threading.Condition(self.lock)
+        self.network = None
+
+    def round_trip(self, method):
+        """同步方法, 记录并等待一个 rtt"""
+        self.stats[method] += 1
+        self.stats['round_trips'] += 1
+        if self.rtt:
+            time.sleep(self.rtt)
+
+    def _later(self, func):
+        """半个 rtt 之后执行, 模拟网络传输"""
+        if not self.rtt:
+            func()
+            return
+        with self.lock:
+            self.serial += 1
+            heapq.heappush(self.timers,
+                           (time.time() + self.rtt / 2.0, self.serial, func))
+            if self.network is None:
+                self.network = threading.Thread(target=self._run_network)
+                self.network.daemon = True
+                self.network.start()
+            self.timers_cond.notify()
+
+    def _run_network(self):
+        while True:
+            with self.lock:
+                while not self.timers or self.timers[0][0] > time.time():
+                    if self.timers:
+                        self.timers_cond.wait(self.timers[0][0] - time.time())
+                    else:
+                        self.timers_cond.wait()
+                func = heapq.heappop(self.timers)[2]
+            func()
+
+    def queue_declare(self, channel, queue='', exclusive=False):
+        with self.lock:
+            self.serial += 1
+            if not queue:
+                queue = 'amq.gen-%d' % self.serial
+            if queue not in self.queues:
+                owner = channel.connection if exclusive else None
+                self.queues[queue] = _Queue(queue, owner)
+                self.stats['queues_created'] += 1
+        return queue
+
+    def exchange_declare(self, exchange):
+        with self.lock:
+            self.exchanges.setdefault(exchange, set())
+
+    def queue_bind(self, queue, exchange):
+        with self.lock:
+            if exchange not in self.exchanges:
+                raise exceptions.ChannelClosed(404, 'NOT_FOUND - no exchange '
+                                                    "'%s'" % exchange)
+            self.exchanges[exchange].add(queue)
+
+    def basic_consume(self, channel, callback, queue):
+        with self.lock:
+            if queue == DIRECT_REPLY_TO:
+                self.channels[channel.token] = (channel, callback)
+                return
+            if queue not in self.queues:
+                raise exceptions.ChannelClosed(404, 'NOT_FOUND - no queue '
+                                                    "'%s'" % queue)
+            q = self.queues[queue]
+            q.consumers.append((channel, callback))
+            pending, q.messages = q.messages, collections.deque()
+        for message in pending:
+            self._route(queue, *message)
+
+    def basic_publish(self, channel, exchange, routing_key, props, body):
+        self.stats['publish'] += 1
+        props = props or spec.BasicProperties()
+
+        # direct reply-to: 发送者必须已经在同一个 channel 上消费伪队列
+        if props.reply_to == DIRECT_REPLY_TO:
+            if channel.token not in self.channels:
+                raise exceptions.ChannelClosed(
+                    406, 'PRECONDITION_FAILED - fast reply consumer '
+                         'does not exist')
+            props = spec.BasicProperties(**dict(props.__dict__))
+            props.reply_to = '%s.%s' % (DIRECT_REPLY_TO, channel.token)
+
+        expires = None
+        if props.expiration:
+            expires = time.time() + int(props.expiration) / 1000.0
+        if not exchange:
+            self._later(lambda: self._route(routing_key, exchange, props,
+                                            body, expires))
+            return
+        with self.lock:
+            if exchange not in self.exchanges:
+                raise exceptions.ChannelClosed(404, 'NOT_FOUND - no exchange '
+                                                    "'%s'" % exchange)
+            queues = list(self.exchanges[exchange])
+        for queue in queues:
+            self._later(lambda queue=queue: self._route(
+                queue, exchange, props, body, expires))
+
+    def _route(self, routing_key, exchange, props, body, expires):
+        """把消息投递给消费者, 过期的消息直接丢弃"""
+        if expires is not None and expires < time.time():
+            self.stats['expired'] += 1
+            return
+        with self.lock:
+            if routing_key.startswith(DIRECT_REPLY_TO + '.'):
+                token = routing_key[len(DIRECT_REPLY_TO) + 1:]
+                target = self.channels.get(token)
+                if target is None:
+                    self.stats['dropped'] += 1
+                    return
+            else:
+                q = self.queues.get(routing_key)
+                if q is None:
+                    self.stats['dropped'] += 1
+                    return
+                if not q.consumers:
+                    q.messages.append((exchange, props, body, expires))
+                    return
+                q.next_consumer %= len(q.consumers)
+                target = q.consumers[q.next_consumer]
+                q.next_consumer += 1
+        self.stats['deliver'] += 1
+        channel, callback = target
+        method = spec.Basic.Deliver(delivery_tag=self.stats['deliver'],
+                                    exchange=exchange,
+                                    routing_key=routing_key)
+        channel.connection._deliver(callback, channel, method, props, body)
+
+    def forget(self, connection):
+        """连接关闭, 删除它的独占队列和消费者"""
+        with self.lock:
+            for name, q in self.queues.items():
+                if q.owner is connection:
+                    del self.queues[name]
+                    for bound in self.exchanges.values():
+                        bound.discard(name)
+                    continue
+                q.consumers = [c for c in q.consumers
+                               if c[0].connection is not connection]
+            for token, (channel, _) in self.channels.items():
+                if channel.connection is connection:
+                    del self.channels[token]
+
+
+_broker = None
+
+
+def get_broker():
+    """当前进程的 broker"""
+    global _broker
+    if _broker is None:
+        _broker = Broker()
+    return _broker
+
+
+class _Impl(object):
+    """和 pika 一样通过 _impl.socket 暴露可读事件"""
+
+    def __init__(self, sock):
+        self.socket = sock
+
+
+class BlockingChannel(object):
+
+    def __init__(self, connection, token):
+        self.connection = connection
+        self.broker = connection.broker
+        self.token = token
+        self.is_open = True
+
+    def queue_declare(self, queue='', passive=False, durable=False,
+                      exclusive=False, auto_delete=False, arguments=None):
+        self.broker.round_trip('queue_declare')
+        name = self.broker.queue_declare(self, queue, exclusive)
+        return frame.Method(1, spec.Queue.DeclareOk(queue=name))
+
+    def exchange_declare(self, exchange=None, exchange_type='direct',
+                         passive=False, durable=False, auto_delete=False,
+                         internal=False, arguments=None):
+        self.broker.round_trip('exchange_declare')
+        self.broker.exchange_declare(exchange)
+
+    def queue_bind(self, queue, exchange, routing_key=None, arguments=None):
+        self.broker.round_trip('queue_bind')
+        self.broker.queue_bind(queue, exchange)
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, all_channels=False):
+        self.broker.round_trip('basic_qos')
+
+    def basic_consume(self, consumer_callback, queue, no_ack=False,
+                      exclusive=False, consumer_tag=None, arguments=None):
+        self.broker.round_trip('basic_consume')
+        self.broker.basic_consume(self, consumer_callback, queue)
+
+    def basic_publish(self, exchange, routing_key, body,
+                      properties=None, mandatory=False, immediate=False):
+        if not self.is_open:
+            raise exceptions.ChannelClosed()
+        self.broker.basic_publish(self, exchange, routing_key,
+                                  properties, body)
+        return True
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+
+class BlockingConnection(object):
+    """替代 pika.BlockingConnection
+
+    投递过来的消息先放进 inbox, 在 process_data_events 中
+    调用消费者的回调, 和 pika 的行为一致.
+    """
+
+    def __init__(self, parameters=None, broker=None):
+        self.broker = broker or get_broker()
+        # TCP 握手 + AMQP Start/Tune/Open
+        for method in ('tcp_connect', 'connection_start',
+                       'connection_tune', 'connection_open'):
+            self.broker.round_trip(method)
+        self.is_open = True
+        self.inbox = collections.deque()
+        self.cond = threading.Condition()
+        self.channels = 0
+        self.reader, self.writer = socket.socketpair()
+        self.reader.setblocking(0)
+        self._impl = _Impl(self.reader)
+
+    def channel(self):
+        self.broker.round_trip('channel_open')
+        self.channels += 1
+        return BlockingChannel(self, '%d.%d' % (id(self), self.channels))
+
+    def close(self):
+        if not self.is_open:
+            return
+        self.is_open = False
+        self.broker.forget(self)
+        with self.cond:
+            self.cond.notify_all()
+        self.writer.close()
+        self.reader.close()
+
+    def _deliver(self, callback, channel, method, props, body):
+        with self.cond:
+            if not self.is_open:
+                return
+            self.inbox.append((callback, channel, method, props, body))
+            self.cond.notify_all()
+        try:
+            self.writer.send(b'.')
+        except socket.error:
+            pass
+
+    def process_data_events(self, time_limit=0):
+        """处理投递过来的消息
+
+        time_limit 为 None 时一直等到有消息, 和 pika 0.10 一致.
+        """
+        if not self.is_open:
+            raise exceptions.ConnectionClosed()
+        deadline = None if time_limit is None else time.time() + time_limit
+        with self.cond:
+            while not self.inbox and self.is_open:
+                if deadline is None:
+                    self.cond.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            events, self.inbox = self.inbox, collections.deque()
+        try:
+            while self.reader.recv(4096):
+                pass
+        except socket.error:
+            pass
+        for callback, channel, method, props, body in events:
+            callback(channel, method, props, body)
+
+    def sleep(self, duration):
+        self.process_data_events(time_limit=duration)
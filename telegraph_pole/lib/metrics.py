@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Longgeek <longgeek@gmail.com>
+
+"""scheduler RPC 的统计
+
+按 message_type 统计从发出到收到返回的延迟, 请求和返回的字节数,
+各种结果(ok/error/timeout/unavailable)的次数以及正在等待的请求数.
+
+统计保存在 worker 进程内, 更新时不加锁: gevent worker 只有一个系统
+线程, greenlet 只在 IO 时切换, 这里的累加不会被打断. 每个 worker
+每隔 METRICS_FLUSH_INTERVAL 秒把自己的快照写入 Redis, /v1/metrics
+读取所有 worker 的快照合并后按 Prometheus 文本格式输出.
+"""
+
+import os
+import time
+import bisect
+import socket
+import logging
+import simplejson
+
+import redis
+
+from telegraph_pole import settings
+from telegraph_pole.lib.redis_client import get_redis
+from telegraph_pole.lib.redis_client import mark_down
+
+
+LOG = logging.getLogger(__name__)
+
+# 快照写入 Redis 的间隔(秒)
+FLUSH_INTERVAL = getattr(settings, 'METRICS_FLUSH_INTERVAL', 10)
+
+KEY_PREFIX = 'telegraph_pole:metrics:'
+
+# 延迟直方图的桶(秒)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# 消息大小直方图的桶(字节)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144,
+                1048576, 4194304, 16777216)
+
+OUTCOMES = ('ok', 'error', 'timeout', 'unavailable')
+
+
+class Histogram(object):
+    """累计直方图, counts 比 buckets 多一个 +Inf 桶"""
+
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def snapshot(self):
+        return {'counts': list(self.counts), 'sum': self.sum}
+
+
+class RPCStats(object):
+    """一种 message_type 的统计"""
+
+    __slots__ = ('latency', 'request_bytes', 'response_bytes',
+                 'outcomes', 'in_flight')
+
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.request_bytes = Histogram(SIZE_BUCKETS)
+        self.response_bytes = Histogram(SIZE_BUCKETS)
+        self.outcomes = dict.fromkeys(OUTCOMES, 0)
+        self.in_flight = 0
+
+    def snapshot(self):
+        return {'latency': self.latency.snapshot(),
+                'request_bytes': self.request_bytes.snapshot(),
+                'response_bytes': self.response_bytes.snapshot(),
+                'outcomes': dict(self.outcomes),
+                'in_flight': self.in_flight}
+
+
+# message_type -> RPCStats
+_stats = {}
+_last_flush = [time.time()]
+_worker = '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+class RPCTimer(object):
+    """一次 RPC 的统计, 发出时创建, 收到返回或者失败时调用 done"""
+
+    __slots__ = ('stats', 'start')
+
+    def __init__(self, message_type, request_bytes):
+        stats = _stats.get(message_type)
+        if stats is None:
+            stats = _stats[message_type] = RPCStats()
+        stats.in_flight += 1
+        stats.request_bytes.observe(request_bytes)
+        self.stats = stats
+        self.start = time.time()
+
+    def done(self, outcome, response_bytes=None):
+        now = time.time()
+        stats = self.stats
+        stats.in_flight -= 1
+        stats.outcomes[outcome] += 1
+        if response_bytes is not None:
+            stats.latency.observe(now - self.start)
+            stats.response_bytes.observe(response_bytes)
+        if now - _last_flush[0] >= FLUSH_INTERVAL:
+            _last_flush[0] = now
+            flush()
+
+
+def snapshot():
+    """当前 worker 的统计"""
+    return dict((message_type, stats.snapshot())
+                for message_type, stats in _stats.items())
+
+
+def flush():
+    """把当前 worker 的快照写入 Redis, 过期时间为三个写入间隔"""
+    global _worker
+    if not _worker.endswith(':%d' % os.getpid()):
+        _worker = '%s:%d' % (socket.gethostname(), os.getpid())
+    conn = get_redis()
+    if conn is None:
+        return
+    try:
+        conn.setex(KEY_PREFIX + _worker,
+                   int(FLUSH_INTERVAL * 3),
+                   simplejson.dumps(snapshot()))
+    except redis.RedisError, e:
+        mark_down(e)
+
+
+def collect():
+    """合并所有 worker 的快照, Redis 不可用时只返回当前 worker 的"""
+    flush()
+    snapshots = []
+    conn = get_redis()
+    try:
+        if conn is not None:
+            keys = list(conn.scan_iter(match=KEY_PREFIX + '*', count=100))
+            if keys:
+                snapshots = [simplejson.loads(value)
+                             for value in conn.mget(keys) if value]
+    except redis.RedisError, e:
+        mark_down(e)
+    if not snapshots:
+        snapshots = [snapshot()]
+
+    merged = {}
+    for worker in snapshots:
+        for message_type, stats in worker.items():
+            if message_type not in merged:
+                merged[message_type] = stats
+                continue
+            total = merged[message_type]
+            for name in ('latency', 'request_bytes', 'response_bytes'):
+                total[name]['counts'] = [
+                    a + b for a, b in zip(total[name]['counts'],
+                                          stats[name]['counts'])]
+                total[name]['sum'] += stats[name]['sum']
+            for outcome, count in stats['outcomes'].items():
+                total['outcomes'][outcome] = \
+                    total['outcomes'].get(outcome, 0) + count
+            total['in_flight'] += stats['in_flight']
+    return merged
+
+
+def _histogram(lines, name, buckets, message_type, histogram):
+    cumulative = 0
+    for bound, count in zip(list(buckets) + ['+Inf'], histogram['counts']):
+        cumulative += count
+        lines.append('%s_bucket{message_type="%s",le="%s"} %d' % (
+            name, message_type, bound, cumulative))
+    lines.append('%s_sum{message_type="%s"} %s' % (
+        name, message_type, histogram['sum']))
+    lines.append('%s_count{message_type="%s"} %d' % (
+        name, message_type, cumulative))
+
+
+def render(merged=None):
+    """按 Prometheus 文本格式输出"""
+    if merged is None:
+        merged = collect()
+    message_types = sorted(merged)
+    lines = []
+
+    for name, key, buckets, help in (
+            ('telegraph_pole_rpc_duration_seconds', 'latency',
+             LATENCY_BUCKETS, 'Publish-to-reply latency of scheduler RPCs.'),
+            ('telegraph_pole_rpc_request_bytes', 'request_bytes',
+             SIZE_BUCKETS, 'Size of scheduler RPC request bodies.'),
+            ('telegraph_pole_rpc_response_bytes', 'response_bytes',
+             SIZE_BUCKETS, 'Size of scheduler RPC reply bodies.')):
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s histogram' % name)
+        for message_type in message_types:
+            _histogram(lines, name, buckets, message_type,
+                       merged[message_type][key])
+
+    lines.append('# HELP telegraph_pole_rpc_total '
+                 'Scheduler RPCs by outcome.')
+    lines.append('# TYPE telegraph_pole_rpc_total counter')
+    for message_type in message_types:
+        outcomes = merged[message_type]['outcomes']
+        for outcome in sorted(outcomes):
+            lines.append('telegraph_pole_rpc_total'
+                         '{message_type="%s",outcome="%s"} %d' % (
+                             message_type, outcome, outcomes[outcome]))
+
+    lines.append('# HELP telegraph_pole_rpc_in_flight '
+                 'Scheduler RPCs waiting for a reply.')
+    lines.append('# TYPE telegraph_pole_rpc_in_flight gauge')
+    for message_type in message_types:
+        lines.append('telegraph_pole_rpc_in_flight{message_type="%s"} %d' % (
+            message_type, merged[message_type]['in_flight']))
+    return '\n'.join(lines) + '\n'
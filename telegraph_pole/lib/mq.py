@@ -2,102 +2,982 @@
 # -*- coding: utf-8 -*-
 # Author: Longgeek <longgeek@gmail.com>
 
-import pika
+import os
+import time
 import uuid
+import socket
+import logging
+import threading
 import simplejson
+import collections
+
+import pika
+import redis
+from pika import exceptions
 
+try:
+    import gevent
+    from gevent import event as gevent_event
+    from gevent import lock as gevent_lock
+    from gevent import monkey as gevent_monkey
+    from gevent import queue as gevent_queue
+    from gevent import socket as gevent_socket
+except ImportError:
+    gevent = None
+
+from django.dispatch import Signal
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from telegraph_pole import settings
+from telegraph_pole.lib import cache
+from telegraph_pole.lib import codec
+from telegraph_pole.lib import metrics
+from telegraph_pole.lib import memory_broker
+from telegraph_pole.lib.redis_client import get_redis
+from telegraph_pole.lib.redis_client import mark_down
 from telegraph_pole.settings import RABBITMQ_HOST
 from telegraph_pole.settings import RABBITMQ_PORT
 from telegraph_pole.settings import RABBITMQ_USER
 from telegraph_pole.settings import RABBITMQ_PASS
 
 
-# class SingLeton(object):
-#     """ 单例类，只初始化一次
-#
-#     获取 RabbitMQ 连接对象.
-#     """
-#
-#     _instance = None
-#     conn = None
-#     channel = None
-#
-#     def __new__(cls, *args, **kwargs):
-#         if not cls._instance:
-#             cls._instance = super(SingLeton, cls).__new__(
-#                 cls, *args, **kwargs)
-#
-#             # Initialize RabbitMQ connection
-#             credentials = pika.PlainCredentials(RABBITMQ_USER,
-#                                                 RABBITMQ_PASS)
-#             cls.conn = pika.BlockingConnection(pika.ConnectionParameters(
-#                 host=RABBITMQ_HOST,
-#                 port=int(RABBITMQ_PORT),
-#                 credentials=credentials))
-#             cls.channel = cls.conn.channel()
-#
-#         return (cls.channel, cls.conn)
-#
-#     def __del__(self):
-#         del self._instance
-#         del self.conn
-#         del self.channel
+LOG = logging.getLogger(__name__)
+
+# 每个 worker 进程中空闲连接的最大数量
+POOL_SIZE = getattr(settings, 'RABBITMQ_POOL_SIZE', 4)
+
+# 心跳间隔(秒), 0 表示关闭心跳
+HEARTBEAT = getattr(settings, 'RABBITMQ_HEARTBEAT', 60)
+
+# 建立连接失败时的重试次数
+CONNECTION_ATTEMPTS = getattr(settings, 'RABBITMQ_CONNECTION_ATTEMPTS', 3)
+
+# RPC 客户端类型:
+#   auto     - gevent 已经 monkey patch 时使用 gevent, 否则使用 blocking
+#   gevent   - 每个 worker 一条连接, 多个 greenlet 复用
+#   blocking - 连接池, 每个请求独占一条连接
+TRANSPORT = getattr(settings, 'RABBITMQ_TRANSPORT', 'auto')
+
+# 使用 RabbitMQ 的 direct reply-to 伪队列(amq.rabbitmq.reply-to)
+# 接收返回消息, 不再声明独占的回调队列
+DIRECT_REPLY_TO = getattr(settings, 'RABBITMQ_DIRECT_REPLY_TO', False)
+REPLY_TO_QUEUE = 'amq.rabbitmq.reply-to'
+
+# 连接的 broker:
+#   rabbitmq - RabbitMQ
+#   memory   - 进程内的替身(lib/memory_broker), 只用于压测
+BROKER = getattr(settings, 'RABBITMQ_BROKER', 'rabbitmq')
+
+# 等待返回的默认超时时间(秒)
+DEFAULT_TIMEOUT = getattr(settings, 'RPC_DEFAULT_TIMEOUT', 30)
+
+# 每种 message_type 的超时时间(秒), 可以在 RPC_TIMEOUTS 中覆盖
+TIMEOUTS = {
+    'top_container': 5,
+    'inspect_container': 10,
+    'files_list_container': 10,
+    'files_read_container': 15,
+    'files_download_container': 30,
+    'files_upload_container': 30,
+    'archive_export_container': 60,
+    'archive_import_container': 60,
+    'host_fdcheck_container': 10,
+    'pause_container': 30,
+    'unpause_container': 30,
+    'stop_container': 60,
+    'start_container': 60,
+    'restart_container': 90,
+    'delete_container': 60,
+    'exec_container': 120,
+    'host_exec_container': 120,
+    'create_container': 180,
+}
+TIMEOUTS.update(getattr(settings, 'RPC_TIMEOUTS', {}))
+
+# 合并相同的只读请求: 同一个请求正在等待返回时, 之后的请求
+# 不再发给 scheduler, 而是等待并共用第一个请求的返回
+COALESCE = getattr(settings, 'RPC_COALESCE', True)
+
+# 其它 worker 等待 Redis 中返回结果的轮询间隔(秒)
+COALESCE_POLL = 0.01
+
+# 返回结果在 Redis 中保留的时间(秒), 只需要够其它 worker 读到
+COALESCE_RESULT_TTL = 5
+
+# 流式返回(send_stream)在 worker 中最多缓存的消息数, 客户端读得太慢
+# 超出之后放弃这次请求, 内存不会无限增长
+STREAM_BUFFER = getattr(settings, 'RPC_STREAM_BUFFER', 256)
+
+# 收到 scheduler 的返回之后发出, 参数为消息和 (status, msgs, results),
+# 超时和无法连接的请求不会发出
+rpc_completed = Signal(providing_args=['message', 'result'])
+
+# 连接断开时会抛出的异常
+CONNECTION_ERRORS = (exceptions.AMQPConnectionError,
+                     exceptions.AMQPChannelError,
+                     exceptions.ConnectionClosed,
+                     exceptions.ChannelClosed)
+
+
+class RPCError(APIException):
+    """RPC 调用失败, 由 rest_framework 转换为对应状态码的响应"""
+
+
+class RPCUnavailable(RPCError):
+    """无法连接到 RabbitMQ 或连接在请求中断开"""
+
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Error: The scheduler is unavailable!'
+    outcome = 'unavailable'
+
+
+class RPCTimeout(RPCError):
+    """在超时时间内没有收到返回消息"""
+
+    status_code = status.HTTP_504_GATEWAY_TIMEOUT
+    default_detail = 'Error: The scheduler did not reply in time!'
+    outcome = 'timeout'
+
+
+class RPCOverflow(RPCError):
+    """流式返回的输出超过 STREAM_BUFFER, 客户端读取太慢"""
+
+    status_code = status.HTTP_502_BAD_GATEWAY
+    default_detail = 'Error: Output dropped, the client reads too slowly!'
+    outcome = 'error'
+
+
+def get_timeout(message):
+    """根据 message_type 获取超时时间"""
+    return TIMEOUTS.get(message.get('message_type'), DEFAULT_TIMEOUT)
+
+
+def open_connection():
+    """打开一条到 broker 的连接"""
+    if BROKER == 'memory':
+        return memory_broker.BlockingConnection()
+    return pika.BlockingConnection(connection_parameters())
+
+
+def consume_replies(channel, callback):
+    """在 channel 上开始消费返回消息, 返回回调队列的名字
+
+    direct reply-to 模式不需要声明队列, 返回消息直接投递给发送消息的
+    channel, 一次 RPC 只有一次发送和一次投递. 该模式要求在同一个
+    channel 上先消费再发送, 并且必须是 no_ack.
+    """
+    if DIRECT_REPLY_TO:
+        queue = REPLY_TO_QUEUE
+    else:
+        # 定义接收返回消息的队列(随机), 整个连接生命周期内只声明一次
+        queue = channel.queue_declare(exclusive=True).method.queue
+
+    # 消费消息, 返回消息不需要 ack, 否则会在长连接上无限堆积
+    channel.basic_consume(callback, no_ack=True, queue=queue)
+    return queue
+
+
+def publish(channel, reply_to, corr_id, request, timeout):
+    """发送消息, 并设置返回队列和 correlation_id
+
+    request 为 codec.encode 的返回值 (body, properties).
+
+    设置 expiration, 超时之后还没被消费的消息由 broker 直接丢弃,
+    避免 scheduler 恢复之后再去执行已经没人等待的请求.
+    """
+    body, properties = request
+    channel.basic_publish(exchange='',
+                          routing_key='docker_scheduler',
+                          properties=pika.BasicProperties(
+                              reply_to=reply_to,
+                              correlation_id=corr_id,
+                              expiration=str(int(timeout * 1000)),
+                              **properties),
+                          body=body)
+
+
+def emit(channel, exchange, request):
+    """发送消息到 exchange, 不需要返回"""
+    body, properties = request
+    channel.basic_publish(exchange=exchange,
+                          routing_key='',
+                          properties=pika.BasicProperties(**properties),
+                          body=body)
+
+
+def stream_end(props):
+    """流式返回的最后一个消息
+
+    headers 中 stream 为 chunk(原始输出)或者 meta(编码过的元数据,
+    例如文件大小)的是中间的消息. 不支持流式返回的 scheduler
+    只返回一个普通消息, 同样视为结束.
+    """
+    return (props.headers or {}).get('stream') not in ('chunk', 'meta')
+
+
+def connection_parameters():
+    """RabbitMQ 连接参数"""
+    credentials = pika.PlainCredentials(RABBITMQ_USER,
+                                        RABBITMQ_PASS)
+    return pika.ConnectionParameters(
+        host=RABBITMQ_HOST,
+        port=int(RABBITMQ_PORT),
+        credentials=credentials,
+        heartbeat_interval=int(HEARTBEAT),
+        connection_attempts=int(CONNECTION_ATTEMPTS),
+        retry_delay=1)
 
 
 class Call(object):
-    """发送消息同时等待远程返回值"""
+    """发送消息同时等待远程返回值
+
+    一个 Call 持有一条长连接、一个 channel 和一个回调队列,
+    由 Pool 管理并在多次请求之间复用.
+    """
 
     def __init__(self):
-        # Initialize RabbitMQ connection
-        credentials = pika.PlainCredentials(RABBITMQ_USER,
-                                            RABBITMQ_PASS)
-        self.conn = pika.BlockingConnection(pika.ConnectionParameters(
-            host=RABBITMQ_HOST,
-            port=int(RABBITMQ_PORT),
-            credentials=credentials))
+        self.conn = None
+        self.channel = None
+        self.callback_queue = None
+
+        # 返回的结果都会保存在该字典中
+        self.response = {}
+        # 流式返回: correlation_id -> 收到还没取走的消息
+        self.streams = {}
+        self.connect()
+
+    def connect(self):
+        """建立连接, 声明回调队列并开始消费"""
+        self.close()
+        self.conn = open_connection()
         self.channel = self.conn.channel()
-        # sing_leton = SingLeton()
-        # self.channel = sing_leton[0]
-        # self.connection = sing_leton[1]
+        self.callback_queue = consume_replies(self.channel, self.on_response)
+        self.response = {}
+        self.streams = {}
 
-        # 定义接收返回消息的队列(随机)
-        result = self.channel.queue_declare(exclusive=True)
-        self.callback_queue = result.method.queue
+    def close(self):
+        """关闭连接, 忽略已经断开的连接"""
+        if self.conn is not None:
+            try:
+                if self.conn.is_open:
+                    self.conn.close()
+            except CONNECTION_ERRORS:
+                pass
+        self.conn = None
+        self.channel = None
 
-        # 消费消息
-        self.channel.basic_consume(self.on_response,
-                                   no_ack=False,
-                                   queue=self.callback_queue)
+    @property
+    def is_open(self):
+        return self.conn is not None and self.conn.is_open and \
+            self.channel is not None and self.channel.is_open
 
-        # 返回的结果都会保存在该字典中
-        self.response = {}
+    def ensure_open(self):
+        """检查连接是否可用, 不可用则重新连接
+
+        处理积压的事件(包括心跳), 让空闲期间被 broker
+        断开的连接在这里暴露出来.
+        """
+        if self.is_open:
+            try:
+                self.conn.process_data_events()
+                return
+            except CONNECTION_ERRORS:
+                LOG.warning('RabbitMQ connection lost, reconnecting')
+        self.connect()
 
     def on_response(self, ch, method, props, body):
         """定义接收到返回消息的处理方法"""
-        self.response[props.correlation_id] = body
+        if props.correlation_id in self.streams:
+            self.streams[props.correlation_id].append((props, body))
+            return
+        # 只接收正在等待的消息
+        if props.correlation_id in self.response:
+            self.response[props.correlation_id] = (props, body)
+
+    def request_many(self, messages, timeouts):
+        """连续发送多个消息, 然后一起等待返回
+
+        Return:
+            和 messages 顺序一致的列表, 元素为返回消息的
+            (properties, body), 超时的为 RPCTimeout
+        """
+        now = time.time()
+        pending = []
+        try:
+            for message, timeout in zip(messages, timeouts):
+                corr_id = str(uuid.uuid4())
+                self.response[corr_id] = None
+                pending.append((corr_id, now + timeout))
+                publish(self.channel, self.callback_queue,
+                        corr_id, message, timeout)
+
+            # 接收返回的数据, 阻塞直到有事件到达或者全部超时
+            while True:
+                now = time.time()
+                deadlines = [deadline for key, deadline in pending
+                             if self.response[key] is None and
+                             deadline > now]
+                if not deadlines:
+                    break
+                self.conn.process_data_events(time_limit=min(deadlines) - now)
+        finally:
+            # 返回接收到的数据, 超时之后再到达的消息会被 on_response 丢弃
+            replies = [self.response.pop(key, None)
+                       for key, _ in pending]
+        return [RPCTimeout() if reply is None else reply
+                for reply in replies]
+
+    def stream(self, message, timeout):
+        """发送消息, 逐个返回同一个 correlation_id 的消息直到结束
 
-    def request(self, message):
+        缓存的消息取完之后才从连接读取, 读取速度由调用者决定.
+        timeout 为两个消息之间最长的间隔.
+        """
         corr_id = str(uuid.uuid4())
-        self.response[corr_id] = None
-
-        # 发送消息, 并设置返回队列和 crooelation_id
-        self.channel.basic_publish(exchange='',
-                                   routing_key='docker_scheduler',
-                                   properties=pika.BasicProperties(
-                                       reply_to=self.callback_queue,
-                                       correlation_id=corr_id),
-                                   body=message)
-
-        # 接收返回的数据
-        while self.response[corr_id] is None:
-            self.conn.process_data_events()
-        # 返回接收到的数据
-        return self.response[corr_id]
-
-
-def send_message(message):
-    """发送消息"""
-    call = Call()
+        chunks = self.streams[corr_id] = collections.deque()
+        try:
+            publish(self.channel, self.callback_queue,
+                    corr_id, message, timeout)
+            while True:
+                deadline = time.time() + timeout
+                while not chunks:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise RPCTimeout()
+                    self.conn.process_data_events(time_limit=remaining)
+                props, body = chunks.popleft()
+                yield props, body
+                if stream_end(props):
+                    return
+        finally:
+            # 之后再到达的消息会被 on_response 丢弃
+            self.streams.pop(corr_id, None)
+
+
+class Pool(object):
+    """RabbitMQ 连接池
+
+    每个 worker 进程一个, 请求时取出一个 Call, 用完放回.
+    """
+
+    def __init__(self, size=POOL_SIZE):
+        self.pid = os.getpid()
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def get(self):
+        """取出一个可用的 Call, 没有空闲的就新建"""
+        call = None
+        with self.lock:
+            if self.idle:
+                call = self.idle.pop()
+        try:
+            if call is None:
+                return Call()
+            call.ensure_open()
+            return call
+        except CONNECTION_ERRORS, e:
+            LOG.error('Can not connect to RabbitMQ: %s' % e)
+            raise RPCUnavailable()
+
+    def put(self, call):
+        """放回连接池, 连接池满了或者连接已断开就关闭"""
+        if call.is_open:
+            with self.lock:
+                if len(self.idle) < self.size:
+                    self.idle.append(call)
+                    return
+        call.close()
+
+    def request_many(self, messages, timeouts):
+        call = self.get()
+        try:
+            replies = call.request_many(messages, timeouts)
+        except CONNECTION_ERRORS, e:
+            # 消息可能已经发出, 不能重发, 关闭连接并返回错误
+            LOG.error('RabbitMQ connection lost during request: %s' % e)
+            call.close()
+            return [RPCUnavailable() for message in messages]
+        # 超时不影响连接, 放回连接池继续使用
+        self.put(call)
+        return replies
+
+    def request(self, message, timeout):
+        reply = self.request_many([message], [timeout])[0]
+        if isinstance(reply, RPCError):
+            raise reply
+        return reply
+
+    def stream(self, message, timeout):
+        call = self.get()
+        try:
+            for reply in call.stream(message, timeout):
+                yield reply
+        except CONNECTION_ERRORS, e:
+            LOG.error('RabbitMQ connection lost during request: %s' % e)
+            call.close()
+            raise RPCUnavailable()
+        finally:
+            # 中途放弃(客户端断开)也可以继续使用这条连接
+            self.put(call)
+
+    def send(self, message, reply_to, corr_id, timeout):
+        """只发送消息, 返回消息投递到 reply_to, 由其它消费者处理"""
+        self._publish(lambda channel: publish(channel, reply_to, corr_id,
+                                              message, timeout))
+
+    def emit(self, exchange, message):
+        self._publish(lambda channel: emit(channel, exchange, message))
+
+    def declare_exchange(self, exchange, exchange_type):
+        self._publish(lambda channel: channel.exchange_declare(
+            exchange=exchange, exchange_type=exchange_type))
+
+    def _publish(self, func):
+        call = self.get()
+        try:
+            func(call.channel)
+        except CONNECTION_ERRORS, e:
+            LOG.error('RabbitMQ connection lost during send: %s' % e)
+            call.close()
+            raise RPCUnavailable()
+        self.put(call)
+
+
+class Multiplexer(object):
+    """协程 RPC 客户端
+
+    每个 worker 进程只有一条连接和一个回调队列, 所有 greenlet
+    共用这条连接发送消息. 后台 greenlet 负责接收返回消息, 根据
+    correlation_id 唤醒对应的等待者, 其它 greenlet 等待时不会阻塞
+    整个 worker.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.conn = None
+        self.channel = None
+        self.callback_queue = None
+        self.pump = None
+
+        # pika 的连接不可重入, 发送和接收都要持有这把锁
+        self.lock = gevent_lock.RLock()
+
+        # correlation_id -> AsyncResult
+        self.waiters = {}
+        # 流式返回: correlation_id -> Queue
+        self.streams = {}
+
+    @property
+    def is_open(self):
+        return self.conn is not None and self.conn.is_open and \
+            self.channel is not None and self.channel.is_open
+
+    def connect(self):
+        """建立连接, 并启动接收返回消息的 greenlet"""
+        with self.lock:
+            if self.is_open:
+                return
+            self.close()
+            try:
+                self.conn = open_connection()
+                self.channel = self.conn.channel()
+                self.callback_queue = consume_replies(self.channel,
+                                                      self.on_response)
+            except CONNECTION_ERRORS, e:
+                LOG.error('Can not connect to RabbitMQ: %s' % e)
+                self.close()
+                raise RPCUnavailable()
+            self.pump = gevent.spawn(self._pump, self.conn)
+
+    def close(self):
+        """关闭连接, 唤醒所有还在等待的请求"""
+        conn, self.conn, self.channel = self.conn, None, None
+        if conn is not None:
+            try:
+                if conn.is_open:
+                    conn.close()
+            except CONNECTION_ERRORS:
+                pass
+        waiters, self.waiters = self.waiters, {}
+        for waiter in waiters.values():
+            waiter.set_exception(RPCUnavailable())
+        streams, self.streams = self.streams, {}
+        for queue in streams.values():
+            self._fail(queue, RPCUnavailable())
+
+    def _pump(self, conn):
+        """后台接收返回消息, 直到连接断开
+
+        在锁外等待 socket 可读, 可读之后再持锁处理事件,
+        超时返回时顺便处理心跳.
+        """
+        interval = HEARTBEAT / 2.0 if HEARTBEAT else 30
+        while conn is self.conn and conn.is_open:
+            try:
+                with self.lock:
+                    conn.process_data_events()
+                gevent_socket.wait_read(conn._impl.socket.fileno(),
+                                        timeout=interval)
+            except socket.timeout:
+                continue
+            except (CONNECTION_ERRORS + (socket.error, AttributeError)), e:
+                LOG.warning('RabbitMQ connection lost: %s' % e)
+                break
+        if conn is self.conn:
+            self.close()
+
+    def on_response(self, ch, method, props, body):
+        """根据 correlation_id 唤醒等待的 greenlet"""
+        queue = self.streams.get(props.correlation_id)
+        if queue is not None:
+            try:
+                queue.put_nowait((props, body))
+            except gevent_queue.Full:
+                # 不能阻塞接收消息的 greenlet, 放弃这次请求
+                del self.streams[props.correlation_id]
+                self._fail(queue, RPCOverflow())
+            return
+        waiter = self.waiters.pop(props.correlation_id, None)
+        if waiter is not None:
+            waiter.set((props, body))
+
+    def request_many(self, messages, timeouts):
+        """连续发送多个消息, 然后一起等待返回
+
+        Return:
+            和 messages 顺序一致的列表, 元素为返回消息的
+            (properties, body), 超时的为 RPCTimeout,
+            连接断开的为 RPCUnavailable
+        """
+        self.connect()
+        now = time.time()
+        pending = []
+        for message, timeout in zip(messages, timeouts):
+            corr_id = str(uuid.uuid4())
+            waiter = gevent_event.AsyncResult()
+            self.waiters[corr_id] = waiter
+            pending.append((corr_id, waiter, now + timeout))
+
+        try:
+            with self.lock:
+                for (corr_id, waiter, deadline), message, timeout in \
+                        zip(pending, messages, timeouts):
+                    publish(self.channel, self.callback_queue,
+                            corr_id, message, timeout)
+        except (CONNECTION_ERRORS + (AttributeError,)), e:
+            # close 会让所有等待者收到 RPCUnavailable
+            LOG.error('RabbitMQ connection lost during request: %s' % e)
+            self.close()
+
+        replies = []
+        for corr_id, waiter, deadline in pending:
+            try:
+                # 只挂起当前 greenlet, 等待后台 greenlet 唤醒
+                replies.append(waiter.get(
+                    timeout=max(deadline - time.time(), 0)))
+            except gevent.Timeout:
+                replies.append(RPCTimeout())
+            except RPCError, e:
+                replies.append(e)
+            finally:
+                # 超时之后再到达的消息找不到等待者, 会被 on_response 丢弃
+                self.waiters.pop(corr_id, None)
+        return replies
+
+    def request(self, message, timeout):
+        reply = self.request_many([message], [timeout])[0]
+        if isinstance(reply, RPCError):
+            raise reply
+        return reply
+
+    @staticmethod
+    def _fail(queue, error):
+        """清空缓存的消息, 让等待者收到 error"""
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(error)
+
+    def stream(self, message, timeout):
+        """发送消息, 逐个返回同一个 correlation_id 的消息直到结束
+
+        timeout 为两个消息之间最长的间隔.
+        """
+        corr_id = str(uuid.uuid4())
+        queue = gevent_queue.Queue(STREAM_BUFFER)
+        self.streams[corr_id] = queue
+        try:
+            self._publish(lambda channel: publish(
+                channel, self.callback_queue, corr_id, message, timeout))
+            while True:
+                try:
+                    reply = queue.get(timeout=timeout)
+                except gevent_queue.Empty:
+                    raise RPCTimeout()
+                if isinstance(reply, RPCError):
+                    raise reply
+                yield reply
+                if stream_end(reply[0]):
+                    return
+        finally:
+            self.streams.pop(corr_id, None)
+
+    def send(self, message, reply_to, corr_id, timeout):
+        """只发送消息, 返回消息投递到 reply_to, 由其它消费者处理"""
+        self._publish(lambda channel: publish(channel, reply_to, corr_id,
+                                              message, timeout))
+
+    def emit(self, exchange, message):
+        self._publish(lambda channel: emit(channel, exchange, message))
+
+    def declare_exchange(self, exchange, exchange_type):
+        self._publish(lambda channel: channel.exchange_declare(
+            exchange=exchange, exchange_type=exchange_type))
+
+    def _publish(self, func):
+        self.connect()
+        try:
+            with self.lock:
+                func(self.channel)
+        except (CONNECTION_ERRORS + (AttributeError,)), e:
+            LOG.error('RabbitMQ connection lost during send: %s' % e)
+            self.close()
+            raise RPCUnavailable()
+
+
+def _cooperative():
+    """是否使用 gevent 客户端"""
+    if TRANSPORT == 'auto':
+        return gevent is not None and \
+            gevent_monkey.is_module_patched('socket')
+    return TRANSPORT == 'gevent'
+
+
+_transport = None
+
+
+def get_transport():
+    """获取当前进程的 RPC 客户端
+
+    gunicorn fork 出 worker 之后 pid 会变化,
+    不能复用父进程的连接.
+    """
+    global _transport
+    if _transport is None or _transport.pid != os.getpid():
+        if _cooperative():
+            _transport = Multiplexer()
+        else:
+            _transport = Pool()
+    return _transport
+
+
+class Flight(object):
+    """一个正在等待返回的只读请求, 相同的请求等待同一个 Flight"""
+
+    def __init__(self):
+        if _cooperative():
+            self.event = gevent_event.Event()
+        else:
+            self.event = threading.Event()
+        self.data = None
+        self.error = None
+
+    def wait(self, timeout):
+        """等待第一个请求的返回, 每个等待者得到一份新的结果"""
+        if not self.event.wait(timeout):
+            raise RPCTimeout()
+        if self.error is not None:
+            raise self.error
+        return tuple(simplejson.loads(self.data))
+
+
+# (请求 key, 代数) -> Flight
+_flights = {}
+
+
+def _coalesce(key, timeout, call):
+    """合并 worker 内相同的请求, 只有第一个请求调用 call
+
+    视图会修改返回的结果, 所以结果序列化之后保存,
+    其它等待者各自反序列化.
+    """
+    flight = _flights.get(key)
+    if flight is not None:
+        return flight.wait(timeout)
+    flight = _flights[key] = Flight()
+    try:
+        result = _coalesce_workers(key, timeout, call)
+        flight.data = simplejson.dumps(result)
+    except Exception, e:
+        flight.error = e
+        raise
+    finally:
+        del _flights[key]
+        flight.event.set()
+    return result
+
+
+def _coalesce_workers(key, timeout, call):
+    """通过 Redis 合并不同 worker 的相同请求
+
+    第一个 worker 用 SET NX 拿到锁, 锁的值是一个随机 token, 收到返回之后
+    把结果写入 <key>:<token> 再释放锁. 其它 worker 读取 token, 轮询结果
+    key; 锁消失却没有结果(第一个请求失败)时自己发送请求.
+    Redis 不可用时直接发送.
+    """
+    conn = get_redis()
+    if conn is None:
+        return call()
+    lock = key + ':lock'
+    deadline = time.time() + timeout
+    try:
+        while True:
+            token = uuid.uuid4().hex
+            if conn.set(lock, token, nx=True, px=int(timeout * 1000)):
+                break
+            token = conn.get(lock)
+            if token is None:
+                continue
+            while time.time() < deadline:
+                data = conn.get('%s:%s' % (key, token))
+                if data is not None:
+                    return tuple(simplejson.loads(data))
+                if conn.get(lock) != token:
+                    return call()
+                time.sleep(COALESCE_POLL)
+            raise RPCTimeout()
+    except redis.RedisError, e:
+        mark_down(e)
+        return call()
+
+    try:
+        result = call()
+    except Exception:
+        # 失败的请求只释放锁, 其它 worker 会自己发送
+        _release(conn, lock)
+        raise
+    _release(conn, lock, '%s:%s' % (key, token), simplejson.dumps(result))
+    return result
+
+
+def _release(conn, lock, result_key=None, data=None):
+    """写入返回结果并释放锁"""
+    try:
+        pipe = conn.pipeline()
+        if result_key is not None:
+            pipe.setex(result_key, COALESCE_RESULT_TTL, data)
+        pipe.delete(lock)
+        pipe.execute()
+    except redis.RedisError, e:
+        mark_down(e)
+
+
+def send_message(message, timeout=None):
+    """发送消息
+
+    Params:
+        message: dict; 消息内容, 包含 message_type
+        timeout: int;  等待返回的秒数, 默认根据 message_type 获取
+
+    Return:
+        (status,
+         msgs,
+         results)
+
+    只读的消息先查询缓存(lib/cache), 没有命中时和正在等待返回的相同
+    请求合并; 修改容器的消息完成之后使该容器的缓存失效.
+    超时抛出 RPCTimeout(504), 无法连接抛出 RPCUnavailable(503).
+    """
+    lookup, result = cache.get(message)
+    if result is not None:
+        return result
+    if timeout is None:
+        timeout = get_timeout(message)
+    if lookup is None or not COALESCE:
+        return _send_message(message, timeout, lookup)
+    return _coalesce('%s:%s' % (lookup[0], lookup[1]), timeout,
+                     lambda: _send_message(message, timeout, lookup))
+
+
+def _send_message(message, timeout, lookup, request=None):
+    if request is None:
+        request = codec.encode(message)
+    timer = metrics.RPCTimer(message.get('message_type'), len(request[0]))
+    try:
+        reply = get_transport().request(request, timeout)
+    except RPCError, e:
+        timer.done(e.outcome)
+        raise
+    finally:
+        # 超时的修改操作可能已经执行, 同样使缓存失效
+        cache.invalidate(message)
     # 返回消息处理结果
-    res = simplejson.loads(call.request(simplejson.dumps(message)))
+    result = _result(timer, reply)
+    cache.set(lookup, result)
+    rpc_completed.send(sender=None, message=message, result=result)
+    return result
+
+
+def send_data(message, data, timeout=None):
+    """发送带原始字节的消息(见 codec.encode_data), 不查询缓存也不合并
+
+    Params:
+        message: dict; 消息内容, 包含 message_type
+        data:    str;  原始字节, 例如上传文件的一段
+        timeout: int;  等待返回的秒数, 默认根据 message_type 获取
+
+    Return:
+        (status, msgs, results)
+
+    超时抛出 RPCTimeout(504), 无法连接抛出 RPCUnavailable(503).
+    """
+    if timeout is None:
+        timeout = get_timeout(message)
+    return _send_message(message, timeout, None,
+                         codec.encode_data(message, data))
+
+
+def _result(timer, reply):
+    """解码返回消息并记录统计, 失败的返回 (状态码, 错误信息, None)"""
+    if isinstance(reply, RPCError):
+        timer.done(reply.outcome)
+        return (reply.status_code, reply.detail, None)
+    props, body = reply
+    res = codec.decode_reply(props, body)
+    timer.done('ok' if res[0] == 0 else 'error', len(body))
     return (res[0], res[1], res[2])
+
+
+def send_many(messages, timeout=None):
+    """批量发送消息, 并发等待所有返回
+
+    所有消息先连续发出再一起等待, N 个请求的耗时约等于最慢的那一个,
+    而不是 N 次往返. 缓存的处理和 send_message 一致, 命中缓存的消息
+    不会发出.
+
+    Params:
+        messages: list; 消息列表, 每个消息包含 message_type
+        timeout:  int;  每个消息等待返回的秒数, 默认根据 message_type 获取
+
+    Return:
+        [(status, msgs, results), ...]  # 和 messages 顺序一致
+
+    单个消息超时或者失败不影响其它消息, 该消息的 status 为对应的
+    HTTP 状态码(504/503), msgs 为错误信息, results 为 None.
+    """
+    results = [None] * len(messages)
+    lookups = {}
+    pending = []
+    for i, message in enumerate(messages):
+        lookup, result = cache.get(message)
+        if result is None:
+            lookups[i] = lookup
+            pending.append(i)
+        else:
+            results[i] = result
+    if not pending:
+        return results
+
+    timeouts = [get_timeout(messages[i]) if timeout is None else timeout
+                for i in pending]
+    requests = [codec.encode(messages[i]) for i in pending]
+    timers = [metrics.RPCTimer(messages[i].get('message_type'),
+                               len(request[0]))
+              for i, request in zip(pending, requests)]
+    try:
+        replies = get_transport().request_many(requests, timeouts)
+    except RPCError, e:
+        replies = [e] * len(requests)
+    for i, timer, reply in zip(pending, timers, replies):
+        cache.invalidate(messages[i])
+        results[i] = _result(timer, reply)
+        cache.set(lookups[i], results[i])
+        if not isinstance(reply, RPCError):
+            rpc_completed.send(sender=None, message=messages[i],
+                               result=results[i])
+    return results
+
+
+def send_async(message, reply_to, corr_id, timeout=None):
+    """只发送消息, 不等待返回
+
+    scheduler 把返回消息发到 reply_to 队列, 由该队列的消费者
+    根据 corr_id 处理(见 lib/jobs).
+
+    Params:
+        message:  dict; 消息内容, 包含 message_type
+        reply_to: str;  接收返回消息的队列
+        corr_id:  str;  返回消息的 correlation_id
+        timeout:  int;  消息在队列中的过期时间(秒), 默认根据 message_type 获取
+
+    无法连接抛出 RPCUnavailable(503).
+    """
+    if timeout is None:
+        timeout = get_timeout(message)
+    get_transport().send(codec.encode(message), reply_to, corr_id, timeout)
+
+
+def broadcast(exchange, message):
+    """发送消息到 exchange(例如 fanout), 不等待返回
+
+    无法连接抛出 RPCUnavailable(503).
+    """
+    get_transport().emit(exchange, codec.encode(message))
+
+
+def declare_exchange(exchange, exchange_type):
+    """用当前进程的连接声明 exchange, 不另外打开连接
+
+    无法连接抛出 RPCUnavailable(503).
+    """
+    get_transport().declare_exchange(exchange, exchange_type)
+
+
+def send_stream(message, timeout=None):
+    """发送消息, 逐段接收 scheduler 的输出
+
+    消息中加上 stream=True, scheduler 每产生一段输出就返回一个 headers
+    中 stream 为 chunk 的消息, body 为原始输出; 最后返回一个普通消息,
+    内容和 send_message 的返回一致.
+
+    Params:
+        message: dict; 消息内容, 包含 message_type
+        timeout: int;  两段输出之间最长等待的秒数, 默认根据 message_type 获取
+
+    Return:
+        生成器, 依次产生 ('output', str) 和最后的 ('result', (status, msgs, results)),
+        scheduler 返回的元数据(headers 中 stream 为 meta)产生 ('meta', dict)
+
+    超时抛出 RPCTimeout(504), 无法连接抛出 RPCUnavailable(503),
+    客户端读取太慢抛出 RPCOverflow(502).
+    """
+    if timeout is None:
+        timeout = get_timeout(message)
+    message = dict(message, stream=True)
+    request = codec.encode(message)
+    timer = metrics.RPCTimer(message.get('message_type'), len(request[0]))
+    size = 0
+    outcome = 'error'
+    try:
+        for props, body in get_transport().stream(request, timeout):
+            size += len(body)
+            if (props.headers or {}).get('stream') == 'meta':
+                yield 'meta', codec.decode_reply(props, body)
+                continue
+            if not stream_end(props):
+                yield 'output', codec.decompress(body, props.content_encoding)
+                continue
+            res = codec.decode_reply(props, body)
+            outcome = 'ok' if res[0] == 0 else 'error'
+            result = (res[0], res[1], res[2])
+            rpc_completed.send(sender=None, message=message, result=result)
+            yield 'result', result
+    except RPCError, e:
+        outcome = e.outcome
+        raise
+    finally:
+        # 客户端中途断开的按 error 统计
+        timer.done(outcome, size if outcome in ('ok', 'error') else None)
+        cache.invalidate(message)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Longgeek <longgeek@gmail.com>
+
+"""文件写入的增量补丁
+
+编辑器保存时只发送修改的部分和修改之前内容的 hash, scheduler 用
+hash 确认容器中的文件还是编辑器打开时的内容, 一致才应用补丁;
+不一致时不写入, 由客户端重新发送完整内容.
+
+补丁是按位置排序, 互不重叠的替换列表:
+
+    [[start, end, text], ...]
+
+把原内容中 [start, end) 的字符替换为 text, 位置按 unicode 字符计算.
+插入时 start == end, 删除时 text 为空.
+
+hash 为 UTF-8 编码之后内容的 sha1.
+"""
+
+import hashlib
+
+
+def content_hash(text):
+    """内容的 hash, text 为 unicode 或者 UTF-8 编码的 str"""
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return hashlib.sha1(text).hexdigest()
+
+
+def validate(ops):
+    """检查补丁的格式, 返回是否有效"""
+    if not isinstance(ops, list):
+        return False
+    last = 0
+    for op in ops:
+        if not isinstance(op, list) or len(op) != 3:
+            return False
+        start, end, text = op
+        if not isinstance(start, (int, long)) or \
+                not isinstance(end, (int, long)) or \
+                not isinstance(text, basestring):
+            return False
+        if start < last or end < start:
+            return False
+        last = end
+    return True
+
+
+def apply(text, ops):
+    """把补丁应用到 text, 返回新的内容
+
+    补丁超出原内容的范围抛出 ValueError.
+    """
+    parts = []
+    pos = 0
+    for start, end, replacement in ops:
+        if end > len(text):
+            raise ValueError('Patch out of range: %d > %d' % (end, len(text)))
+        parts.append(text[pos:start])
+        parts.append(replacement)
+        pos = end
+    parts.append(text[pos:])
+    return u''.join(parts)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Longgeek <longgeek@gmail.com>
+
+import os
+import time
+import logging
+
+import redis
+
+from telegraph_pole.settings import REDIS_DB
+from telegraph_pole.settings import REDIS_HOST
+from telegraph_pole.settings import REDIS_PORT
+
+
+LOG = logging.getLogger(__name__)
+
+# 连接和读写 Redis 的超时时间(秒), Redis 只用来做缓存和汇总,
+# 不能因为它卡住请求
+SOCKET_TIMEOUT = 0.5
+
+# Redis 出错之后多少秒内不再访问它
+RETRY_INTERVAL = 5
+
+_client = None
+_down_until = [0]
+
+
+def get_redis():
+    """当前进程共用的 Redis 客户端, 自带连接池
+
+    调用过 mark_down 之后的 RETRY_INTERVAL 秒内返回 None,
+    调用方跳过 Redis, 不用每个请求都等一次超时.
+    """
+    global _client
+    if _down_until[0] > time.time():
+        return None
+    if _client is None or _client.pid != os.getpid():
+        _client = redis.StrictRedis(host=REDIS_HOST,
+                                    port=int(REDIS_PORT),
+                                    db=int(REDIS_DB),
+                                    socket_timeout=SOCKET_TIMEOUT,
+                                    socket_connect_timeout=SOCKET_TIMEOUT)
+        _client.pid = os.getpid()
+    return _client
+
+
+def mark_down(error):
+    """记录 Redis 出错, RETRY_INTERVAL 秒之后再重试"""
+    if _down_until[0] <= time.time():
+        LOG.warning('Redis unavailable, retry in %ds: %s' % (
+            RETRY_INTERVAL, error))
+    _down_until[0] = time.time() + RETRY_INTERVAL
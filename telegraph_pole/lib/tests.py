@@ -0,0 +1,454 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Longgeek <longgeek@gmail.com>
+
+import time
+import hashlib
+import datetime
+import threading
+import simplejson
+
+from pika import spec
+from pika import exceptions
+
+from django.db import DatabaseError
+from django.test import TestCase
+from django.test import SimpleTestCase
+from django.utils import timezone
+
+from apphome.models import Job
+from telegraph_pole.lib import mq
+from telegraph_pole.lib import jobs
+from telegraph_pole.lib import cache
+from telegraph_pole.lib import codec
+from telegraph_pole.lib import memory_broker
+from telegraph_pole.lib import convert
+from telegraph_pole.lib import events
+from telegraph_pole.lib import patch
+
+
+class Channel(object):
+    def __init__(self):
+        self.acked = []
+
+    def basic_ack(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+
+class Method(object):
+    delivery_tag = 1
+
+
+class JobReplyTest(TestCase):
+    """on_reply 处理失败也 ack, 不会让 consume 退出"""
+
+    def reply(self, corr_id, body=None):
+        channel = Channel()
+        props = spec.BasicProperties(correlation_id=corr_id,
+                                     content_type='application/json')
+        if body is None:
+            body = simplejson.dumps([0, '', {'cid': 'abc'}])
+        jobs.on_reply(channel, Method(), props, body)
+        return channel.acked
+
+    def job(self):
+        return Job.objects.create(
+            message_type='stop_container',
+            deadline=timezone.now() + datetime.timedelta(seconds=30))
+
+    def test_success(self):
+        job = self.job()
+        self.assertEqual(self.reply('job:%d' % job.id), [1])
+        self.assertEqual(Job.objects.get(id=job.id).status, 'success')
+
+    def test_invalid_correlation_id(self):
+        self.assertEqual(self.reply('job:abc'), [1])
+
+    def test_deleted_job(self):
+        self.assertEqual(self.reply('job:999999'), [1])
+
+    def test_invalid_body(self):
+        job = self.job()
+        self.assertEqual(self.reply('job:%d' % job.id, '{not json'), [1])
+        self.assertEqual(Job.objects.get(id=job.id).status, 'error')
+
+    def test_database_error(self):
+        finish = jobs.finish
+
+        def broken(*args, **kwargs):
+            raise DatabaseError('gone away')
+        jobs.finish = broken
+        try:
+            self.assertEqual(self.reply('job:%d' % self.job().id), [1])
+        finally:
+            jobs.finish = finish
+
+
+class SweepTest(TestCase):
+    """sweep 不依赖返回和客户端查询, batch 也会继续执行"""
+
+    def setUp(self):
+        self.send_async = jobs.mq.send_async
+        self.ensure_queue = jobs._ensure_queue
+        self.sent = []
+
+        def send_async(message, queue, corr_id, timeout):
+            self.sent.append(corr_id)
+        jobs.mq.send_async = send_async
+        jobs._ensure_queue = lambda: None
+
+    def tearDown(self):
+        jobs.mq.send_async = self.send_async
+        jobs._ensure_queue = self.ensure_queue
+
+    def test_expire_and_dispatch(self):
+        now = timezone.now()
+        stalled = [Job.objects.create(
+            message_type='exec', batch='b1', status='pending',
+            deadline=now - datetime.timedelta(seconds=1))
+            for i in range(jobs.BATCH_CONCURRENCY)]
+        queued = Job.objects.create(
+            message_type='exec', batch='b1', status='queued',
+            message=simplejson.dumps({'message_type': 'exec'}),
+            deadline=now)
+        jobs.sweep()
+        for job in stalled:
+            self.assertEqual(Job.objects.get(id=job.id).status, 'timeout')
+        self.assertEqual(Job.objects.get(id=queued.id).status, 'pending')
+        self.assertEqual(self.sent, ['job:%d' % queued.id])
+
+
+class PatchTest(SimpleTestCase):
+    """files/write patch 模式的补丁"""
+
+    def test_validate(self):
+        self.assertTrue(patch.validate([]))
+        self.assertTrue(patch.validate([[0, 2, u'x'], [2, 2, u'y']]))
+        # 没有排序或者互相重叠
+        self.assertFalse(patch.validate([[5, 6, u''], [0, 1, u'']]))
+        self.assertFalse(patch.validate([[0, 4, u''], [3, 6, u'']]))
+        self.assertFalse(patch.validate([[3, 2, u'']]))
+        self.assertFalse(patch.validate([[-1, 2, u'']]))
+        self.assertFalse(patch.validate([[0, 1]]))
+        self.assertFalse(patch.validate({'0': [0, 1, u'']}))
+
+    def test_out_of_range(self):
+        self.assertRaises(ValueError, patch.apply, u'abc', [[1, 4, u'']])
+
+    def test_unicode_offsets(self):
+        # 位置按字符计算, 不是 UTF-8 的字节
+        text = u'编辑器保存'
+        self.assertEqual(patch.apply(text, [[0, 0, u'>'], [2, 3, u'工具'],
+                                            [5, 5, u'!']]),
+                         u'>编辑工具保存!')
+
+    def test_hash_matches_read(self):
+        # files/read 返回解码之后的内容和文件字节的 hash, 编辑器用返回
+        # 的内容计算 base_hash 必须一致
+        data = u'# 编码\nprint 1\n'.encode('utf-8')
+        self.assertEqual(patch.content_hash(data.decode('utf-8')),
+                         hashlib.sha1(data).hexdigest())
+        self.assertEqual(patch.content_hash(data),
+                         hashlib.sha1(data).hexdigest())
+
+
+class Stop(Exception):
+    pass
+
+
+class Connection(object):
+    closed = False
+
+    def channel(self):
+        raise exceptions.AMQPConnectionError('connection reset')
+
+    def close(self):
+        self.closed = True
+
+
+class EventsTest(TestCase):
+    """RabbitMQ 不可用时事件不影响请求"""
+
+    def setUp(self):
+        self.broadcast = mq.broadcast
+        self.ensure_exchange = events._ensure_exchange
+        self.sent = []
+
+        def broadcast(exchange, event):
+            self.sent.append(event)
+        mq.broadcast = broadcast
+        events._ensure_exchange = lambda: None
+        events._retry_at[0] = 0
+
+    def tearDown(self):
+        mq.broadcast = self.broadcast
+        events._ensure_exchange = self.ensure_exchange
+        events._retry_at[0] = 0
+        events._owners.clear()
+
+    def test_publish_fails_fast(self):
+        def broadcast(exchange, event):
+            self.sent.append(event)
+            raise mq.RPCUnavailable()
+        mq.broadcast = broadcast
+        events.publish({'id': '1'})
+        events.publish({'id': '2'})
+        self.assertEqual([event['id'] for event in self.sent], ['1'])
+
+    def test_rpc_completed_without_query(self):
+        events.remember_owner('3', '2')
+        with self.assertNumQueries(0):
+            events.on_rpc_completed(None, {'id': 3,
+                                           'message_type': 'stop_container'},
+                                    (0, '', {}))
+        self.assertEqual(self.sent[0]['user_id'], '2')
+
+    def test_hub_closes_connection(self):
+        open_connection, sleep = mq.open_connection, events.time.sleep
+        conn = Connection()
+        mq.open_connection = lambda: conn
+
+        def stop(seconds):
+            raise Stop()
+        events.time.sleep = stop
+        try:
+            self.assertRaises(Stop, events.Hub()._run)
+        finally:
+            mq.open_connection, events.time.sleep = open_connection, sleep
+        self.assertTrue(conn.closed)
+
+
+class ConvertTest(SimpleTestCase):
+    """无法解析的值只抛出 ValueError"""
+
+    def test_parse_created(self):
+        self.assertEqual(convert.format_created(
+            convert.parse_created(1417874473)), '1417874473')
+        self.assertEqual(convert.format_created(
+            convert.parse_created(' 1417874473 ')), '1417874473')
+        for value in ([1417874473], {}, True, 'yesterday'):
+            self.assertRaises(ValueError, convert.parse_created, value)
+
+    def test_parse_size(self):
+        self.assertEqual(convert.parse_size('2.5 kB'), 2500)
+        self.assertEqual(convert.parse_size(2500), 2500)
+        for value in (['2500'], True, '-1', '2 parsecs'):
+            self.assertRaises(ValueError, convert.parse_size, value)
+
+
+class Redis(object):
+    """cache 和 mq 用到的那部分 Redis 命令"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, nx=False, px=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = str(value)
+        return True
+
+    def setex(self, key, ttl, value):
+        return self.set(key, value)
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1)
+        return int(self.data[key])
+
+    def expire(self, key, ttl):
+        return key in self.data
+
+    def delete(self, key):
+        return self.data.pop(key, None) is not None
+
+    def pipeline(self):
+        return Pipeline(self)
+
+
+class Pipeline(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.conn, name)
+        return lambda *args: self.calls.append((method, args))
+
+    def execute(self):
+        return [method(*args) for method, args in self.calls]
+
+
+class Scheduler(object):
+    """进程内 broker 上的 scheduler 替身, hold 为 True 时先不返回"""
+
+    def __init__(self):
+        self.requests = []
+        self.held = []
+        self.hold = False
+        self.conn = memory_broker.BlockingConnection()
+        self.channel = self.conn.channel()
+        self.channel.queue_declare(queue='docker_scheduler')
+        self.channel.basic_consume(self.on_request, queue='docker_scheduler',
+                                   no_ack=True)
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while self.running:
+            self.conn.process_data_events(time_limit=0.01)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.conn.close()
+
+    def types(self):
+        return [message['message_type'] for message in self.requests]
+
+    def on_request(self, ch, method, props, body):
+        self.requests.append(codec.decode_request(props, body))
+        if self.hold:
+            self.held.append(props)
+        else:
+            self.reply(props)
+
+    def release(self):
+        held, self.held = self.held, []
+        for props in held:
+            self.reply(props)
+
+    def reply(self, props):
+        body, properties = codec.encode([0, '', {'n': len(self.requests)}])
+        self.channel.basic_publish(
+            exchange='', routing_key=props.reply_to,
+            properties=spec.BasicProperties(
+                correlation_id=props.correlation_id, **properties),
+            body=body)
+
+
+class BrokerTestCase(TestCase):
+    """mq 使用进程内的 broker 和 Redis 替身"""
+
+    def setUp(self):
+        self.saved = (mq.BROKER, mq._transport, memory_broker._broker,
+                      mq.get_redis, cache.get_redis)
+        mq.BROKER = 'memory'
+        mq._transport = None
+        memory_broker._broker = memory_broker.Broker()
+        self.redis = Redis()
+        mq.get_redis = cache.get_redis = lambda: self.redis
+        cache._local.clear()
+        self.scheduler = Scheduler()
+
+    def tearDown(self):
+        self.scheduler.stop()
+        (mq.BROKER, mq._transport, memory_broker._broker,
+         mq.get_redis, cache.get_redis) = self.saved
+        cache._local.clear()
+
+
+class CacheTest(BrokerTestCase):
+    """修改容器之后该容器的缓存失效"""
+
+    def test_invalidate(self):
+        inspect = {'id': 3, 'message_type': 'inspect_container'}
+        first = mq.send_message(dict(inspect))
+        self.assertEqual(mq.send_message(dict(inspect)), first)
+        self.assertEqual(self.scheduler.types(), ['inspect_container'])
+
+        mq.send_message({'id': 3, 'message_type': 'stop_container'})
+        self.assertEqual(self.redis.get(cache._generation_key('3')), '1')
+
+        self.assertNotEqual(mq.send_message(dict(inspect)), first)
+        self.assertEqual(self.scheduler.types(), ['inspect_container',
+                                                  'stop_container',
+                                                  'inspect_container'])
+        # 其它容器的缓存不受影响
+        mq.send_message({'id': 4, 'message_type': 'inspect_container'})
+        mq.send_message({'id': 4, 'message_type': 'inspect_container'})
+        self.assertEqual(self.scheduler.types().count('inspect_container'),
+                         3)
+
+
+class CoalesceTest(BrokerTestCase):
+    """相同的只读请求只发送一次"""
+
+    message = {'id': 3, 'message_type': 'top_container'}
+
+    def setUp(self):
+        super(CoalesceTest, self).setUp()
+        self.ttls = dict(cache.TTLS)
+        # 不缓存, 只测试合并
+        cache.TTLS['top_container'] = 0
+
+    def tearDown(self):
+        cache.TTLS.clear()
+        cache.TTLS.update(self.ttls)
+        super(CoalesceTest, self).tearDown()
+
+    def concurrently(self, count, timeout=5, release=True):
+        results = [None] * count
+
+        def request(i):
+            try:
+                results[i] = mq.send_message(dict(self.message), timeout)
+            except mq.RPCError, e:
+                results[i] = e
+        threads = [threading.Thread(target=request, args=(i,))
+                   for i in range(count)]
+        for thread in threads:
+            thread.start()
+            # 等第一个请求发出之后再开始其它请求
+            while not self.scheduler.requests:
+                time.sleep(0.01)
+        time.sleep(0.05)
+        if release:
+            self.scheduler.release()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_follower_waits_for_leader(self):
+        self.scheduler.hold = True
+        results = self.concurrently(3)
+        self.assertEqual(len(self.scheduler.requests), 1)
+        self.assertEqual(results, [(0, '', {'n': 1})] * 3)
+        # 每个等待者得到各自的一份结果
+        self.assertIsNot(results[1][2], results[2][2])
+
+    def test_leader_fails(self):
+        self.scheduler.hold = True
+        # scheduler 一直不返回, 第一个请求超时
+        results = self.concurrently(2, timeout=0.2, release=False)
+        self.assertEqual(len(self.scheduler.requests), 1)
+        for result in results:
+            self.assertIsInstance(result, mq.RPCTimeout)
+        # 失败只释放锁, 下一个请求重新发送
+        self.scheduler.hold = False
+        self.assertEqual(mq.send_message(dict(self.message)),
+                         (0, '', {'n': 2}))
+
+    def test_other_worker_leader(self):
+        # 另一个 worker 持有锁, 返回之后写入结果
+        key = 'top:0'
+        self.redis.set(key + ':lock', 'token')
+        timer = threading.Timer(0.05, self.redis.set,
+                                (key + ':token', simplejson.dumps(
+                                    [0, '', {'n': 0}])))
+        timer.start()
+        result = mq._coalesce_workers(key, 5, self.fail)
+        self.assertEqual(result, (0, '', {'n': 0}))
+
+    def test_other_worker_leader_fails(self):
+        # 另一个 worker 失败, 只释放锁, 等待者自己发送
+        key = 'top:0'
+        self.redis.set(key + ':lock', 'token')
+        timer = threading.Timer(0.05, self.redis.delete, (key + ':lock',))
+        timer.start()
+        result = mq._coalesce_workers(key, 5, lambda: (0, '', {'n': 1}))
+        self.assertEqual(result, (0, '', {'n': 1}))
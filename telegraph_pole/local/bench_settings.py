@@ -0,0 +1,48 @@
+# -*- coding:utf-8 -*-
+
+# 压测配置, 通过 TELEGRAPH_POLE_PROFILE=bench 启用
+#
+# 使用 SQLite 和进程内的 broker(lib/memory_broker), 不需要 MySQL,
+# RabbitMQ 和 docker_scheduler, 见 benchmarks/load.py
+
+import os
+import tempfile
+
+DEBUG = False
+
+TEMPLATE_DEBUG = False
+
+ALLOWED_HOSTS = ['*']
+
+# Database
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get('TELEGRAPH_POLE_BENCH_DB',
+                               os.path.join(tempfile.gettempdir(),
+                                            'telegraph_pole_bench.sqlite3')),
+    }
+}
+
+# RabbitMQ Server Setup
+
+RABBITMQ_HOST = '127.0.0.1'
+RABBITMQ_PORT = '5672'
+RABBITMQ_USER = 'guest'
+RABBITMQ_PASS = 'guest'
+RABBITMQ_URLS = 'amqp://%s:%s@%s:%s//' % (RABBITMQ_USER,
+                                          RABBITMQ_PASS,
+                                          RABBITMQ_HOST,
+                                          RABBITMQ_PORT)
+
+# 进程内的 broker, scheduler 替身见 benchmarks/fake_scheduler.py
+RABBITMQ_BROKER = 'memory'
+RABBITMQ_TRANSPORT = 'auto'
+RABBITMQ_DIRECT_REPLY_TO = False
+
+# Redis Server Setup
+
+REDIS_DB = '0'
+REDIS_PORT = '6379'
+REDIS_HOST = '127.0.0.1'
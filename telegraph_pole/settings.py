@@ -1,11 +1,27 @@
 # -*- coding:utf-8 -*-
 
+import os
 import logging
+import importlib
+
+# TELEGRAPH_POLE_PROFILE=bench 使用 telegraph_pole/local/bench_settings.py
+# 代替 local_settings.py, 例如压测时使用 SQLite 和进程内的 broker
+PROFILE = os.environ.get('TELEGRAPH_POLE_PROFILE')
 
 try:
-    from local.local_settings import *
+    if PROFILE:
+        # 只复制大写的配置项, 和 import * 读取配置的效果一致
+        _profile = importlib.import_module('.local.%s_settings' % PROFILE,
+                                           __name__.rpartition('.')[0])
+        globals().update((name, value)
+                         for name, value in vars(_profile).items()
+                         if name.isupper())
+        del _profile
+    else:
+        from local.local_settings import *
 except ImportError:
-    logging.error("No local_settings file found in telegraph_pole/local/local_settings.py")
+    logging.error("No local_settings file found in "
+                  "telegraph_pole/local/%s_settings.py" % (PROFILE or 'local'))
     exit()
 
 